@@ -1 +1 @@
-from . import model_helpers, jfuncs, kerrexact#, jax_kerrexact
\ No newline at end of file
+from . import model_helpers, jfuncs, kerrexact, geodesic_tables, face_on, fourier#, jax_kerrexact
\ No newline at end of file
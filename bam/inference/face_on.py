@@ -0,0 +1,240 @@
+"""
+Face-on fast path for axisymmetric, stationary models viewed at inc ~ 0 (or pi).
+
+Seen face-on, lam = 0 and eta = rho**2 - a**2 for every pixel, so emission radius, redshift
+and path length depend only on the screen radius rho. Stokes I is then a pure radial profile,
+and linear polarization only carries the e^{2i varphi} harmonic. Instead of ray tracing and
+Fourier transforming a 2D image, we trace one radial cut of the screen and compute
+visibilities from Hankel transforms of the azimuthal harmonics of the image. The square
+crop of the model image's field of view is included through its own harmonics, so results
+match the image-based likelihood rather than an uncropped source.
+"""
+
+import numpy as np
+from scipy.special import j0, jv
+import ehtim as eh
+from bam.inference.kerrexact import kerr_exact_sep_lp
+
+#largest |sin(inc)| treated as face-on; there the varphi dependence of I is below ~1e-3
+FACE_ON_TOL = 1e-3
+#the ray tracing is degenerate at exactly inc = 0, so face-on cuts are traced just off the axis
+MIN_INC = 1e-8
+#seen face-on, each subimage is demagnified by about e^{-pi} relative to the one before it, so the
+#n-th ring of an emitting region FACE_ON_RING_WIDTH M wide is FACE_ON_RING_WIDTH e^{-pi n} M wide,
+#and the default radial grid puts FACE_ON_RING_SAMPLES bins across the ring of each subimage
+FACE_ON_RING_WIDTH = 10.
+FACE_ON_RING_SAMPLES = 10
+#the face-on critical curve has radius 3 sqrt(3) M at a = 0, shrinking to about 4.83 M as |a| -> 1
+FACE_ON_CRITICAL_RHO = (4.8, 3*np.sqrt(3))
+#subimages n >= 1 of the equatorial plane (r < 1000 M) lie within FACE_ON_BAND_WIDTH e^{-FACE_ON_BAND_DECAY (n-1)} M
+#of the critical curve; the decay is slower than pi, since rings of high spins are demagnified less
+FACE_ON_BAND_WIDTH = 1.
+FACE_ON_BAND_DECAY = 2.
+#largest default number of radial bins; the likelihood holds a nuv x nrho Bessel matrix per harmonic order
+MAX_FACE_ON_NRHO = 8192
+
+
+def is_face_on(inc, tol=FACE_ON_TOL):
+    """
+    Check whether a fixed inclination is close enough to the spin axis for the face-on fast path.
+    """
+    return not np.iterable(inc) and np.abs(np.sin(inc)) <= tol
+
+
+def face_on_grid(fov, nrho):
+    """
+    Midpoints of nrho radial bins covering the circle circumscribing the square field of view.
+    Returns the radii and the (uniform) bin width, in the units of fov. Functions of the grid
+    also take the bin widths of default_face_on_grid, whose bins are not uniform.
+    """
+    drho = np.sqrt(0.5)*fov/nrho
+    rho = (np.arange(nrho)+0.5)*drho
+    return rho, drho
+
+
+def ring_bands(nmax, scale=(1., 1.)):
+    """
+    The radial bands holding subimages 1..nmax, and the bin width that resolves the ring of each,
+    for screen radii in units of M times scale, a pair of the smallest and largest M/D.
+    """
+    bands = []
+    for n in range(1, nmax+1):
+        width = FACE_ON_BAND_WIDTH*np.exp(-FACE_ON_BAND_DECAY*(n-1))
+        lo = (FACE_ON_CRITICAL_RHO[0]-width)*scale[0]
+        hi = (FACE_ON_CRITICAL_RHO[1]+width)*scale[1]
+        bands.append((lo, hi, FACE_ON_RING_WIDTH*np.exp(-np.pi*n)/FACE_ON_RING_SAMPLES*scale[0]))
+    return bands
+
+
+def default_face_on_grid(fov, nmax, scale=(1., 1.), min_nrho=0, max_nrho=MAX_FACE_ON_NRHO):
+    """
+    Default radial grid for a face-on field of view fov, in units of M times scale, a pair of the
+    smallest and largest M/D. Bins resolve the n = 0 image, and are at least as fine as min_nrho
+    uniform bins; inside the nested bands around the critical curve that hold subimages 1..nmax,
+    they resolve the ring of each. Finer subimages are left out while the grid would exceed
+    max_nrho bins. Returns the midpoints and widths of the bins, in the units of fov.
+    """
+    rho_max = np.sqrt(0.5)*fov
+    coarse = min(FACE_ON_RING_WIDTH/FACE_ON_RING_SAMPLES*scale[0], rho_max/max(min_nrho, 1))
+    def segments(bands):
+        #each stretch between band edges takes the finest bin width of the bands covering it
+        breaks = np.unique(np.clip([0., rho_max]+[x for band in bands for x in band[:2]], 0., rho_max))
+        widths = [min([coarse]+[w for lo, hi, w in bands if lo <= 0.5*(x0+x1) <= hi]) for x0, x1 in zip(breaks[:-1], breaks[1:])]
+        return breaks, np.ceil(np.diff(breaks)/widths).astype(int)
+    bands = ring_bands(nmax, scale=scale)
+    nres = nmax
+    breaks, counts = segments(bands)
+    while np.sum(counts) > max_nrho and nres > 0:
+        nres -= 1
+        breaks, counts = segments(bands[:nres])
+    if nres < nmax:
+        hint = "" if scale[0] == scale[1] else " Mass-invariant mode or a narrower MoDuas prior shrinks the bands."
+        print("Resolving the face-on rings of subimage "+str(nres)+" and below only, since those up to nmax = "+str(nmax)+" need "+str(np.sum(segments(bands)[1]))+" radial bins."+hint)
+    grid = np.concatenate([[0.]]+[np.linspace(x0, x1, count+1)[1:] for x0, x1, count in zip(breaks[:-1], breaks[1:], counts)])
+    return 0.5*(grid[1:]+grid[:-1]), np.diff(grid)
+
+
+def window_harmonics(rho, fov, kmax=3):
+    """
+    Azimuthal harmonics {m: w_m(rho)} of the indicator function of the square field of view,
+    which crops the model image. Only m = 0, +-4, +-8, ... contribute; kmax sets how many of
+    the m = +-4k pairs to keep. Beyond the inscribed circle, each side of the square
+    removes an arc of half-width arccos(fov/(2 rho)).
+    """
+    theta = np.arccos(np.clip(0.5*fov/rho, -1., 1.))
+    harmonics = {0:1-4*theta/np.pi}
+    for k in range(1, kmax+1):
+        harmonics[4*k] = -np.sin(4*k*theta)/(k*np.pi)
+        harmonics[-4*k] = harmonics[4*k]
+    return harmonics
+
+
+def face_on_primitives(rho, MoDuas, inc, a, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=False, r_o=np.inf, use_numba=False, intensity_only=False):
+    """
+    Ray trace the radial cut varphi = pi/2 (alpha = 0) of a face-on screen and evaluate the
+    fluid emissivity model along it. Returns the same lists as kerr_exact_sep_lp, with every
+    subimage sampled on the same radii. Along the cut, Q + iU is the coefficient of
+    e^{2i(varphi - pi/2)} in the full image, while I, V, redshift and path length are independent of varphi.
+    """
+    if np.cos(inc) > 0:
+        inc = np.clip(inc, MIN_INC, np.pi/2)
+    else:
+        inc = np.clip(inc, np.pi/2, np.pi-MIN_INC)
+    varphi = np.full_like(rho, np.pi/2)
+    return kerr_exact_sep_lp(rho, MoDuas, varphi, inc, a, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=compute_V, r_o=r_o, use_numba=use_numba, intensity_only=intensity_only)
+
+
+def bessel_matrix(order, q, rho):
+    """
+    J_order(2 pi q rho) on the outer product of baseline lengths q and radii rho.
+    """
+    arg = 2*np.pi*np.outer(q, rho)
+    if order == 0:
+        return j0(arg)
+    return jv(order, arg)
+
+
+def hankel_vis(rho, drho, harmonics, uv, rotation=0., cache=None):
+    """
+    Visibilities of an image I(rho, varphi) = sum_m f_m(rho) e^{i m varphi}, given as a dict
+    {m: f_m} of profiles on the radial grid from face_on_grid (in radians), at an array of
+    (u, v) points in wavelengths. Each harmonic contributes
+        2 pi (-i)^m e^{i m psi} int f_m(rho) J_m(2 pi q rho) rho drho,
+    where q = |(u, v)| and psi is the position angle of (-u, v), matching the screen
+    convention that varphi is measured north of west. The image is first rotated east of
+    north by rotation, as for an ehtim Image with pa = rotation.
+    If an LRUCache is given, Bessel matrices are stored in it keyed on the order and uv,
+    so the cache must only be shared between calls on the same radial grid.
+    """
+    uv = np.atleast_2d(uv)
+    q = np.sqrt(uv[:,0]**2 + uv[:,1]**2)
+    psi = np.arctan2(uv[:,1], -uv[:,0]) - rotation
+    weights = dict([(m, profile*rho*drho) for m, profile in harmonics.items()])
+    vis = np.zeros(len(q), dtype=complex)
+    for order in set([abs(m) for m in weights]):
+        #J_{-m} = (-1)^m J_m, so each order is evaluated once
+        ms = [m for m in weights if abs(m) == order]
+        if cache is not None:
+            support = slice(None)
+            key = (order, uv.tobytes())
+            bessel = cache.get(key)
+            if bessel is None:
+                bessel = bessel_matrix(order, q, rho)
+                cache.put(key, bessel)
+        else:
+            #only evaluate the radii where some harmonic of this order is nonzero
+            support = np.any([weights[m] != 0 for m in ms], axis=0)
+            bessel = bessel_matrix(order, q, rho[support])
+        for m in ms:
+            radial = bessel.dot(weights[m][support])
+            if m < 0:
+                radial = radial*(-1)**order
+            vis += 2*np.pi*(-1j)**m*np.exp(1j*m*psi)*radial
+    return vis
+
+
+def face_on_flux(rho, drho, profile):
+    """
+    Total flux of an m = 0 harmonic on the radial grid from face_on_grid.
+    """
+    return 2*np.pi*np.sum(profile*rho*drho)
+
+
+def test_hankel_vis(npix=256, tol=1e-3):
+    """
+    Compare hankel_vis against the direct Fourier transform of a pixelized ring with an
+    m = 0 and m = 2 azimuthal structure.
+    """
+    fov = 100*eh.RADPERUAS
+    px = ((np.arange(npix)+0.5)/npix-0.5)*fov
+    PXI, PXJ = np.meshgrid(px, px)
+    rho2d = np.sqrt(PXI**2+PXJ**2)
+    varphi2d = np.arctan2(-PXJ, PXI)
+    rho, drho = face_on_grid(fov, 4*npix)
+    ring = lambda r: np.exp(-0.5*((r-20*eh.RADPERUAS)/(4*eh.RADPERUAS))**2)
+    harmonics = {0:ring(rho), 2:0.25j*ring(rho), -2:-0.25j*ring(rho)}
+    image = ring(rho2d)*(1-0.5*np.sin(2*varphi2d))
+    #pixel columns run east to west and rows north to south, so x = -alpha and y = beta
+    x = -PXI.flatten()
+    y = -PXJ.flatten()
+    uv = np.random.RandomState(0).uniform(-8e9, 8e9, size=(50, 2))
+    direct = np.exp(-2j*np.pi*(np.outer(uv[:,0], x)+np.outer(uv[:,1], y))).dot(image.flatten())*(fov/npix)**2
+    hankel = hankel_vis(rho, drho, harmonics, uv)
+    err = np.max(np.abs(hankel-direct))/np.max(np.abs(direct))
+    print("Max error relative to the zero-baseline flux: "+str(err))
+    if err > tol:
+        raise Exception("hankel_vis does not match the direct Fourier transform!")
+
+
+def test_default_face_on_grid(fov_M=16., npix=300, nmax=1, a=0.5, tol=1e-2):
+    """
+    Compare the face-on Stokes I visibilities on the default radial grid of default_face_on_grid against
+    the direct Fourier transform of the image ray traced on an npix x npix grid, for a thin
+    emitting region whose n = 1 ring is only resolved by the finer of the two grids. The 2D image
+    converges more slowly, so npix is set well above what the likelihood would use.
+    """
+    from bam.inference.model_helpers import get_rho_varphi_from_FOV_npix
+    inc = 1e-6
+    jfunc = lambda r: np.exp(-0.5*((r-5.)/1.)**2)
+    spec = 1.
+    def image(rvecs, redshifts, lps):
+        return np.sum([jfunc(rvecs[n])*redshifts[n]**(3+spec)*lps[n]*(rvecs[n] > 0) for n in range(nmax+1)], axis=0)
+    rho, drho = default_face_on_grid(fov_M, nmax)
+    rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = face_on_primitives(rho, 1., inc, a, nmax, 0., 0., None, np.pi/2, spec, None, intensity_only=True)
+    profile = image(rvecs, redshifts, lps)
+    harmonics = dict([(m, window*profile) for m, window in window_harmonics(rho, fov_M).items()])
+    rho2d, varphi2d = get_rho_varphi_from_FOV_npix(fov_M, npix)
+    rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = kerr_exact_sep_lp(rho2d, 1., varphi2d, inc, a, nmax, 0., 0., None, np.pi/2, spec, None, intensity_only=True)
+    image2d = np.nan_to_num(image(rvecs, redshifts, lps))*(fov_M/npix)**2
+    #pixel columns run east to west and rows north to south, so x = -alpha and y = beta
+    x = -rho2d*np.cos(varphi2d)
+    y = rho2d*np.sin(varphi2d)
+    q = np.random.RandomState(0).uniform(0., 0.5, size=30)
+    psi = np.random.RandomState(1).uniform(0., 2*np.pi, size=30)
+    uv = np.column_stack([q*np.cos(psi), q*np.sin(psi)])
+    direct = np.exp(-2j*np.pi*(np.outer(uv[:,0], x)+np.outer(uv[:,1], y))).dot(image2d)
+    hankel = hankel_vis(rho, drho, harmonics, uv)
+    err = np.max(np.abs(hankel-direct))/np.abs(np.sum(image2d))
+    print("Max error relative to the zero-baseline flux with "+str(len(rho))+" radial bins: "+str(err))
+    if err > tol:
+        raise Exception("The default face-on radial grid does not match the ray traced image!")
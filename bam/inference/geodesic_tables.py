@@ -0,0 +1,185 @@
+"""
+Precomputed ray tracing tables on a grid of spin and inclination.
+
+Tables are computed on a screen grid in units of M (see mass-invariant mode in KerrBam),
+so they can be reused for any MoDuas. Each quantity is stored as a separate .npy file
+of shape (len(spins), len(incs), npix_n) per subimage, which is memory-mapped on load so
+that every sampler process on a node shares one copy of the pages.
+
+Emission radii change too quickly near the critical curve to be interpolated between nodes, but
+the Mino time and radial roots they follow from are closed forms in (lam, eta), so a lookup traces
+r, sign(p_r) and the emitting mask exactly and only interpolates phi and t, whose elliptic
+integrals of the third kind are the expensive part of ray tracing. Tables therefore store only
+phi, t and the emitting mask, and only help models that are non-axisymmetric or non-stationary;
+axisymmetric, stationary models never compute phi or t, so a table would save them nothing.
+"""
+
+import os
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+from bam.inference.model_helpers import get_rho_varphi_from_FOV_npix
+from bam.inference.kerrexact import ray_trace_all, sub_in_adap
+
+
+def table_fields(axisymmetric=True, stationary=True):
+    """
+    Names and dtypes of the quantities stored in a table.
+    """
+    fields = [('mask', np.uint8)]
+    if not axisymmetric:
+        fields.append(('phi', np.float64))
+    if not stationary:
+        fields.append(('t', np.float64))
+    return fields
+
+
+def build_geodesic_table(path, fov_M, npix, spins, incs, nmax, adap_fac=1, axisymmetric=True, stationary=True, r_o=np.inf):
+    """
+    Ray trace a screen grid of fov_M gravitational radii at every (a, inc) in spins x incs
+    and write the emitting mask of each subimage, with phi if not axisymmetric and t if not
+    stationary, to a directory of .npy files. Adaptive subimages are stored on their full grids.
+    """
+    if axisymmetric and stationary:
+        raise Exception("Axisymmetric, stationary models do not use phi or t, so there is nothing to tabulate!")
+    spins = np.sort(np.atleast_1d(np.asarray(spins, dtype=float)))
+    incs = np.sort(np.atleast_1d(np.asarray(incs, dtype=float)))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if nmax == 0:
+        adap_fac = 1
+    rho_M, varphi = get_rho_varphi_from_FOV_npix(fov_M, npix, adap_fac=adap_fac, nmax=nmax)
+    sizes = [(npix*adap_fac**n)**2 for n in range(nmax+1)]
+    fields = table_fields(axisymmetric=axisymmetric, stationary=stationary)
+    arrays = {}
+    for name, dtype in fields:
+        for n in range(nmax+1):
+            arrays[(name, n)] = open_memmap(os.path.join(path, name+'_'+str(n)+'.npy'), mode='w+', dtype=dtype, shape=(len(spins), len(incs), sizes[n]))
+
+    print("Building geodesic table with "+str(len(spins)*len(incs))+" (a, inc) nodes.")
+    for i, j in tqdm([(i, j) for i in range(len(spins)) for j in range(len(incs))]):
+        rvecs, phivecs, tvecs, signprs, signpthetas, alphas, betas, lams, etas, adap_masks = ray_trace_all(rho_M, 1., varphi, incs[j], spins[i], nmax, adap_fac=adap_fac, axisymmetric=axisymmetric, stationary=stationary, r_o=r_o)
+        for n in range(nmax+1):
+            if adap_fac > 1 and n > 0:
+                expand = lambda vec: sub_in_adap(sizes[n], adap_masks[n], vec)
+            else:
+                expand = lambda vec: vec
+            arrays[('mask', n)][i, j] = expand(rvecs[n]) > 0
+            if not axisymmetric:
+                arrays[('phi', n)][i, j] = expand(phivecs[n])
+            if not stationary:
+                arrays[('t', n)][i, j] = expand(tvecs[n])
+    for array in arrays.values():
+        array.flush()
+
+    meta = {'fov_M':fov_M, 'npix':npix, 'nmax':nmax, 'adap_fac':adap_fac, 'axisymmetric':axisymmetric, 'stationary':stationary, 'r_o':float(r_o), 'spins':list(spins), 'incs':list(incs)}
+    with open(os.path.join(path, 'table.json'), 'w') as metafile:
+        json.dump(meta, metafile)
+    print("Saved geodesic table to "+path)
+    return GeodesicTable(path)
+
+
+def _bracket(grid, x):
+    """
+    Return the lower index and fractional offset of x on a sorted grid, clipped to the grid edges.
+    """
+    if len(grid) == 1:
+        return 0, 0, 0.
+    i = int(np.clip(np.searchsorted(grid, x) - 1, 0, len(grid)-2))
+    w = float(np.clip((x - grid[i])/(grid[i+1] - grid[i]), 0., 1.))
+    return i, i+1, w
+
+
+class GeodesicTable:
+    """
+    Memory-mapped geodesic table written by build_geodesic_table. Calling ray_trace(a, inc)
+    returns the same outputs as ray_trace_all, with phi and t bilinearly interpolated from the table.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'table.json')) as metafile:
+            meta = json.load(metafile)
+        self.fov_M = meta['fov_M']
+        self.npix = meta['npix']
+        self.nmax = meta['nmax']
+        self.adap_fac = meta['adap_fac']
+        self.axisymmetric = meta['axisymmetric']
+        self.stationary = meta['stationary']
+        self.r_o = meta['r_o']
+        self.spins = np.array(meta['spins'])
+        self.incs = np.array(meta['incs'])
+        self.fields = [name for name, dtype in table_fields(axisymmetric=self.axisymmetric, stationary=self.stationary)]
+        self.arrays = {}
+        for name in self.fields:
+            for n in range(self.nmax+1):
+                self.arrays[(name, n)] = np.load(os.path.join(path, name+'_'+str(n)+'.npy'), mmap_mode='r')
+
+    def covers(self, spin_bounds, inc_bounds):
+        """
+        Check whether the table spans the given ranges of spin and inclination.
+        """
+        return np.min(spin_bounds) >= self.spins[0] and np.max(spin_bounds) <= self.spins[-1] and np.min(inc_bounds) >= self.incs[0] and np.max(inc_bounds) <= self.incs[-1]
+
+    def __getstate__(self):
+        #reopen the memory maps after unpickling instead of copying their contents
+        return {'path':self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def ray_trace(self, a, inc, **kwargs):
+        """
+        ray_trace_all at (a, inc) on the grid of the table. r, the signs and the adaptive masks are
+        traced exactly; phi and t are averaged over the surrounding nodes that have emission at each
+        pixel, and are zero where none has. Like r, they change quickly near the critical curve, so
+        their error there shrinks only with the node spacing. kwargs go to ray_trace_all.
+        """
+        rho_M, varphi = get_rho_varphi_from_FOV_npix(self.fov_M, self.npix, adap_fac=self.adap_fac, nmax=self.nmax)
+        rvecs, phivecs, tvecs, signprs, signpthetas, alphas, betas, lams, etas, adap_masks = ray_trace_all(rho_M, 1., varphi, inc, a, self.nmax, adap_fac=self.adap_fac, r_o=self.r_o, **kwargs)
+        names = [name for name in ['phi', 't'] if name in self.fields]
+        ia0, ia1, wa = _bracket(self.spins, a)
+        ii0, ii1, wi = _bracket(self.incs, inc)
+        nodes = [(ia0, ii0, (1-wa)*(1-wi)), (ia1, ii0, wa*(1-wi)), (ia0, ii1, (1-wa)*wi), (ia1, ii1, wa*wi)]
+        nodes = [node for node in nodes if node[2] > 0]
+        interped = {'phi':phivecs, 't':tvecs}
+        for n in range(self.nmax+1):
+            weight = 0.
+            sums = dict([(name, 0.) for name in names])
+            for ia, ii, w in nodes:
+                mask = self.arrays[('mask', n)][ia, ii]
+                weight = weight + w*mask
+                for name in names:
+                    sums[name] = sums[name] + w*mask*self.arrays[(name, n)][ia, ii]
+            safe_weight = np.where(weight > 0, weight, 1.)
+            for name in names:
+                full = np.where(weight > 0, sums[name]/safe_weight, 0.)
+                #adaptive subimages are traced only inside their masks, and stored on full grids
+                if self.adap_fac > 1 and n > 0:
+                    full = full[adap_masks[n]]
+                interped[name][n] = np.where(rvecs[n] != 0, full, 0.)
+        return rvecs, interped['phi'], interped['t'], signprs, signpthetas, alphas, betas, lams, etas, adap_masks
+
+
+def test_geodesic_table(path, npix=30, nmax=1, adap_fac=2, fov_M=20., r_o=1e4, phi_tol=0.05, t_tol=2.):
+    """
+    Build a table at path on a coarse grid of spins and inclinations, then check the phi and t
+    that ray_trace interpolates against ray_trace_all at the midpoints between nodes: their median
+    absolute errors over the emitting pixels of each subimage must be below phi_tol and t_tol (in M).
+    """
+    spins = [-0.5, -0.4, 0.3, 0.4]
+    incs = np.radians([15., 20., 60., 65.])
+    table = build_geodesic_table(path, fov_M, npix, spins, incs, nmax, adap_fac=adap_fac, axisymmetric=False, stationary=False, r_o=r_o)
+    rho_M, varphi = get_rho_varphi_from_FOV_npix(fov_M, npix, adap_fac=adap_fac, nmax=nmax)
+    failed = False
+    for a, inc in [(-0.45, np.radians(17.5)), (0.35, np.radians(62.5))]:
+        exact = ray_trace_all(rho_M, 1., varphi, inc, a, nmax, adap_fac=adap_fac, axisymmetric=False, stationary=False, r_o=r_o)
+        interped = table.ray_trace(a, inc)
+        for n in range(nmax+1):
+            emitting = exact[0][n] != 0
+            for i, name, tol in [(1, 'phi', phi_tol), (2, 't', t_tol)]:
+                err = np.median(np.abs(interped[i][n]-exact[i][n])[emitting])
+                print("a = "+str(a)+", inc = "+str(np.degrees(inc))+", n = "+str(n)+": median "+name+" error "+str(err))
+                failed = failed or not err < tol
+    if failed:
+        raise Exception("GeodesicTable.ray_trace interpolates phi or t too coarsely!")
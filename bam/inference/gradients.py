@@ -0,0 +1,473 @@
+"""
+Differentiable likelihood for KerrBam, and samplers that use its gradients.
+
+The chain from the screen grid to the log likelihood (ray tracing, the fluid emissivity model,
+the envelope and the Fourier transform of jax_kerrexact, then the data terms) is written in
+jax.numpy, so that jax gives the gradient of the log likelihood in every modeled parameter
+together with its value. It covers stationary, axisymmetric models seen from infinity; with
+adap_fac > 1, each subimage is traced on its whole native grid and transformed there, as with
+native_vis. The functions returned here run with 64-bit jax floats, enabled around each call with
+jax_ellip.x64, so the global precision of jax is left as it was.
+"""
+
+import numpy as np
+import ehtim as eh
+import jax
+import jax.numpy as jnp
+from scipy.special import ive
+from bam.inference.jax_kerrexact import make_grid, grid_stokes, dft
+from bam.inference.jax_ellip import x64
+from bam.inference.fourier import BaselineTable
+from bam.inference.data_helpers import amp_add_syserr, logcamp_add_syserr, cphase_add_syserr, get_cphase_uvpairs, cphase_uvdists, get_logcamp_uvpairs, logcamp_uvdists, get_camp_amp_sigma, get_cphase_vis_sigma, get_minimal_logcamps, get_minimal_cphases
+
+
+#trajectories whose energy error exceeds MAX_ENERGY_ERROR are counted as divergent
+MAX_ENERGY_ERROR = 1000.
+
+
+def make_grids(kb, im):
+    """
+    The pixel grids of the differentiable model: one holding all subimages, or with adap_fac > 1
+    one native grid per subimage, with the field of view and pulse of the model image im.
+    """
+    if kb.mass_invariant:
+        rho = kb.rho_M
+    else:
+        rho = kb.rho_uas
+    if kb.nmax == 0:
+        rho = [rho]
+        varphi = [kb.varphivec]
+    else:
+        varphi = kb.varphivec
+    if kb.adap_fac == 1:
+        groups = [list(range(kb.nmax+1))]
+    else:
+        groups = [[n] for n in range(kb.nmax+1)]
+    #a pixel of subimage n covers adap_fac**(2*(nmax-n)) pixels of the finest grid
+    return [make_grid(rho[ns[0]], varphi[ns[0]], im.fovx(), ns, weight=kb.adap_fac**(2*(kb.nmax-ns[0])), pulse=im.pulse) for ns in groups]
+
+def model_stokes(kb, grids, to_eval, intensity_only=False):
+    """
+    The Stokes I, Q, U and V images of to_eval on each grid, summed over its subimages and normalized
+    to unit total flux and polarization fraction, with dEVPA = 0; compute_image in jax.numpy.
+    """
+    imparams = dict([(ipn, to_eval[ipn]) for ipn in kb.imparam_names])
+    if kb.mass_invariant:
+        MoDuas = 1.
+    else:
+        MoDuas = imparams['MoDuas']
+    spec = imparams['spec']
+    fluid_eta = imparams['eta']
+    if fluid_eta is None:
+        fluid_eta = imparams['chi']+np.pi
+    alpha_zeta = imparams['alpha_zeta']
+    if alpha_zeta is None:
+        alpha_zeta = spec
+    stokes = [grid_stokes(grid, MoDuas, imparams['a'], imparams['inc'], imparams['beta'], imparams['chi'], fluid_eta, imparams['iota'], spec, alpha_zeta, imparams['h'], kb.jfunc, imparams['jargs'],
+                          optical_depth=kb.optical_depth, polflux=kb.polflux, compute_P=kb.compute_P, compute_V=kb.compute_V, intensity_only=intensity_only) for grid in grids]
+    tf = jnp.sum(jnp.array([jnp.sum(s[0]) for s in stokes]))
+    return [s/tf for s in stokes]
+
+def likelihood_data(kb, obs, data_types, debias=True, compute_minimal=True, load_recent=False):
+    """
+    The data, sigmas, uv points, design matrices and constant normalizations of each data term,
+    prepared as in KerrBam.build_likelihood for a model without error modeling parameters.
+    """
+    u = obs.data['u']
+    v = obs.data['v']
+    uvdists = np.sqrt(u**2+v**2)
+    d = {'u':u, 'v':v, 'visuv':np.vstack([u,v]).T}
+    if 'vis' in data_types or 'mvis' in data_types:
+        sigma = obs.data['sigma']
+        amp = obs.unpack('amp',debias=debias)['amp']
+        if kb.adding_syserr:
+            _, sigma = amp_add_syserr(amp, sigma, fractional=kb.f, additive = kb.e, var_a = kb.var_a, var_b=kb.var_b, var_c=kb.var_c, var_u0=kb.var_u0, u = uvdists)
+        if 'vis' in data_types:
+            d['vis'] = (obs.data['vis'], sigma, -2*np.sum(np.log((2.0*np.pi)**0.5 * sigma)))
+        if 'mvis' in data_types:
+            vis = obs.data['vis']
+            pvis = obs.data['qvis']+1j*obs.data['uvis']
+            msigma = sigma * np.sqrt(2/np.abs(vis)**2 + np.abs(pvis)**2 / np.abs(vis)**4)
+            d['mvis'] = (pvis/vis, msigma, -2*np.sum(np.log((2.0*np.pi)**0.5*msigma)))
+    for dt in ['qvis','uvis','vvis']:
+        if dt in data_types:
+            sd = obs.data[dt[0]+'sigma']
+            d[dt] = (obs.data[dt], sd, -2*np.sum(np.log((2.0*np.pi)**0.5*sd)))
+    if 'amp' in data_types:
+        sigma = obs.data['sigma']
+        d['amp'] = (obs.unpack('amp', debias=debias)['amp'], sigma, -np.sum(np.log((2.0*np.pi)**0.5 * sigma)))
+    if 'logcamp' in data_types:
+        if compute_minimal:
+            if load_recent:
+                logcamp_data = np.genfromtxt('logcamps.txt',dtype=None,names=['time','t1','t2','t3','t4','u1','u2','u3','u4','v1','v2','v3','v4','camp','sigmaca'])
+                d['logcamp_design_mat'] = np.loadtxt('logcamp_design_matrix.txt')
+                d['logcamp_uvpairs'] = np.loadtxt('logcamp_uvpairs.txt')
+            else:
+                logcamp_data, d['logcamp_design_mat'], d['logcamp_uvpairs'] = get_minimal_logcamps(obs,debias=debias)
+        else:
+            logcamp_data = obs.c_amplitudes(ctype='logcamp', debias=debias)
+        d['campuvs'] = get_logcamp_uvpairs(logcamp_data)
+        logcamp_sigma = logcamp_data['sigmaca']
+        if kb.adding_syserr:
+            n1amp, n2amp, d1amp, d2amp, n1err, n2err, d1err, d2err = get_camp_amp_sigma(obs, logcamp_data)
+            campd1, campd2, campd3, campd4 = logcamp_uvdists(logcamp_data)
+            _, logcamp_sigma = logcamp_add_syserr(n1amp, n2amp, d1amp, d2amp, n1err, n2err, d1err, d2err, campd1, campd2, campd3, campd4, fractional=kb.f, additive = kb.e, var_a = kb.var_a, var_b=kb.var_b, var_c=kb.var_c, var_u0=kb.var_u0, debias=debias)
+        d['logcamp'] = (logcamp_data['camp'], logcamp_sigma, -np.sum(np.log((2.0*np.pi)**0.5 * logcamp_sigma)))
+    if 'cphase' in data_types:
+        if compute_minimal:
+            if load_recent:
+                cphase_data = np.genfromtxt('cphases.txt',dtype=None,names=['time','t1','t2','t3','u1','u2','u3','v1','v2','v3','cphase','sigmacp'])
+                d['cphase_design_mat'] = np.loadtxt('cphase_design_matrix.txt')
+                d['cphase_uvpairs'] = np.loadtxt('cphase_uvpairs.txt')
+            else:
+                cphase_data, d['cphase_design_mat'], d['cphase_uvpairs'] = get_minimal_cphases(obs)
+        else:
+            cphase_data = obs.c_phases(ang_unit='rad')
+        d['cphaseuvs'] = get_cphase_uvpairs(cphase_data)
+        cphase_sigma = cphase_data['sigmacp']
+        if kb.adding_syserr:
+            v1, v2, v3, v1err, v2err, v3err = get_cphase_vis_sigma(obs, cphase_data)
+            cphased1, cphased2, cphased3 = cphase_uvdists(cphase_data)
+            _, cphase_sigma = cphase_add_syserr(v1, v2, v3, np.abs(v1err), np.abs(v2err), np.abs(v3err), cphased1, cphased2, cphased3, fractional=kb.f, additive = kb.e, var_a = kb.var_a, var_b=kb.var_b, var_c=kb.var_c, var_u0=kb.var_u0)
+        d['cphase'] = (cphase_data['cphase'], cphase_sigma, -np.sum(np.log(2.0*np.pi*ive(0, 1.0/(cphase_sigma)**2))))
+    #design matrices may be sparse, and enter the traced likelihood as dense arrays
+    for name in ['logcamp_design_mat', 'cphase_design_mat']:
+        if name in d and hasattr(d[name], 'toarray'):
+            d[name] = d[name].toarray()
+    return d
+
+@x64
+def build_loglike(kb, obs, data_types=['vis'], debias=True, compute_minimal=True, load_recent=False):
+    """
+    Given a model-mode KerrBam whose modelim is set, an observation and a list of data product
+    names, return the log likelihood of build_likelihood as a jax-traceable function of an array
+    of the modeled parameters.
+    """
+    if not kb.stationary or not kb.axisymmetric:
+        raise Exception("The differentiable likelihood supports stationary, axisymmetric models only.")
+    if kb.r_o != np.inf:
+        raise Exception("The differentiable likelihood supports an observer at infinity only.")
+    if kb.error_modeling:
+        raise Exception("The differentiable likelihood does not support error modeling parameters.")
+    if kb.rice_amps and 'amp' in data_types:
+        raise Exception("The differentiable likelihood does not support Rice amplitudes.")
+    if kb.adap_fac > 1 and kb.nmax > 0 and kb.optical_depth != 'thin':
+        raise Exception("With adap_fac > 1, the differentiable likelihood needs an optically thin model.")
+    unknown = [dt for dt in data_types if not dt in ['vis','amp','logcamp','cphase','qvis','uvis','vvis','mvis']]
+    if len(unknown) > 0:
+        raise Exception("Unrecognized data types "+str(unknown)+"!")
+    if kb.modelim is None:
+        raise Exception("Set this KerrBam's modelim, e.g. with make_modelim, before building a likelihood.")
+    kb.set_marginalized([])
+    intensity_only = all([dt in ['vis','amp','logcamp','cphase'] for dt in data_types])
+    polvis = not intensity_only
+    d = likelihood_data(kb, obs, data_types, debias=debias, compute_minimal=compute_minimal, load_recent=load_recent)
+    grids = make_grids(kb, kb.modelim)
+    u = d['u']
+    v = d['v']
+    visuv = d['visuv']
+
+    shared_uv = {}
+    if 'vis' in data_types and not polvis:
+        shared_uv['vis'] = visuv
+    if 'amp' in data_types:
+        shared_uv['amp'] = visuv
+    if 'logcamp' in data_types:
+        if compute_minimal:
+            shared_uv['logcamp'] = d['logcamp_uvpairs']
+        else:
+            shared_uv.update(dict(zip(['campuv1','campuv2','campuv3','campuv4'], d['campuvs'])))
+    if 'cphase' in data_types:
+        if compute_minimal:
+            shared_uv['cphase'] = d['cphase_uvpairs']
+        else:
+            shared_uv.update(dict(zip(['cphaseuv1','cphaseuv2','cphaseuv3'], d['cphaseuvs'])))
+    table = BaselineTable(shared_uv) if len(shared_uv) > 0 else None
+
+    def lookup(table_ivis, name):
+        sl = table.slices[name]
+        out = table_ivis[table.inverse[sl]]
+        return jnp.where(table.flip[sl], jnp.conj(out), out)
+
+    def loglike(params):
+        to_eval = kb.build_eval(params)
+        stokes = model_stokes(kb, grids, to_eval, intensity_only=intensity_only)
+        uvscale = to_eval['MoDuas'] if kb.mass_invariant else 1.
+        zbl = to_eval['zbl']
+        phasor = jnp.exp(-1j*2*np.pi*(u*to_eval['xuas']+v*to_eval['yuas'])*eh.RADPERUAS)
+        if table is not None:
+            table_ivis = zbl*sum([dft(s[:1], grid, table.uv, to_eval['PA'], uvscale)[0] for s, grid in zip(stokes, grids)])
+        out = 0.
+        if polvis:
+            model_ivis, model_qvis, model_uvis, model_vvis = sum([dft(s, grid, visuv, to_eval['PA'], uvscale) for s, grid in zip(stokes, grids)])
+            pfac = zbl*to_eval['polfrac']
+            cos2 = jnp.cos(2*to_eval['dEVPA'])
+            sin2 = jnp.sin(2*to_eval['dEVPA'])
+            model_ivis, model_qvis, model_uvis, model_vvis = zbl*model_ivis*phasor, pfac*(cos2*model_qvis-sin2*model_uvis)*phasor, pfac*(sin2*model_qvis+cos2*model_uvis)*phasor, pfac*model_vvis*phasor
+            models = {'vis':model_ivis, 'qvis':model_qvis, 'uvis':model_uvis, 'vvis':model_vvis, 'mvis':(model_qvis+1j*model_uvis)/model_ivis}
+        elif 'vis' in data_types:
+            models = {'vis':lookup(table_ivis, 'vis')*phasor}
+        for dt in ['vis','qvis','uvis','vvis','mvis']:
+            if dt in data_types:
+                data, sd, ln_norm = d[dt]
+                out += -0.5*jnp.sum(jnp.abs(models[dt]-data)**2/sd**2) + ln_norm
+        if 'amp' in data_types:
+            data, sd, ln_norm = d['amp']
+            out += -0.5*jnp.sum((jnp.abs(lookup(table_ivis, 'amp'))-data)**2/sd**2) + ln_norm
+        if 'logcamp' in data_types:
+            if compute_minimal:
+                model_logcamp = jnp.dot(d['logcamp_design_mat'], jnp.log(jnp.abs(lookup(table_ivis, 'logcamp'))))
+            else:
+                camps = [jnp.log(jnp.abs(lookup(table_ivis, name))) for name in ['campuv1','campuv2','campuv3','campuv4']]
+                model_logcamp = camps[0]+camps[1]-camps[2]-camps[3]
+            data, sd, ln_norm = d['logcamp']
+            out += -0.5*jnp.sum((data-model_logcamp)**2/sd**2) + ln_norm
+        if 'cphase' in data_types:
+            if compute_minimal:
+                model_cphase = jnp.dot(d['cphase_design_mat'], jnp.angle(lookup(table_ivis, 'cphase')))
+            else:
+                model_cphase = sum([jnp.angle(lookup(table_ivis, name)) for name in ['cphaseuv1','cphaseuv2','cphaseuv3']])
+            data, sd, ln_norm = d['cphase']
+            out += -jnp.sum((1-jnp.cos(data-model_cphase))/sd**2) + ln_norm
+        return out
+
+    return x64(loglike)
+
+@x64
+def build_loglike_and_grad(kb, obs, data_types=['vis'], debias=True, compute_minimal=True, load_recent=False):
+    """
+    build_loglike, compiled together with its gradient. Returns loglike_and_grad(params), which gives
+    the log likelihood as a float and its gradient in the modeled parameters as a numpy array.
+    """
+    loglike = build_loglike(kb, obs, data_types=data_types, debias=debias, compute_minimal=compute_minimal, load_recent=load_recent)
+    #trace the unwrapped loglike; x64 is set around each call of loglike_and_grad instead
+    value_and_grad = jax.jit(jax.value_and_grad(loglike.__wrapped__))
+    @x64
+    def loglike_and_grad(params):
+        ll, grad = value_and_grad(jnp.asarray(params, dtype=float))
+        return float(ll), np.asarray(grad)
+    return loglike_and_grad
+
+
+def box_transform(z, bounds):
+    """
+    Map unconstrained z to the box of bounds with a logistic function. Returns the point and the
+    log of the Jacobian determinant of the map.
+    """
+    lo, hi = bounds[:,0], bounds[:,1]
+    s = 0.5*(1+np.tanh(0.5*z))
+    logjac = np.sum(np.log(hi-lo) - np.logaddexp(0, z) - np.logaddexp(0, -z))
+    return lo + (hi-lo)*s, logjac
+
+def box_inverse(x, bounds):
+    lo, hi = bounds[:,0], bounds[:,1]
+    s = np.clip((np.asarray(x)-lo)/(hi-lo), 1e-12, 1-1e-12)
+    return np.log(s) - np.log1p(-s)
+
+def box_posterior(loglike_and_grad, bounds):
+    """
+    Log posterior and its gradient in unconstrained coordinates, for a uniform prior on the box of bounds.
+    Points where the likelihood is not finite have a log posterior of -inf.
+    """
+    def logp_and_grad(z):
+        x, logjac = box_transform(z, bounds)
+        ll, grad = loglike_and_grad(x)
+        if not np.isfinite(ll) or not np.all(np.isfinite(grad)):
+            return -np.inf, np.zeros_like(z)
+        s = 0.5*(1+np.tanh(0.5*z))
+        return ll+logjac, grad*(bounds[:,1]-bounds[:,0])*s*(1-s) + 1-2*s
+    return logp_and_grad
+
+def leapfrog(z, r, grad, step, minv, logp_and_grad):
+    r = r + 0.5*step*grad
+    z = z + step*minv*r
+    logp, grad = logp_and_grad(z)
+    r = r + 0.5*step*grad
+    return z, r, grad, logp
+
+def joint(logp, r, minv):
+    out = logp - 0.5*np.sum(minv*r**2)
+    return out if np.isfinite(out) else -np.inf
+
+def no_uturn(zminus, zplus, rminus, rplus, minv):
+    dz = zplus-zminus
+    return np.dot(dz, minv*rminus) >= 0 and np.dot(dz, minv*rplus) >= 0
+
+def acceptance(joint1, joint0):
+    """
+    Metropolis acceptance probability of a move from joint0 to joint1, zero for nan trajectories.
+    """
+    diff = joint1-joint0
+    if not np.isfinite(diff):
+        return 1. if diff > 0 else 0.
+    return np.exp(min(0., diff))
+
+def find_reasonable_step(z, logp, grad, minv, logp_and_grad, rng):
+    """
+    Heuristic initial step size of Hoffman & Gelman (2014), Algorithm 4.
+    """
+    step = 1.
+    r = rng.standard_normal(len(z))/np.sqrt(minv)
+    joint0 = joint(logp, r, minv)
+    z1, r1, grad1, logp1 = leapfrog(z, r, grad, step, minv, logp_and_grad)
+    logratio = joint(logp1, r1, minv) - joint0
+    direction = 1 if logratio > np.log(0.5) else -1
+    for i in range(100):
+        if direction*logratio <= -direction*np.log(2):
+            break
+        step = step*2.**direction
+        z1, r1, grad1, logp1 = leapfrog(z, r, grad, step, minv, logp_and_grad)
+        logratio = joint(logp1, r1, minv) - joint0
+    return step
+
+def build_tree(z, r, grad, logu, direction, depth, step, joint0, minv, logp_and_grad, rng):
+    """
+    Recursive tree doubling of the No-U-Turn Sampler (Hoffman & Gelman 2014, Algorithm 6).
+    Returns the leftmost and rightmost states, a proposal with its log posterior and gradient, the
+    number of valid states, whether to continue, and the summed acceptance statistics.
+    """
+    if depth == 0:
+        z1, r1, grad1, logp1 = leapfrog(z, r, grad, direction*step, minv, logp_and_grad)
+        joint1 = joint(logp1, r1, minv)
+        n1 = int(logu <= joint1)
+        s1 = logu < MAX_ENERGY_ERROR + joint1
+        return z1, r1, grad1, z1, r1, grad1, z1, logp1, grad1, n1, s1, acceptance(joint1, joint0), 1
+    zm, rm, gm, zp, rp, gp, z1, logp1, grad1, n1, s1, a1, na1 = build_tree(z, r, grad, logu, direction, depth-1, step, joint0, minv, logp_and_grad, rng)
+    if s1:
+        if direction == -1:
+            zm, rm, gm, _, _, _, z2, logp2, grad2, n2, s2, a2, na2 = build_tree(zm, rm, gm, logu, direction, depth-1, step, joint0, minv, logp_and_grad, rng)
+        else:
+            _, _, _, zp, rp, gp, z2, logp2, grad2, n2, s2, a2, na2 = build_tree(zp, rp, gp, logu, direction, depth-1, step, joint0, minv, logp_and_grad, rng)
+        if n1+n2 > 0 and rng.uniform() < n2/(n1+n2):
+            z1, logp1, grad1 = z2, logp2, grad2
+        a1 += a2
+        na1 += na2
+        s1 = s2 and no_uturn(zm, zp, rm, rp, minv)
+        n1 += n2
+    return zm, rm, gm, zp, rp, gp, z1, logp1, grad1, n1, s1, a1, na1
+
+def hmc_sample(logp_and_grad, z0, nsamples, nwarmup, nleapfrog=None, step_size=None, target_accept=0.8, max_depth=10, seed=None, print_progress=True):
+    """
+    Sample exp(logp) with Hamiltonian Monte Carlo from z0: the No-U-Turn Sampler by default, or
+    proposals of nleapfrog leapfrog steps. During the nwarmup warmup iterations the step size is tuned
+    by dual averaging towards target_accept, and a diagonal mass matrix is estimated from the middle
+    of the warmup, in windows as in Stan. Returns the samples and a dict of sampler statistics.
+    """
+    rng = np.random.default_rng(seed)
+    z = np.array(z0, dtype=float)
+    dim = len(z)
+    minv = np.ones(dim)
+    logp, grad = logp_and_grad(z)
+    if not np.isfinite(logp):
+        raise Exception("The log posterior is not finite at the initial point.")
+    if step_size is None:
+        step_size = find_reasonable_step(z, logp, grad, minv, logp_and_grad, rng)
+    #dual averaging constants of Hoffman & Gelman (2014)
+    gamma, t0, kappa = 0.05, 10., 0.75
+    def restart(step):
+        return {'mu':np.log(10*step), 'hbar':0., 'logstep_bar':0., 'count':0}
+    dual = restart(step_size)
+    #mass matrix windows: a fast stretch for the step size, a slow one for the variances, and a final fast stretch
+    adapt_mass = nwarmup >= 20
+    window = (int(0.15*nwarmup), nwarmup-int(0.1*nwarmup))
+    window_draws = []
+    samples = np.zeros((nsamples, dim))
+    stats = {'logp':np.zeros(nsamples), 'accept':np.zeros(nsamples), 'n_leapfrog':np.zeros(nsamples, dtype=int), 'divergent':np.zeros(nsamples, dtype=bool)}
+    for it in range(nwarmup+nsamples):
+        r0 = rng.standard_normal(dim)/np.sqrt(minv)
+        joint0 = joint(logp, r0, minv)
+        if nleapfrog is None:
+            logu = joint0 - rng.exponential()
+            zm = zp = z
+            rm = rp = r0
+            gm = gp = grad
+            depth, n, keep_going = 0, 1, True
+            while keep_going and depth < max_depth:
+                direction = rng.choice([-1, 1])
+                if direction == -1:
+                    zm, rm, gm, _, _, _, z1, logp1, grad1, n1, s1, a, na = build_tree(zm, rm, gm, logu, direction, depth, step_size, joint0, minv, logp_and_grad, rng)
+                else:
+                    _, _, _, zp, rp, gp, z1, logp1, grad1, n1, s1, a, na = build_tree(zp, rp, gp, logu, direction, depth, step_size, joint0, minv, logp_and_grad, rng)
+                if s1 and rng.uniform() < n1/n:
+                    z, logp, grad = z1, logp1, grad1
+                n += n1
+                keep_going = s1 and no_uturn(zm, zp, rm, rp, minv)
+                depth += 1
+            accept = a/na
+            divergent = not s1
+            nsteps = 2**depth-1
+        else:
+            z1, r1, grad1 = z, r0, grad
+            for i in range(nleapfrog):
+                z1, r1, grad1, logp1 = leapfrog(z1, r1, grad1, step_size, minv, logp_and_grad)
+            joint1 = joint(logp1, r1, minv)
+            accept = acceptance(joint1, joint0)
+            divergent = not joint1 >= joint0 - MAX_ENERGY_ERROR
+            if rng.uniform() < accept:
+                z, logp, grad = z1, logp1, grad1
+            nsteps = nleapfrog
+        if it < nwarmup:
+            dual['count'] += 1
+            m = dual['count']
+            dual['hbar'] = (1-1/(m+t0))*dual['hbar'] + (target_accept-accept)/(m+t0)
+            logstep = dual['mu'] - np.sqrt(m)/gamma*dual['hbar']
+            dual['logstep_bar'] = m**-kappa*logstep + (1-m**-kappa)*dual['logstep_bar']
+            step_size = np.exp(logstep)
+            if adapt_mass and window[0] <= it < window[1]:
+                window_draws.append(z)
+            if adapt_mass and it == window[1]-1:
+                nw = len(window_draws)
+                minv = (nw/(nw+5.))*np.var(window_draws, axis=0) + 1e-3*(5./(nw+5.))
+                step_size = find_reasonable_step(z, logp, grad, minv, logp_and_grad, rng)
+                dual = restart(step_size)
+            if it == nwarmup-1:
+                step_size = np.exp(dual['logstep_bar'])
+        else:
+            i = it-nwarmup
+            samples[i] = z
+            stats['logp'][i] = logp
+            stats['accept'][i] = accept
+            stats['n_leapfrog'][i] = nsteps
+            stats['divergent'][i] = divergent
+        if print_progress and (it+1) % 100 == 0:
+            print("Iteration "+str(it+1)+" of "+str(nwarmup+nsamples)+", step size "+str(step_size)+".")
+    stats['step_size'] = step_size
+    stats['inverse_mass'] = minv
+    return samples, stats
+
+
+def test_loglike_and_grad(npix=16, nmax=1, rel_step=1e-6, tol=1e-5):
+    """
+    Check the gradients of build_loglike_and_grad against central finite differences of build_loglike,
+    for a small model fit to visibility amplitudes and complex visibilities of a synthetic five-station
+    observation of a ring.
+    """
+    from bam.inference.kerrbam import KerrBam
+    from bam.inference.jfuncs import ring_jfunc
+    from ehtim.const_def import DTARR
+    #geocentric positions in m and SEFDs in Jy of ALMA, LMT, SMT, SMA and PV
+    stations = [('AA', 2225061.164, -5440057.370, -2481681.150, 90.), ('LM', -768715.632, -5988507.072, 2063354.852, 5000.),
+                ('AZ', -1828796.200, -5054406.800, 3427865.200, 11000.), ('SM', -5464555.493, -2492927.989, 2150797.176, 4500.),
+                ('PV', 5088967.748, -301681.186, 3825012.206, 1400.)]
+    tarr = np.array([(site, x, y, z, sefd, sefd, 0j, 0j, 0., 0., 0.) for site, x, y, z, sefd in stations], dtype=DTARR)
+    ra, dec = 12.513728717168174, 12.39112323919932
+    empty = eh.array.Array(tarr).obsdata(ra, dec, 230e9, 2e9, 60., 3600., 0., 24., mjd=57854)
+    fov = 60*eh.RADPERUAS
+    truth = KerrBam(fov, npix, ring_jfunc, ['peak_r','thickness'], [5., 2.], 3.8, 0.5, 0.3, 0.6, PA=1., beta=0.4, chi=-2., nmax=nmax)
+    obs = truth.make_image(ra=ra, dec=dec, rf=230e9, mjd=57854).observe_same(empty, ttype='direct', ampcal=True, phasecal=True, seed=4)
+    kb = KerrBam(fov, npix, ring_jfunc, ['peak_r','thickness'], [5., [1., 3.]], [3., 5.], [-0.9, 0.9], [0.1, 0.6], 0.6, PA=[0., 2.], beta=[0., 0.7], chi=[-np.pi, 0.], nmax=nmax)
+    kb.modelim = kb.make_modelim(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd=obs.mjd)
+    data_types = ['vis', 'amp']
+    loglike = build_loglike(kb, obs, data_types=data_types)
+    loglike_and_grad = build_loglike_and_grad(kb, obs, data_types=data_types)
+    bounds = np.array(kb.modeled_params, dtype=float)
+    point = {'MoDuas':4., 'a':0.4, 'inc':0.35, 'PA':1.2, 'beta':0.3, 'chi':-1.8, 'thickness':2.}
+    x0 = np.array([point[name] for name in kb.modeled_names])
+    ll, grad = loglike_and_grad(x0)
+    steps = rel_step*(bounds[:,1]-bounds[:,0])
+    fd = np.array([(float(loglike(x0+h*e)) - float(loglike(x0-h*e)))/(2*h) for h, e in zip(steps, np.eye(len(x0)))])
+    err = np.max(np.abs(grad-fd))/np.max(np.abs(fd))
+    print("Log likelihood "+str(ll)+" of "+str(kb.modeled_names)+" at "+str(x0))
+    print("Max error of the gradient relative to its largest finite-difference component: "+str(err))
+    if not (np.isclose(ll, float(loglike(x0))) and err <= tol):
+        raise Exception("build_loglike_and_grad does not match finite differences of build_loglike!")
@@ -0,0 +1,380 @@
+"""
+Model images of KerrBam from the primitives of kerr_exact_sep_lp.
+
+primitives_from_caches computes ray traced and emissivity primitives through a pair of caches,
+and image_from_primitives applies the envelope, optical depth, normalization and polarization
+parameters to them. Both are shared by KerrBam.compute_image, which passes its own caches, and by ImageModel, an immutable copy of the grid and
+settings of a KerrBam whose caches belong to the calling thread, so that a likelihood built on it
+can be called from several threads at once.
+"""
+
+import threading
+import numpy as np
+import ehtim as eh
+from bam.inference.kerrexact import ray_trace_all, emissivity_from_geometry
+from bam.inference.face_on import face_on_primitives, face_on_flux
+from bam.inference.model_helpers import rescale_veclists, resize_operator, LRUCache, FrozenCache
+
+
+def rescale_subimages(model, veclists):
+    """
+    Resample each list of subimages in the dict veclists to the finest grid. The lists are
+    stacked, so each subimage size costs one product with a sparse operator from model.resize_operators.
+    """
+    names = list(veclists.keys())
+    rescaled = rescale_veclists([veclists[name] for name in names], order=model.interp_order, operators=model.resize_operators)
+    return dict(zip(names, rescaled))
+
+def rescale_stokes(model, ivecs, qvecs, uvecs, vvecs, compute_P, compute_V):
+    """
+    rescale_subimages for the Stokes subimages; Q and U, or V, are left alone when not computed.
+    """
+    veclists = {'i':ivecs}
+    if compute_P:
+        veclists['q'] = qvecs
+        veclists['u'] = uvecs
+    if compute_V:
+        veclists['v'] = vvecs
+    veclists = rescale_subimages(model, veclists)
+    return veclists['i'], veclists.get('q', qvecs), veclists.get('u', uvecs), veclists.get('v', vvecs)
+
+def primitives_from_caches(model, mudists, varphi, geometry_cache, emissivity_cache, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=False):
+    """
+    The output of kerr_exact_sep_lp on the screen grid mudists, varphi of model, a KerrBam or an
+    ImageModel, reusing ray tracing cached in geometry_cache (keyed on geometry) and emissivity cached
+    in emissivity_cache (keyed on geometry and fluid parameters) when possible. Stokes vectors are
+    returned as copies, since image_from_primitives modifies them in place. With intensity_only, the
+    reduced emissivity kernel is used and q, u, v are shared zeros.
+    """
+    if model.mass_invariant:
+        MoDuas = 1.
+    if model.use_jax:
+        return model.rtfunc(mudists, MoDuas, varphi, inc, a, model.nmax, beta, chi, eta, iota, spec, alpha_zeta, adap_fac = model.adap_fac, axisymmetric=model.axisymmetric, stationary=model.stationary, compute_V = model.compute_V, r_o=model.r_o, intensity_only=intensity_only)
+    geometry_key = (MoDuas, a, inc, model.nmax, model.adap_fac, model.r_o)
+    fluid_key = (beta, chi, eta, iota, spec if alpha_zeta is None else alpha_zeta, model.compute_V, intensity_only)
+    prims = emissivity_cache.get(geometry_key+fluid_key)
+    if prims is None:
+        geometry = geometry_cache.get(geometry_key)
+        if geometry is None:
+            if model.geodesic_table is not None:
+                geometry = model.geodesic_table.ray_trace(a, inc, use_numba=model.use_numba, symmetric=model.symmetric, chunk_size=model.chunk_size, max_memory=model.max_memory, nthreads=model.nthreads)
+            else:
+                geometry = ray_trace_all(mudists, MoDuas, varphi, inc, a, model.nmax, adap_fac = model.adap_fac, axisymmetric=model.axisymmetric, stationary=model.stationary, nmin=0, r_o=model.r_o, use_numba=model.use_numba, symmetric=model.symmetric, chunk_size=model.chunk_size, max_memory=model.max_memory, nthreads=model.nthreads)
+            geometry_cache.put(geometry_key, geometry)
+        prims = emissivity_from_geometry(geometry, mudists, a, inc, model.nmax, beta, chi, eta, iota, spec, alpha_zeta, adap_fac = model.adap_fac, compute_V = model.compute_V, chunk_size=model.chunk_size, max_memory=model.max_memory, nthreads=model.nthreads, intensity_only=intensity_only)
+        emissivity_cache.put(geometry_key+fluid_key, prims)
+    rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = prims
+    ivecs = [np.copy(ivec) for ivec in ivecs]
+    if not intensity_only:
+        qvecs = [np.copy(qvec) for qvec in qvecs]
+        uvecs = [np.copy(uvec) for uvec in uvecs]
+        vvecs = [np.copy(vvec) for vvec in vvecs]
+    return list(rvecs), list(phivecs), list(tvecs), ivecs, qvecs, uvecs, vvecs, list(redshifts), list(lps)
+
+def face_on_primitives_from_cache(model, emissivity_cache, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta):
+    """
+    face_on_primitives on model.face_on_rho, cached in emissivity_cache next to the primitives of
+    primitives_from_caches.
+    """
+    if model.mass_invariant:
+        MoDuas = 1.
+    key = ('face_on', MoDuas, a, inc, model.nmax, model.r_o, beta, chi, eta, iota, spec if alpha_zeta is None else alpha_zeta)
+    prims = emissivity_cache.get(key)
+    if prims is None:
+        prims = face_on_primitives(model.face_on_rho, MoDuas, inc, a, model.nmax, beta, chi, eta, iota, spec, alpha_zeta, r_o=model.r_o, use_numba=model.use_numba, intensity_only=True)
+        emissivity_cache.put(key, prims)
+    return prims
+
+def image_from_primitives(model, prims, imparams, intensity_only=False, native=False, normalize=True):
+    """
+    Given the output of kerr_exact_sep_lp, which is modified in place, and a list of values of
+    the image parameters in imparams, compute the resulting i, q, u, v on the grid and with the
+    settings of model, a KerrBam or an ImageModel. Options are those of KerrBam.compute_image.
+    """
+    MoDuas, a, inc, zbl, xuas, yuas, PA, beta, chi, eta, iota, spec, alpha_zeta, h, polfrac, dEVPA, jargs = imparams
+
+    #without polarized flux, Q, U and V vanish and the EVPA is never needed
+    intensity_only = intensity_only or not(model.polflux)
+    compute_P = model.compute_P and not(intensity_only)
+    compute_V = model.compute_V and not(intensity_only)
+
+    rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = prims
+    if not(compute_P) or not(compute_V):
+        zvecs = [np.zeros_like(rvecs[n]) for n in range(model.nmax+1)]
+    if model.optical_depth == 'varying' or model.optical_depth == 'thick':
+        veclists = {'r':rvecs, 'redshift':redshifts, 'lp':lps, 'i':ivecs}
+        if not model.axisymmetric:
+            veclists['phi'] = phivecs
+        if not model.stationary:
+            veclists['t'] = tvecs
+        if compute_P:
+            veclists['q'] = qvecs
+            veclists['u'] = uvecs
+        if compute_V:
+            veclists['v'] = vvecs
+        veclists = rescale_subimages(model, veclists)
+        rvecs, redshifts, lps, ivecs = veclists['r'], veclists['redshift'], veclists['lp'], veclists['i']
+        phivecs = veclists.get('phi', phivecs)
+        tvecs = veclists.get('t', tvecs)
+        qvecs = veclists.get('q', qvecs)
+        uvecs = veclists.get('u', uvecs)
+        vvecs = veclists.get('v', vvecs)
+    if model.stationary:
+
+        for n in reversed(range(model.nmax+1)):
+            #the envelope vanishes wherever no photon reaches the emitter, so only evaluate it on the support
+            support = np.flatnonzero(redshifts[n])
+            if model.axisymmetric:
+                jfunc_vals = model.jfunc(rvecs[n][support], jargs)
+            else:
+                jfunc_vals = model.jfunc(rvecs[n][support],phivecs[n][support],jargs)
+
+            profile = np.zeros_like(redshifts[n])
+            profile[support] = jfunc_vals*redshifts[n][support]**(3+spec)
+
+            if model.optical_depth == 'thin':
+                profile[support] *= lps[n][support]
+            elif model.optical_depth == 'varying':
+                tau = h*lps[n]
+                exptau = np.exp(-tau)
+                profile[support] *= 1-exptau[support]
+                if n < model.nmax:
+                    ivecs[n+1] *= exptau
+                    if compute_P:
+                        qvecs[n+1] *= exptau
+                        uvecs[n+1] *= exptau
+                    if compute_V:
+                        vvecs[n+1] *= exptau
+            elif model.optical_depth == 'thick':
+                #this is the optically thick case, where h is a constant
+                pass
+            else:
+                print("Unrecognized optical depth prescription! Defaulting to optically thick.")
+
+            if model.polflux:
+                ivecs[n]*=profile
+            else:
+                ivecs[n] = profile
+                qvecs[n] = zvecs[n]
+                uvecs[n] = zvecs[n]
+                vvecs[n] = zvecs[n]
+            if compute_P:
+                qvecs[n]*=profile
+                uvecs[n]*=profile
+            if compute_V:
+                vvecs[n]*=profile
+        if model.optical_depth == 'thin' and native:
+            #a pixel of subimage n covers adap_fac**(2*(nmax-n)) pixels of the finest grid
+            weights = [model.adap_fac**(2*(model.nmax-n)) for n in range(model.nmax+1)]
+            ivecs = [ivecs[n]*weights[n] for n in range(model.nmax+1)]
+            if compute_P:
+                qvecs = [qvecs[n]*weights[n] for n in range(model.nmax+1)]
+                uvecs = [uvecs[n]*weights[n] for n in range(model.nmax+1)]
+            if compute_V:
+                vvecs = [vvecs[n]*weights[n] for n in range(model.nmax+1)]
+        elif model.optical_depth == 'thin':
+            ivecs, qvecs, uvecs, vvecs = rescale_stokes(model, ivecs, qvecs, uvecs, vvecs, compute_P, compute_V)
+        tf = np.sum([np.sum(ivec) for ivec in ivecs]) if normalize else 1.
+        ivecs = [ivec*zbl/tf for ivec in ivecs]
+        if not(compute_P) or not(compute_V):
+            zvecs = [np.zeros_like(ivec) for ivec in ivecs]
+        if not(compute_P):
+            qvecs = zvecs
+            uvecs = zvecs
+        if not(compute_V):
+            vvecs = zvecs
+        if compute_P:
+            qvecs = [qvec*zbl/tf*polfrac for qvec in qvecs]
+            uvecs = [uvec*zbl/tf*polfrac for uvec in uvecs]
+            if not np.isclose(0.,dEVPA):
+                pvecs = [(qvecs[i]+1j*uvecs[i])*np.exp(2j*dEVPA) for i in range(len(qvecs))]
+                qvecs = [np.real(pvec) for pvec in pvecs]
+                uvecs = [np.imag(pvec) for pvec in pvecs]
+        if compute_V:
+            vvecs = [vvec*zbl/tf*polfrac for vvec in vvecs]
+        return ivecs, qvecs, uvecs, vvecs
+    else:
+        out = []
+        for time in model.times:
+            for n in reversed(range(model.nmax+1)):
+                support = np.flatnonzero(redshifts[n])
+                jfunc_vals = model.jfunc(rvecs[n][support],phivecs[n][support],tvecs[n][support]+time,jargs)
+                profile = np.zeros_like(redshifts[n])
+                profile[support] = jfunc_vals*redshifts[n][support]**(3+spec)
+
+                if model.optical_depth == 'thin':
+                    profile[support] *= lps[n][support]
+                elif model.optical_depth == 'varying':
+                    tau = h*lps[n]
+                    exptau = np.exp(-tau)
+                    profile[support] *= 1-exptau[support]
+                    if n < model.nmax:
+                        ivecs[n+1] *= exptau
+                        if compute_P:
+                            qvecs[n+1] *= exptau
+                            uvecs[n+1] *= exptau
+                        if compute_V:
+                            vvecs[n+1] *= exptau
+                elif model.optical_depth == 'thick':
+                    #this is the optically thick case, where h is a constant
+                    pass
+                else:
+                    print("Unrecognized optical depth prescription! Defaulting to optically thick.")
+
+                if model.polflux:
+                    ivecs[n]*=profile
+                else:
+                    ivecs[n] = profile
+                    qvecs[n] = zvecs[n]
+                    uvecs[n] = zvecs[n]
+                    vvecs[n] = zvecs[n]
+                if compute_P:
+                    qvecs[n]*=profile
+                    uvecs[n]*=profile
+                if compute_V:
+                    vvecs[n]*=profile
+            if model.optical_depth == 'thin':
+                ivecs, qvecs, uvecs, vvecs = rescale_stokes(model, ivecs, qvecs, uvecs, vvecs, compute_P, compute_V)
+            tf = np.sum(ivecs) if normalize else 1.
+            ivecs = [ivec*zbl/tf for ivec in ivecs]
+            if not(compute_P) or not(compute_V):
+                zvecs = [np.zeros_like(ivec) for ivec in ivecs]
+            if not(compute_P):
+                qvecs = zvecs
+                uvecs = zvecs
+            if not(compute_V):
+                vvecs = zvecs
+            if compute_P:
+                qvecs = [qvec*zbl/tf*polfrac for qvec in qvecs]
+                uvecs = [uvec*zbl/tf*polfrac for uvec in uvecs]
+                if not np.isclose(0.,dEVPA):
+                    pvecs = [(qvecs[i]+1j*uvecs[i])*np.exp(2j*dEVPA) for i in range(len(qvecs))]
+                    qvecs = [np.real(pvec) for pvec in pvecs]
+                    uvecs = [np.imag(pvec) for pvec in pvecs]
+            if compute_V:
+                vvecs = [vvec*zbl/tf*polfrac for vvec in vvecs]
+            out.append([ivecs, qvecs, uvecs, vvecs])
+        return out
+
+def face_on_profile_from_primitives(model, prims, imparams):
+    """
+    Face-on counterpart of image_from_primitives: given the output of face_on_primitives and
+    imparams, return the Stokes I profile on model.face_on_rho, normalized so that the flux
+    inside the field of view is zbl.
+    """
+    MoDuas, a, inc, zbl, xuas, yuas, PA, beta, chi, eta, iota, spec, alpha_zeta, h, polfrac, dEVPA, jargs = imparams
+    rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = prims
+    ivecs = [np.copy(ivec) for ivec in ivecs]
+    for n in reversed(range(model.nmax+1)):
+        profile = model.jfunc(rvecs[n], jargs)*redshifts[n]**(3+spec)
+        if model.optical_depth == 'thin':
+            profile = profile * lps[n]
+        elif model.optical_depth == 'varying':
+            exptau = np.exp(-h*lps[n])
+            profile = profile * (1-exptau)
+            if n < model.nmax:
+                ivecs[n+1] *= exptau
+        if model.polflux:
+            ivecs[n] *= profile
+        else:
+            ivecs[n] = profile
+    iprofile = np.sum(ivecs, axis=0)
+    return iprofile*zbl/face_on_flux(model.face_on_rho*eh.RADPERUAS, model.face_on_drho*eh.RADPERUAS, iprofile*model.face_on_window[0])
+
+
+class ImageModel:
+    """
+    The screen grid and image settings of a model-mode KerrBam, copied when it is built. Ray tracing
+    and emissivity are cached with primitives_from_caches, as in KerrBam, but each thread has its own caches,
+    made on its first call, so one instance can be used from several threads at once. The operators
+    that resize subimages to the finest grid are precomputed, and only read.
+    """
+    def __init__(self, kb):
+        self.cache_size = kb.cache_size
+        self.local = threading.local()
+        self.jfunc = kb.jfunc
+        self.rtfunc = kb.rtfunc
+        self.use_jax = kb.use_jax
+        self.use_numba = kb.use_numba
+        self.symmetric = kb.symmetric
+        self.chunk_size = kb.chunk_size
+        self.max_memory = kb.max_memory
+        self.nthreads = kb.nthreads
+        self.geodesic_table = kb.geodesic_table
+        self.mass_invariant = kb.mass_invariant
+        self.mudists = kb.rho_M if kb.mass_invariant else kb.rho_uas
+        self.varphi = kb.varphivec
+        self.nmax = kb.nmax
+        self.adap_fac = kb.adap_fac
+        self.interp_order = kb.interp_order
+        self.axisymmetric = kb.axisymmetric
+        self.stationary = kb.stationary
+        self.times = kb.times
+        self.r_o = kb.r_o
+        self.optical_depth = kb.optical_depth
+        self.polflux = kb.polflux
+        self.compute_P = kb.compute_P
+        self.compute_V = kb.compute_V
+        self.face_on = kb.face_on
+        if self.face_on:
+            self.face_on_rho = kb.face_on_rho
+            self.face_on_drho = kb.face_on_drho
+            self.face_on_window = kb.face_on_window
+        operators = {}
+        if self.interp_order <= 1:
+            xdim = kb.npix*self.adap_fac**self.nmax
+            for n in range(self.nmax):
+                subxdim = kb.npix*self.adap_fac**n
+                operators[(subxdim, xdim, self.interp_order, 'edge')] = resize_operator(subxdim, xdim, order=self.interp_order, mode='edge')
+        self.resize_operators = FrozenCache(operators)
+
+    def __getstate__(self):
+        #thread-local caches stay behind; a copy starts with empty ones
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def caches(self):
+        """
+        The geometry and emissivity caches of the calling thread.
+        """
+        if not hasattr(self.local, 'geometry_cache'):
+            self.local.geometry_cache = LRUCache(self.cache_size)
+            self.local.emissivity_cache = LRUCache(self.cache_size)
+        return self.local.geometry_cache, self.local.emissivity_cache
+
+    def cache_info(self):
+        """
+        Return hit and miss counts for the geometry and emissivity caches of the calling thread.
+        """
+        geometry_cache, emissivity_cache = self.caches()
+        return {'geometry':geometry_cache.info(), 'emissivity':emissivity_cache.info()}
+
+    def primitives(self, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=False):
+        """
+        primitives_from_caches on the grid of the model, with the caches of the calling thread.
+        """
+        geometry_cache, emissivity_cache = self.caches()
+        return primitives_from_caches(self, self.mudists, self.varphi, geometry_cache, emissivity_cache, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=intensity_only)
+
+    def image(self, imparams, intensity_only=False, native=False, normalize=True):
+        """
+        KerrBam.compute_image on the grid and with the settings of the model.
+        """
+        MoDuas, a, inc, zbl, xuas, yuas, PA, beta, chi, eta, iota, spec, alpha_zeta, h, polfrac, dEVPA, jargs = imparams
+        intensity_only = intensity_only or not(self.polflux)
+        prims = self.primitives(MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=intensity_only)
+        return image_from_primitives(self, prims, imparams, intensity_only=intensity_only, native=native, normalize=normalize)
+
+    def face_on_profile(self, imparams):
+        """
+        KerrBam.compute_face_on_profile with the settings of the model.
+        """
+        MoDuas, a, inc, zbl, xuas, yuas, PA, beta, chi, eta, iota, spec, alpha_zeta, h, polfrac, dEVPA, jargs = imparams
+        geometry_cache, emissivity_cache = self.caches()
+        prims = face_on_primitives_from_cache(self, emissivity_cache, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta)
+        return face_on_profile_from_primitives(self, prims, imparams)
@@ -0,0 +1,265 @@
+"""
+Elliptic integrals and Jacobi elliptic functions in pure jax.numpy, so that they can be
+jit-compiled, vectorized and differentiated. Arguments follow scipy.special, with the
+parameter m = k**2.
+
+Carlson's symmetric integrals are evaluated with a fixed number of duplication steps and the
+Jacobi functions with a fixed number of arithmetic-geometric mean steps, so that every call
+traces the same graph whatever its arguments. The steps run in lax loops rather than Python
+loops: unrolled, the nested duplications of RJ alone come to hundreds of steps per call, and
+the graphs of the non-axisymmetric ray tracing took XLA many minutes to compile.
+
+They need 64-bit floats. Rather than switching jax to 64 bits globally at import, which would
+change the precision of any other jax code in the same process, the entry points of the jax
+backend are wrapped with x64, which enables them only for the duration of each call.
+"""
+
+from functools import wraps
+import jax
+try:
+    from jax import enable_x64
+except ImportError:
+    #older jax only provides the context manager in jax.experimental
+    from jax.experimental import enable_x64
+import jax.numpy as jnp
+
+
+#duplication steps for Carlson's integrals; each one divides the spread of the arguments by four,
+#and the truncation error of the final series scales as the sixth power of that spread
+CARLSON_STEPS = 12
+#arithmetic-geometric mean steps for ellipj, which converge quadratically
+AGM_STEPS = 10
+#arguments of square roots are kept above TINY, so that gradients stay finite at branch points
+TINY = 1e-300
+
+
+def x64(func):
+    """
+    Wrap func so that it runs with 64-bit jax floats, leaving the global precision of jax alone.
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        with enable_x64():
+            return func(*args, **kwargs)
+    return wrapped
+
+
+def safe_sqrt(x):
+    return jnp.sqrt(jnp.maximum(x, TINY))
+
+def carlson_rf(x, y, z):
+    """
+    Carlson's symmetric integral of the first kind, RF(x, y, z), for x, y, z >= 0.
+    """
+    def step(i, carry):
+        x, y, z = carry
+        sx, sy, sz = safe_sqrt(x), safe_sqrt(y), safe_sqrt(z)
+        lam = sx*sy + sy*sz + sz*sx
+        return 0.25*(x+lam), 0.25*(y+lam), 0.25*(z+lam)
+    x, y, z = jax.lax.fori_loop(0, CARLSON_STEPS, step, tuple(jnp.broadcast_arrays(x, y, z)))
+    ave = (x+y+z)/3.
+    dx = 1-x/ave
+    dy = 1-y/ave
+    dz = -(dx+dy)
+    e2 = dx*dy - dz**2
+    e3 = dx*dy*dz
+    return (1 - e2/10. + e3/14. + e2**2/24. - 3*e2*e3/44.)/jnp.sqrt(ave)
+
+def carlson_rd(x, y, z):
+    """
+    Carlson's symmetric integral of the second kind, RD(x, y, z), for x, y >= 0 and z > 0.
+    """
+    def step(i, carry):
+        x, y, z, total = carry
+        sx, sy, sz = safe_sqrt(x), safe_sqrt(y), safe_sqrt(z)
+        lam = sx*sy + sy*sz + sz*sx
+        total = total + 0.25**i/(sz*(z+lam))
+        return 0.25*(x+lam), 0.25*(y+lam), 0.25*(z+lam), total
+    x, y, z = jnp.broadcast_arrays(x, y, z)
+    x, y, z, total = jax.lax.fori_loop(0, CARLSON_STEPS, step, (x, y, z, jnp.zeros_like(x)))
+    fac = 0.25**CARLSON_STEPS
+    ave = 0.2*(x+y+3*z)
+    dx = 1-x/ave
+    dy = 1-y/ave
+    dz = -(dx+dy)/3.
+    ea = dx*dy
+    eb = dz*dz
+    ec = ea-eb
+    ed = ea-6*eb
+    ee = ed+2*ec
+    series = 1 + ed*(-3/14. + 9/88.*ed - 9/52.*dz*ee) + dz*(ee/6. + dz*(-9/22.*ec + 3/26.*dz*ea))
+    return 3*total + fac*series/(ave*jnp.sqrt(ave))
+
+def carlson_rc(x, y):
+    """
+    Carlson's degenerate integral RC(x, y) = RF(x, y, y), for x >= 0 and y > 0.
+    """
+    return carlson_rf(x, y, y)
+
+def carlson_rj(x, y, z, p):
+    """
+    Carlson's symmetric integral of the third kind, RJ(x, y, z, p), for x, y, z >= 0 and p > 0.
+    """
+    def step(i, carry):
+        x, y, z, p, total = carry
+        sx, sy, sz = safe_sqrt(x), safe_sqrt(y), safe_sqrt(z)
+        lam = sx*sy + sy*sz + sz*sx
+        alpha = (p*(sx+sy+sz) + sx*sy*sz)**2
+        beta = p*(p+lam)**2
+        total = total + 0.25**i*carlson_rc(alpha, beta)
+        return 0.25*(x+lam), 0.25*(y+lam), 0.25*(z+lam), 0.25*(p+lam), total
+    x, y, z, p = jnp.broadcast_arrays(x, y, z, p)
+    x, y, z, p, total = jax.lax.fori_loop(0, CARLSON_STEPS, step, (x, y, z, p, jnp.zeros_like(x)))
+    fac = 0.25**CARLSON_STEPS
+    ave = 0.2*(x+y+z+2*p)
+    dx = (ave-x)/ave
+    dy = (ave-y)/ave
+    dz = (ave-z)/ave
+    dp = (ave-p)/ave
+    ea = dx*(dy+dz) + dy*dz
+    eb = dx*dy*dz
+    ec = dp**2
+    ed = ea-3*ec
+    ee = eb+2*dp*(ea-ec)
+    series = 1 + ed*(-3/14. + 9/88.*ed - 9/52.*ee) + eb*(1/6. + dp*(-3/11. + dp*3/26.)) + dp*ea*(1/3. - dp*3/22.) - dp*ec/3.
+    return 3*total + fac*series/(ave*jnp.sqrt(ave))
+
+def ellipk(m):
+    """
+    Complete elliptic integral of the first kind K(m), for m < 1.
+    """
+    return carlson_rf(0., 1-m, 1.)
+
+def ellipe(m):
+    """
+    Complete elliptic integral of the second kind E(m), for m < 1.
+    """
+    return carlson_rf(0., 1-m, 1.) - m/3.*carlson_rd(0., 1-m, 1.)
+
+def ellipf_sin(s, m):
+    """
+    F(arcsin(s)|m) for -1 <= s <= 1, without the infinite derivative of arcsin at s = +-1.
+    """
+    s2 = s**2
+    return s*carlson_rf(1-s2, 1-m*s2, 1.)
+
+def ellipf_cos(c, m):
+    """
+    F(arccos(c)|m) for -1 <= c <= 1, whose amplitude runs from 0 to pi.
+    """
+    s = safe_sqrt(1-c**2)
+    base = s*carlson_rf(c**2, 1-m*s**2, 1.)
+    return jnp.where(c >= 0, base, 2*ellipk(m) - base)
+
+def reduce_amplitude(phi):
+    """
+    Write phi = phr + n*pi with |phr| <= pi/2; F and E grow by 2K and 2E with each n.
+    """
+    n = jax.lax.stop_gradient(jnp.round(phi/jnp.pi))
+    return phi - n*jnp.pi, n
+
+def ellipkinc(phi, m):
+    """
+    Incomplete elliptic integral of the first kind F(phi|m), for any real phi and m < 1.
+    """
+    phr, n = reduce_amplitude(phi)
+    s = jnp.sin(phr)
+    c = jnp.cos(phr)
+    return s*carlson_rf(c**2, 1-m*s**2, 1.) + 2*n*ellipk(m)
+
+def ellipeinc(phi, m):
+    """
+    Incomplete elliptic integral of the second kind E(phi|m), for any real phi and m < 1.
+    """
+    phr, n = reduce_amplitude(phi)
+    s = jnp.sin(phr)
+    c = jnp.cos(phr)
+    delta = 1-m*s**2
+    return s*carlson_rf(c**2, delta, 1.) - m/3.*s**3*carlson_rd(c**2, delta, 1.) + 2*n*ellipe(m)
+
+def ellippi(n, phi, m):
+    """
+    Incomplete elliptic integral of the third kind Pi(n; phi|m), for any real phi, m sin(phi)**2 < 1
+    and n sin(phi)**2 != 1, as scipy_ellip_binding.ellip_pi_arr; the Cauchy principal value is taken
+    where n sin(phi)**2 > 1.
+    """
+    def reduced(n, phr, m):
+        s = jnp.sin(phr)
+        x = jnp.cos(phr)**2
+        y = 1-m*s**2
+        rho = 1-n*s**2
+        crf = carlson_rf(x, y, 1.)
+        #DLMF 19.20.14 for rho < 0
+        q = -rho
+        pv = (x+y+q - x*y)/(1+q)
+        crj_neg = ((pv-1)*carlson_rj(x, y, 1., jnp.where(rho < 0, pv, 1.)) - 3*crf + 3*safe_sqrt(x*y/(x*y+pv*q))*carlson_rc(x*y+pv*q, jnp.where(rho < 0, pv*q, 1.)))/(q+1)
+        crj = jnp.where(rho > 0, carlson_rj(x, y, 1., jnp.where(rho > 0, rho, 1.)), crj_neg)
+        return s*crf + n/3.*s**3*crj
+    n, phi, m = jnp.broadcast_arrays(n, phi, m)
+    phr, k = reduce_amplitude(phi)
+    return reduced(n, phr, m) + 2*k*reduced(n, jnp.pi/2*jnp.ones_like(phi), m)
+
+def ellipj(u, m):
+    """
+    Jacobi elliptic functions sn, cn, dn and the amplitude ph of u, for 0 <= m < 1, from the
+    descending Landen (arithmetic-geometric mean) recursion, as in scipy.special.ellipj.
+    """
+    def ascend(carry, _):
+        a, b, c = carry
+        a, b, c = 0.5*(a+b), jnp.sqrt(a*b), 0.5*(a-b)
+        return (a, b, c), (a, c)
+    def descend(carry, ac):
+        phi, prev = carry
+        a, c = ac
+        return (0.5*(jnp.arcsin(c*jnp.sin(phi)/a) + phi), phi), None
+    u, m = jnp.broadcast_arrays(u, m)
+    (a, b, c), (avals, cvals) = jax.lax.scan(ascend, (jnp.ones_like(m), safe_sqrt(1-m), safe_sqrt(m)), None, length=AGM_STEPS)
+    phi = 2.**AGM_STEPS*a*u
+    #from the last AGM step back to the first; prev is the amplitude before the final step
+    (phi, prev), _ = jax.lax.scan(descend, (phi, phi), (avals, cvals), reverse=True)
+    sn = jnp.sin(phi)
+    cn = jnp.cos(phi)
+    dn = cn/jnp.cos(prev-phi)
+    return sn, cn, dn, phi
+
+@x64
+def test_jax_ellip(tol=1e-12):
+    """
+    Check the values and derivatives of the elliptic functions against scipy.special
+    and finite differences.
+    """
+    import numpy as np
+    from scipy import special
+    rng = np.random.default_rng(0)
+    m = np.concatenate([rng.uniform(-50, 0, 20), rng.uniform(0, 1, 20), [0.999999, 1e-8]])
+    phi = rng.uniform(-7, 7, len(m))
+    u = rng.uniform(-20, 20, len(m))
+    s = rng.uniform(-1, 1, len(m))
+    maxerr = 0.
+    pairs = [(ellipk(m), special.ellipk(m)), (ellipe(m), special.ellipe(m)), (ellipkinc(phi, m), special.ellipkinc(phi, m)),
+             (ellipeinc(phi, m), special.ellipeinc(phi, m)), (ellipf_sin(s, m), special.ellipkinc(np.arcsin(s), m)), (ellipf_cos(s, m), special.ellipkinc(np.arccos(s), m))]
+    pos = m >= 0
+    for x, y in zip(ellipj(u[pos], m[pos]), special.ellipj(u[pos], m[pos])):
+        pairs.append((x, y))
+    #Pi against ellip_pi_arr, for characteristics on both sides of 1/sin(phi)**2
+    from bam.inference.scipy_ellip_binding import ellip_pi_arr
+    mpi = np.clip(m, -50, 0.9)
+    npi = np.concatenate([rng.uniform(-5, 0.9, len(m)//2), rng.uniform(1.5, 5, len(m)-len(m)//2)])
+    far = np.abs(1-npi*np.sin(phi)**2) > 0.05
+    pairs.append((ellippi(npi[far], phi[far], mpi[far]), ellip_pi_arr(npi[far], phi[far], mpi[far])))
+    for x, y in pairs:
+        maxerr = max(maxerr, np.max(np.abs(np.asarray(x)-y)/np.maximum(1, np.abs(y))))
+    print("Max error relative to scipy: "+str(maxerr))
+    if maxerr > tol:
+        raise Exception("jax_ellip does not match scipy.special!")
+    #derivatives in the argument and parameter of sn, against central differences of scipy
+    h = 1e-6
+    up, mp = u[pos], m[pos]*0.98
+    dsn_du = jax.vmap(jax.grad(lambda x, y: ellipj(x, y)[0]))(up, mp)
+    dsn_dm = jax.vmap(jax.grad(lambda x, y: ellipj(x, y)[0], argnums=1))(up, mp)
+    fd_du = (special.ellipj(up+h, mp)[0]-special.ellipj(up-h, mp)[0])/(2*h)
+    fd_dm = (special.ellipj(up, mp+h)[0]-special.ellipj(up, mp-h)[0])/(2*h)
+    graderr = max(np.max(np.abs(dsn_du-fd_du)/np.maximum(1, np.abs(fd_du))), np.max(np.abs(dsn_dm-fd_dm)/np.maximum(1, np.abs(fd_dm))))
+    print("Max error of derivatives of sn relative to finite differences: "+str(graderr))
+    if graderr > 1e-5:
+        raise Exception("Derivatives of jax_ellip do not match finite differences!")
@@ -1,5 +1,13 @@
 """
-Implementation of the Kerr toy model for exact computation.
+Implementation of the Kerr toy model for exact computation, in jax.numpy.
+
+The functions follow kerrexact, with the elliptic functions of jax_ellip, so that the chain from
+the screen grid to model visibilities (ray tracing, the fluid emissivity model, the envelope and the
+Fourier transform) can be jit-compiled, vectorized over parameters with vmap, and differentiated.
+Every pixel is traced in every case, and pixels are told apart (by case, and by whether their rays
+reach the emitter) on values without gradients; pixels outside a branch see fixed placeholder
+inputs, so that no branch produces nan gradients. With adap_fac > 1, each subimage is traced on its
+whole native grid rather than only around the previous subimage.
 
 The phi computations are almost direct copies of Andrew Chael's kgeo.
 
@@ -8,66 +16,64 @@ Andrew is a co-author on the paper associated with this code.
 
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.special import ellipj, ellipk, ellipkinc, ellipeinc
-from scipy.interpolate import griddata
-from skimage.transform import rescale, resize
-from scipy.signal import convolve2d
-from bam.inference.model_helpers import get_rho_varphi_from_FOV_npix
-from bam.inference.scipy_ellip_binding import ellip_pi_arr
-import time
-from jax.config import config
-config.update("jax_enable_x64", True)
+import jax
 import jax.numpy as jnp
 from jax import jit, vmap
+from ehtim.observing.pulses import trianglePulse2D, deltaPulse2D
+from ehtim.const_def import RADPERUAS
+from bam.inference.jax_ellip import ellipk, ellipkinc, ellipeinc, ellipf_sin, ellipf_cos, ellipj, ellippi, x64
 
 
-minkmetric = np.diag([-1, 1, 1, 1])
-
-kernel = np.ones((3,3))
-
 phi_o = 3*np.pi/2
-r_o = np.inf
+
+#placeholder roots for pixels outside cases 1 and 2 (all real, r4 < 1 <= rp) and case 3 (r3, r4 complex)
+CASE12_ROOTS = (-4., -1., -0.5, 0.5)
+CASE3_ROOTS = (-4., -1., 0.5+1j, 0.5-1j)
+#placeholder conserved quantities and radius for pixels whose rays never reach the emitter
+PLACEHOLDER_ETA = 30.
+PLACEHOLDER_R = 10.
 
 def R1_R2(al,phi,j,ret_r2=True): #B62 and B65
     """
     Function by Andrew Chael to compute phi and t integral preliminaries.
     """
     al2 = al**2
-    s2phi = np.sqrt(1-j*np.sin(phi)**2)
-    p1 = np.sqrt((al2 -1)/(j+(1-j)*al2))
-    f1 = 0.5*p1*np.log(np.abs((p1*s2phi+np.sin(phi))/(p1*s2phi-np.sin(phi))))
+    s2phi = jnp.sqrt(1-j*jnp.sin(phi)**2)
+    p1 = jnp.sqrt((al2 -1)/(j+(1-j)*al2))
+    f1 = 0.5*p1*jnp.log(jnp.abs((p1*s2phi+jnp.sin(phi))/(p1*s2phi-jnp.sin(phi))))
     nn = al2/(al2-1)
-    R1 = (ellip_pi_arr(nn,phi,j) - al*f1)/(1-al2)
+    R1 = (ellippi(nn,phi,j) - al*f1)/(1-al2)
 
     if ret_r2:
         F = ellipkinc(phi,j)
         E = ellipeinc(phi,j)
-        R2 = (F - (al2/(j+(1-j)*al2))*(E - al*np.sin(phi)*s2phi/(1+al*np.cos(phi)))) / (al2-1)
+        R2 = (F - (al2/(j+(1-j)*al2))*(E - al*jnp.sin(phi)*s2phi/(1+al*jnp.cos(phi)))) / (al2-1)
         R2 = R2 + (2*j - nn)*R1 / (j + (1-j)*al2)
 
     else:
-        R2=np.NaN
+        R2=np.nan
 
     return (R1,R2)
 
-np.seterr(invalid='ignore')
-np.seterr(divide='ignore')
-print("KerrBAM is silencing numpy warnings about invalid inputs and division by zero (default: warn, now ignore). To undo, call np.seterr(invalid='warn').")
-
-def _get_preliminaries(alpha, beta, inc, a, rp, rm):
+def get_lam_eta(alpha, beta, inc, a):
     lam = -alpha*jnp.sin(inc)
     eta = (alpha**2-a**2)*jnp.cos(inc)**2 + beta**2
+    return lam, eta
+
+def get_up_um(lam, eta, a):
     del_theta = 1/2*(1-(eta+lam**2)/a**2)
     sqrtdt = jnp.sqrt(del_theta**2+eta/a**2)
-    up = del_theta + sqrtdt
-    um = del_theta - sqrtdt
-
-    clam= jnp.complex128(lam)
-    ceta= jnp.complex128(eta)
-    A = a**2 - ceta - clam**2
-    B = 2*(ceta+(clam-a)**2)
-    C = -a**2 * ceta
+    return del_theta + sqrtdt, del_theta - sqrtdt
+
+def get_radroots(lam, eta, a):
+    """
+    kerrexact.get_radroots, for real lam and eta.
+    """
+    lam = lam.astype(complex)
+    eta = eta.astype(complex)
+    A = a**2 - eta - lam**2
+    B = 2*(eta+(lam-a)**2)
+    C = -a**2 * eta
     P = - A**2 / 12 - C
     Q = -A/3 * ((A/6)**2 - C)-B**2/8
     H = -9*Q + jnp.sqrt(12*P**3 + 81*Q**2)
@@ -76,619 +82,573 @@ def _get_preliminaries(alpha, beta, inc, a, rp, rm):
     b4z = B/(4*z)
     termp = jnp.sqrt(-A/2 - zsq + b4z)
     termn = jnp.sqrt(-A/2 - zsq - b4z)
-    r1 = -z - termp
-    r2 = -z + termp
-    r3 = z - termn
-    r4 = z + termn
-
-    rr1 = jnp.real(r1)
-    rr2 = jnp.real(r2)
-    rr3 = jnp.real(r3)
-    rr4 = jnp.real(r4)
-    ir1 = jnp.imag(r1)
-    ir2 = jnp.imag(r2)
-    ir3 = jnp.imag(r3)
-    ir4 = jnp.imag(r4)
-    ir1_0 = jnp.isclose(ir1,0)
-    ir2_0 = jnp.isclose(ir2,0)
-    ir3_0 = jnp.isclose(ir3,0)
-    ir4_0 = jnp.isclose(ir4,0)
-    c12 = jnp.isclose(ir1,-ir2)
-    c34 = jnp.isclose(ir3,-ir4)
-
-    allreal = ir1_0 * ir2_0 * ir3_0 * ir4_0
-
-    case1 = allreal * (rr2<rp)*(rr3>rp)
-    case2 = allreal * (rr4<rp)
-    case3 = ir1_0 * ir2_0 * ~ir3_0 * ~ir3_0 * c34 * (rr2<rp)
-    # case4 = ~ir1_0 * ~ir2_0 * ~ir3_0 * ~ir4_0 * c12 * c34
-
-    return lam, eta, up, um, r1, r2, r3, r4, rr1, rr2, rr3, rr4, ir1, ir2, ir3, ir4, case1, case2, case3
-
-vmap_get_preliminaries = vmap(_get_preliminaries,[0,0,None,None, None, None])
-get_preliminaries = jit(vmap_get_preliminaries)
+    return -z - termp, -z + termp, z - termn, z + termn
 
 def Delta(r, a):
     return r**2 - 2*r + a**2
 
 def Xi(r, a, theta):
-    return (r**2+a**2)**2 - Delta(r, a)* a**2 * np.sin(theta)**2
+    return (r**2+a**2)**2 - Delta(r, a)* a**2 * jnp.sin(theta)**2
 
 def omega(r, a, theta):
     return 2*a*r/Xi(r, a, theta)
 
 def Sigma(r, a, theta):
-    return r**2 + a**2 * np.cos(theta)**2
+    return r**2 + a**2 * jnp.cos(theta)**2
 
 def R(r, a, lam, eta):
     return (r**2 + a**2 - a*lam)**2 - Delta(r,a) * (eta + (a-lam)**2)
 
-def getlorentzboost(boost, chi):
-    gamma = 1 / np.sqrt(1 - boost**2) 
-    coschi = np.cos(chi)
-    sinchi = np.sin(chi)
-    lorentzboost = np.array([[gamma, -gamma*boost*coschi, -gamma*boost*sinchi, 0],[-gamma*boost*coschi, (gamma-1)*coschi**2+1, (gamma-1)*sinchi*coschi, 0],[-gamma*boost*sinchi, (gamma-1)*sinchi*coschi, (gamma-1)*sinchi**2+1, 0],[0,0,0,1]])
-    return lorentzboost
-
-#these should return r, phi, tau, tau_tot
-
-
-def ray_trace_by_case(a, rm, rp, sb, lam, eta, r1, r2, r3, r4, up, um, inc, nmax, case, adap_fac= 1,axisymmetric = True, nmin=0):
+def classify(r1, r2, r3, r4, rp):
     """
-    Case 1: r1, r2, r3, r4 are real, r2<rp<r3.
-    Case 2: r1, r2, r3, r4 are real and less than rp.
-    Case 3: r1, r2 real, r3, r4 complex and conjugate.
-    Case 4: All complex, r1,r2 conjugate and r3,r4 conjugate.
+    Masks of the pixels in cases 1, 2 and 3 of kerrexact.ray_trace_all, from roots without gradients.
     """
-    if len(sb) == 0:
-        # print("No support in case "+str(case))
-        return [[] for n in range(nmin, nmax+1)], [[] for n in range(nmin, nmax+1)], [[] for n in range(nmin, nmax+1)], [[] for n in range(nmin, nmax+1)]
-    r21 = r2-r1
-    r31 = r3-r1
-    r32 = r3-r2
-    r42 = r4-r2
-    r41 = r4-r1
-    r43 = r4-r3
+    r1, r2, r3, r4 = [jax.lax.stop_gradient(x) for x in [r1, r2, r3, r4]]
+    ir1_0, ir2_0, ir3_0, ir4_0 = [jnp.isclose(jnp.imag(x), 0) for x in [r1, r2, r3, r4]]
+    c34 = jnp.isclose(jnp.imag(r3), -jnp.imag(r4))
+    allreal = ir1_0 & ir2_0 & ir3_0 & ir4_0
+    case1 = allreal & (jnp.real(r2) < rp) & (jnp.real(r3) > rp)
+    case2 = allreal & (jnp.real(r4) < rp)
+    case3 = ir1_0 & ir2_0 & ~ir3_0 & c34 & (jnp.real(r2) < rp)
+    return case1, case2, case3
+
+def get_Phi_tau(snarg, urat):
+    """
+    Function by Andrew Chael to get the Jacobi amplitude Phi(tau) of the polar motion.
+    """
+    mk = urat/(urat-1)
+    Phi_tau = 0.5*jnp.pi-ellipj(ellipk(mk) - snarg/jnp.sqrt(1-mk), mk)[3]
+    return jnp.where(jnp.abs(snarg)<1e-12, snarg, Phi_tau)
 
-    k = (r32*r41 / (r31*r42))
+def ray_trace_grid(alpha, beta, a, inc, nmin, nmax, axisymmetric=True, stationary=True, r_o=np.inf):
+    """
+    kerrexact.ray_trace_all at screen coordinates alpha, beta (in M), for subimages nmin..nmax.
+    Returns r, phi, t, signpr and signptheta, each of shape (nmax+1-nmin, npix), the mask of pixels
+    whose rays reach the equator before the horizon, and lam and eta. r, phi and t are zero off the
+    mask; phi is only computed without axisymmetric, and t only without stationary.
+    nmin, nmax, axisymmetric, stationary and r_o are static under jit.
+    """
+    a = jnp.where(jnp.abs(a) <= 1e-8, 1e-6, a)
+    nn = nmax+1-nmin
+    rp = 1+jnp.sqrt(1-a**2)
+    rm = 1-jnp.sqrt(1-a**2)
+    lam, eta = get_lam_eta(alpha, beta, inc, a)
+    case1, case2, case3 = classify(*get_radroots(lam, eta, a), jax.lax.stop_gradient(rp))
+    #rays with eta <= 0 never cross the equator
+    case1, case2, case3 = [x & jax.lax.stop_gradient(eta > 0) for x in [case1, case2, case3]]
+    traced = case1 | case2 | case3
+    case12 = case1 | case2
+    #conserved quantities of untraced pixels are replaced, then the roots recomputed
+    lam_t = jnp.where(traced, lam, 0.)
+    eta_t = jnp.where(traced, eta, PLACEHOLDER_ETA)
+    r1, r2, r3, r4 = get_radroots(lam_t, eta_t, a)
+    up, um = get_up_um(lam_t, eta_t, a)
+    full = not(axisymmetric) or not(stationary)
+
+    sb = jnp.sign(beta)
+    m = jnp.where(sb > 0, 0., sb) + nmin + jnp.arange(1, nn+1)[:,None]
     urat = up/um
-    Kurat = ellipk(urat)
-    # print(nmin)
-    #option 1
-    m = sb.copy()
-    m[m>0] = 0
-    m+= nmin
-    rvecs = []
-    phivecs = []
-    Irmasks = []
-    signprs = []
-    Fobs_arg = np.arcsin(np.cos(inc)/np.sqrt(up))
-    Fobs = ellipkinc(Fobs_arg, urat)
-
-    if not axisymmetric:
+    #clipped, since rounding can push the argument just past 1 when up ~ 1 (nearly face-on)
+    Fobs_sin = jnp.clip(jnp.cos(inc)/jnp.sqrt(up), -1, 1)
+    Fobs = ellipf_sin(Fobs_sin, urat)
+    Ir = (2*m*ellipk(urat) - sb*Fobs)/jnp.sqrt(-um*a**2)
+    if full:
         a2um = a**2*um
-        Gph_o = -1/np.sqrt(-a2um) * ellip_pi_arr(up, Fobs_arg, urat)
-        # print(np.any(Gph_o<0))
-        Gth_o = -1/np.sqrt(-a2um) * Fobs
-
-
-
-    # sb = np.sign(beta)
-    if case == 1:
-        r3142sqrt = np.sqrt(r31*r42)
-        if r_o == np.inf:
-            x2ro = np.sqrt(r31/r41)
-        else:
-            x2ro = np.sqrt(r31*(r_o-r4)/(r41*(r_o-r3)))
-        I2ro = 2/r3142sqrt * ellipkinc(np.arcsin(x2ro),k)
-        Ir_turn = I2ro
-        Ir_total = 2*Ir_turn
-
-        # fobs = ellipkinc(np.arcsin(np.sqrt(r31/r41)), k)
-        # #note: only outside the critical curve, since nothing inside has a turning point
-        # Ir_turn = np.real(2/np.sqrt(r31*r42)*fobs)
-        # Ir_total = 2*Ir_turn
-    if case == 2:
-        r3142sqrt = np.sqrt(r31*r42)
-        if r_o == np.inf:
-            x2ro = np.sqrt(r31/r41)
-        else:
-            x2ro = np.sqrt(r31*(r_o-r4)/(r41*(r_o-r3)))
-        x2rp = np.sqrt((r31*(rp-r4))/(r41*(rp-r3)))
-        I2rp = 2/r3142sqrt*ellipkinc(np.arcsin(x2rp),k)
-        I2ro = 2/r3142sqrt*ellipkinc(np.arcsin(x2ro),k)#this is the previous fobs
-        Ir_total = I2ro-I2rp      
-
-    if case == 1 or case == 2:
-
-        for n in range(nmin, nmax+1):
-            m+= 1
-            # print('m',m)
-            Ir = 1/np.sqrt(-um*a**2)*(2*m*Kurat - sb*Fobs)
-            if case == 1:
-                signpr = np.sign(Ir_turn-Ir)
-            else:
-                signpr = np.ones_like(Ir)
-            Irmask = Ir<Ir_total
-
-            X2 = 1/2*r3142sqrt *(-Ir + I2ro)
-            snnum, cnnum, dnnum, amnum = ellipj(X2,k)
-
-            snsqr = snnum**2
-            r =(r4*r31 - r3*r41*snsqr)/(r31-r41*snsqr)
-            r[~Irmask] = np.nan
-            rvec = np.nan_to_num(r)
-            rvecs.append(rvec)
-            signprs.append(signpr)
-            Irmasks.append(Irmask)
-            if not axisymmetric:      
-                tau = Ir
-                auxarg = np.arcsin(x2ro)
-
-                rp3 = rp - r3
-                rm3 = rm - r3
-                rp4 = rp - r4
-                rm4 = rm - r4
-
-                dX2dtau = -0.5*r3142sqrt
-                dsn2dtau = 2*snnum*cnnum*dnnum*dX2dtau
-                drsdtau = -r31*r43*r41*dsn2dtau / ((r31-r41*snsqr)**2)
-                Rpot_o = (r_o-r1)*(r_o-r2)*(r_o-r3)*(r_o-r4)
-                drsdtau_o = np.sqrt(Rpot_o)
-                H = drsdtau / (r - r3) - drsdtau_o/(r_o-r3)
-                E = np.sqrt(r31*r42)*(ellipkinc(amnum,k) - ellipeinc(auxarg, k))
-                Pi_1 = (2./np.sqrt(r31*r42))*(ellip_pi_arr(r41/r31,amnum,k)-ellip_pi_arr(r41/r31,auxarg,k))
-                Pi_p = (2./np.sqrt(r31*r42))*(r43/(rp3*rp4))*(ellip_pi_arr((rp3*r41)/(rp4*r31),amnum,k)-
-                                                                 ellip_pi_arr((rp3*r41)/(rp4*r31),auxarg,k))
-                Pi_m = (2./np.sqrt(r31*r42))*(r43/(rm3*rm4))*(ellip_pi_arr((rm3*r41)/(rm4*r31),amnum,k)-
-                                                                 ellip_pi_arr((rm3*r41)/(rm4*r31),auxarg,k))
-
-
-                # final integrals
-                I1 = r3*(-Ir) + r43*Pi_1 # B48
-                I2 = H - 0.5*(r1*r4 + r2*r3)*(-tau) - E # B49
-                Ip = Ir/rp3 - Pi_p # B50
-                Im = Ir/rm3 - Pi_m # B50
-                I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
-
-
-                #finish Gph calculation
-                snarg = np.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
-
-                snarg = snarg.astype(float)
-                sinPhi_tau = np.zeros_like(snarg)
-                Phi_tau = np.zeros_like(snarg)
-                jmask = np.abs(snarg)<1e-12
-                if np.any(jmask):
-                    sinPhi_tau[jmask] = snarg[jmask]
-                    Phi_tau[jmask] = snarg[jmask]
-                if np.any(~jmask):
-                    mk = (urat/(urat-1))[~jmask] # real, in (0,1) since k<0
-                    # mk = np.outer(np.ones(1),mk)[~jmask]
-                    ellipfuns = ellipj(snarg[~jmask]/np.sqrt(1-mk), mk)
-                    #sn(sqrt(1-m)x | k) = sqrt(1-m)*sn(x|m)/dn(x|m)
-                    sinPhi_tau[~jmask] = np.sqrt(1-mk) * ellipfuns[0]/ellipfuns[2]
-                    #am(sqrt(1-m)x | k) = pi/2 - am(K(m) - x | m for m <=1
-                    Phi_tau[~jmask] = 0.5*np.pi-ellipj(ellipk(mk) - snarg[~jmask]/np.sqrt(1-mk), mk)[3]
-
-                Gph = (1/np.sqrt(-a2um)*ellip_pi_arr(up, Phi_tau, urat)-sb*Gph_o)#.astype(float)
-                # print(Gph)
-                # print('Gph_o',Gph_o)
-
-                phi = phi_o + I_phi + lam * Gph
-                phi[~Irmask] = np.nan
-                phivecs.append(np.nan_to_num(phi))
-
-    if case == 3:
-        Agl = np.real(np.sqrt(r32*r42))
-        Bgl = np.real(np.sqrt(r31*r41))
-        # Agl = np.sqrt(np.imag(r4)**2 + (np.real(r4)-r2)**2)
-        # Bgl = np.sqrt(np.imag(r4)**2 + (np.real(r4)-r1)**2)
-        k3 = ((Agl+Bgl)**2 - (r2-r1)**2)/(4*Agl*Bgl)
-        rp1 = rp-r1
-        rp2 = rp-r2
-        x3rp = (Agl*rp1 - Bgl*rp2)/(Agl*rp1 + Bgl*rp2) # GL19a, B55
-        if r_o == np.inf:
-            x3ro = (Agl-Bgl)/(Agl+Bgl)
-        else:
-            ro1 = r_o - r1
-            ro2 = r_o - r2
-            Aro1 = Agl*ro1
-            Bro2 = Bgl*ro2
-            x3ro = (Aro1-Bro2)/(Aro1+Bro2)
-
-        if not axisymmetric:
-            alp = -1/x3rp
-            rm1 = rm - r1
-            rm2 = rm - r2
-            x3rm = (Agl*rm1 - Bgl*rm2)/(Agl*rm1 + Bgl*rm2) # GL19a, B55
-            alm = -1/x3rm
-            al0 = -1/x3ro
-        pref = 1/np.sqrt(Agl*Bgl)
-        auxarg = np.arccos(x3ro)
-        Ir_o = pref*ellipkinc(auxarg, k3)
-        Ir_p = pref*ellipkinc(np.arccos(x3rp),k3)
-        Ir_total = Ir_o - Ir_p
-        # al0 = (Agl+Bgl)/(Bgl-Agl)
-        # I3r_angle = np.arccos(1/al0)
-        # I3r = ellipkinc(I3r_angle, k3) / np.sqrt(Agl*Bgl)
-        # I3rp_angle = np.arccos((Agl*(rp-r1)-Bgl*(rp-r2))/(Agl*(rp-r1)+Bgl*(rp-r2)))
-        # I3rp = ellipkinc(I3rp_angle, k3) / np.sqrt(Agl*Bgl)    
-        
-
-        # Ir_total = I3r - I3rp
-        signpr = np.ones_like(Agl)
-        for n in range(nmin, nmax+1):
-            m += 1
-            Ir = 1/np.sqrt(-um*a**2)*(2*m*Kurat - sb*Fobs)
-            Irmask = Ir<Ir_total
-
-            X3 = np.sqrt(Agl*Bgl)*(-Ir + Ir_o)
-
-            snnum, cnnum, dnnum, amnum = ellipj(X3, k3)
-            signptheta = (-1)**m * sb
-            ffac = 1 / 2 * np.real(r31 * r42)**(1/2)
-
-            r = ((Bgl*r2 - Agl*r1) + (Bgl*r2+Agl*r1)*cnnum) / ((Bgl-Agl)+(Bgl+Agl)*cnnum)
-            r[~Irmask] = np.nan
-            rvec = np.nan_to_num(r)
-            # rvecs.append(np.nan_to_num(r))
-            rvecs.append(rvec)
-            signprs.append(signpr)
-            Irmasks.append(Irmask)
-
-            if not axisymmetric:
-                # pass
-                #TODO figure out conversion to Andrew's definitions
-                tau = Ir
-                #need:
-                # al0
-                amX3 = amnum
-                # auxarg
-
-                # # building blocks of the path integrals
-                R1_a_0, R2_a_0 = R1_R2(al0,amX3,k3)
-                R1_b_0, R2_b_0 = R1_R2(al0,auxarg,k3)
-                R1_a_p, _ = R1_R2(alp,amX3,k3,ret_r2=False)
-                R1_b_p, _ = R1_R2(alp,auxarg,k3,ret_r2=False)
-                # if a>MINSPIN:
-                R1_a_m, _ = R1_R2(alm,amX3,k3,ret_r2=False)
-                R1_b_m, _ = R1_R2(alm,auxarg,k3,ret_r2=False)
-                # else:
-                #     R1_a_m = np.zeros(R1_a_p.shape)
-                #     R1_b_m = np.zeros(R1_a_p.shape)
-
-                Pi_1 = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl**2-Agl**2)) * (R1_a_0 - R1_b_0) # B81
-                Pi_2 = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl**2-Agl**2))**2 * (R2_a_0 - R2_b_0) # B81
-                Pi_p = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl*rp2 - Agl*rp1))*(R1_a_p - R1_b_p) # B82
-                Pi_m = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl*rm2 - Agl*rm1))*(R1_a_m - R1_b_m) # B82
-
-
-                # final integrals
-                pref = ((Bgl*r2 + Agl*r1)/(Bgl+Agl))
-                I1 = pref*(-tau) + Pi_1 # B78
-                I2 = pref**2*(-tau) + 2*pref*Pi_1 + np.sqrt(Agl*Bgl)*Pi_2 # B79
-                Ip = -((Bgl+Agl)*(-tau) + Pi_p) / (Bgl*rp2 + Agl*rp1) # B80
-                Im = -((Bgl+Agl)*(-tau) + Pi_m) / (Bgl*rm2 + Agl*rm1) # B80
-                I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
-
-                #finish Gph calculation
-                snarg = np.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
-                sinPhi_tau = np.zeros_like(snarg)
-                Phi_tau = np.zeros_like(snarg)
-                jmask = np.abs(snarg)<1e-12
-                if np.any(jmask):
-                    sinPhi_tau[jmask] = snarg[jmask]
-                    Phi_tau[jmask] = snarg[jmask]
-                if np.any(~jmask):
-                    mk = (urat/(urat-1))[~jmask] # real, in (0,1) since k<0
-                    # mk = np.outer(np.ones(snarg.shape[0]),mk)[~jmask]
-                    ellipfuns = ellipj(snarg[~jmask]/np.sqrt(1-mk), mk)
-                    #sn(sqrt(1-m)x | k) = sqrt(1-m)*sn(x|m)/dn(x|m)
-                    sinPhi_tau[~jmask] = np.sqrt(1-mk) * ellipfuns[0]/ellipfuns[2]
-                    #am(sqrt(1-m)x | k) = pi/2 - am(K(m) - x | m for m <=1
-                    Phi_tau[~jmask] = 0.5*np.pi-ellipj(ellipk(mk) - snarg[~jmask]/np.sqrt(1-mk), mk)[3]
-
-                Gph = (1/np.sqrt(-a2um)*ellip_pi_arr(up, Phi_tau, urat)-sb*Gph_o)
-
-
-
-                phi = phi_o + I_phi + lam * Gph
-                phi[~Irmask] = np.nan
-                phivecs.append(np.nan_to_num(phi))
-    if case ==4:
-        pass
-    return rvecs, phivecs, Irmasks, signprs
-
-def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmetric=True, nmin=0):
-    
-    rp = 1+np.sqrt(1-a**2)
-    rm = 1-np.sqrt(1-a**2)
-
-    if np.isclose(a,0):
-        a = 1e-6
-    ns = range(nmin, nmax+1)
-    if adap_fac == 1:
-        rho = jnp.array(mudists/MoDuas)
+        Fobs_arg = jnp.arcsin(Fobs_sin)
+        Gph_o = -1/jnp.sqrt(-a2um) * ellippi(up, Fobs_arg, urat)
+        Gth_o = -1/jnp.sqrt(-a2um) * Fobs
+        Gt_o = 2*up/jnp.sqrt(-um*a**2)* (ellipeinc(Fobs_arg, urat) - Fobs)/(2*urat) # GL 19a, 31
+
+    #cases 1 and 2: four real roots
+    q1, q2, q3, q4 = [jnp.where(case12, jnp.real(x), y) for x, y in zip([r1, r2, r3, r4], CASE12_ROOTS)]
+    r31 = q3-q1
+    r32 = q3-q2
+    r42 = q4-q2
+    r41 = q4-q1
+    r43 = q4-q3
+    k = r32*r41/(r31*r42)
+    r3142sqrt = jnp.sqrt(r31*r42)
+    if r_o == np.inf:
+        x2ro = jnp.sqrt(r31/r41)
     else:
-        rho = jnp.array(mudists[0]/MoDuas)
-    zeros = jnp.zeros_like(rho)
-    npix = len(zeros)
-    xdim = int(np.sqrt(npix))
-    if adap_fac == 1:
-        alpha = rho*jnp.cos(varphi)
-        beta = rho*jnp.sin(varphi)
+        x2ro = jnp.sqrt(r31*(r_o-q4)/(r41*(r_o-q3)))
+    I2ro = 2/r3142sqrt*ellipf_sin(x2ro, k)
+    x2rp_sq = jnp.where(case2, r31*(rp-q4)/(r41*(rp-q3)), 0.25)
+    I2rp = 2/r3142sqrt*ellipf_sin(jnp.sqrt(x2rp_sq), k)
+    Ir_total12 = jnp.where(case1, 2*I2ro, I2ro-I2rp)
+    signpr = jnp.where(case1, jnp.sign(I2ro-jax.lax.stop_gradient(Ir)), 1.)
+    #rays that end before the equator are sent to the turning point instead, where r stays finite
+    reached12 = jax.lax.stop_gradient(Ir < Ir_total12)
+    snnum, cnnum, dnnum, amnum = ellipj(0.5*r3142sqrt*(-jnp.where(reached12, Ir, I2ro) + I2ro), k)
+    sn2 = snnum**2
+    rvec12 = (q4*r31 - q3*r41*sn2)/(r31-r41*sn2)
+    if full:
+        tau = Ir
+        auxarg = jnp.arcsin(x2ro)
+        rp3 = rp - q3
+        rm3 = rm - q3
+        rp4 = rp - q4
+        rm4 = rm - q4
+        dX2dtau = -0.5*r3142sqrt
+        dsn2dtau = 2*snnum*cnnum*dnnum*dX2dtau
+        drsdtau = -r31*r43*r41*dsn2dtau / ((r31-r41*sn2)**2)
+        Rpot_o = (r_o-q1)*(r_o-q2)*(r_o-q3)*(r_o-q4)
+        drsdtau_o = signpr*jnp.sqrt(Rpot_o)
+        H = drsdtau / (rvec12 - q3) - drsdtau_o/(r_o-q3)
+        E = r3142sqrt*(ellipkinc(amnum,k) - signpr*ellipeinc(auxarg, k))
+        Pi_1 = (2./r3142sqrt)*(ellippi(r41/r31,amnum,k)-signpr*ellippi(r41/r31,auxarg,k))
+        Pi_p = (2./r3142sqrt)*(r43/(rp3*rp4))*(ellippi((rp3*r41)/(rp4*r31),amnum,k)-
+                                                signpr*ellippi((rp3*r41)/(rp4*r31),auxarg,k))
+        Pi_m = (2./r3142sqrt)*(r43/(rm3*rm4))*(ellippi((rm3*r41)/(rm4*r31),amnum,k)-
+                                                signpr*ellippi((rm3*r41)/(rm4*r31),auxarg,k))
+        I1_12 = q3*(-tau) + r43*Pi_1 # B48
+        I2_12 = H - 0.5*(q1*q4 + q2*q3)*(-tau) - E # B49
+        Ip_12 = Ir/rp3 - Pi_p # B50
+        Im_12 = Ir/rm3 - Pi_m # B50
+
+    #case 3: two real and two complex conjugate roots
+    q1 = jnp.where(case3, jnp.real(r1), CASE3_ROOTS[0])
+    q2 = jnp.where(case3, jnp.real(r2), CASE3_ROOTS[1])
+    c3 = jnp.where(case3, r3, CASE3_ROOTS[2])
+    c4 = jnp.where(case3, r4, CASE3_ROOTS[3])
+    r21 = q2-q1
+    Agl = jnp.real(jnp.sqrt((c3-q2)*(c4-q2)))
+    Bgl = jnp.real(jnp.sqrt((c3-q1)*(c4-q1)))
+    k3 = ((Agl+Bgl)**2 - r21**2)/(4*Agl*Bgl)
+    rp1 = rp-q1
+    rp2 = rp-q2
+    x3rp = (Agl*rp1 - Bgl*rp2)/(Agl*rp1 + Bgl*rp2) # GL19a, B55
+    if r_o == np.inf:
+        x3ro = (Agl-Bgl)/(Agl+Bgl)
     else:
-        alpha = rho*jnp.cos(varphi[0])
-        beta = rho*jnp.sin(varphi[0])        
-
-    #back to numpy    
-    outputs = get_preliminaries(alpha, beta, inc, a, rp, rm)
-    lam, eta, up, um, r1, r2, r3, r4, rr1, rr2, rr3, rr4, ir1, ir2, ir3, ir4, case1, case2, case3 = [np.asarray(output) for output in outputs]
-    all_signpthetas = [np.ones_like(rho) for n in range(nmin,nmax+1)]
-    sb = np.sign(beta)
-
-    m = sb.copy()
-    m[m>0] = 0
-    m += nmin 
-    for ni in range(len(ns)):
-        m+=1
-        all_signpthetas[ni] = (-1)**m*sb
-
-    #for now, don't raytrace case 4
-    rvecs1, phivecs1, Irmasks1, signprs1 = ray_trace_by_case(a,rm,rp,sb[case1],lam[case1],eta[case1],rr1[case1],rr2[case1],rr3[case1],rr4[case1],up[case1],um[case1],inc,nmax,1,adap_fac=adap_fac,axisymmetric=axisymmetric,nmin=nmin)
-    rvecs2, phivecs2, Irmasks2, signprs2 = ray_trace_by_case(a,rm,rp,sb[case2],lam[case2],eta[case2],rr1[case2],rr2[case2],rr3[case2],rr4[case2],up[case2],um[case2],inc,nmax,2,adap_fac=adap_fac,axisymmetric=axisymmetric,nmin=nmin)
-    rvecs3, phivecs3, Irmasks3, signprs3 = ray_trace_by_case(a,rm,rp,sb[case3],lam[case3],eta[case3],rr1[case3],rr2[case3],r3[case3],r4[case3],up[case3],um[case3],inc,nmax,3,adap_fac=adap_fac,axisymmetric=axisymmetric,nmin=nmin)
-    # rvecs4, phivecs4, Irmasks4, signprs4 = ray_trace_by_case(a,rm,rp,sb[case4],lam[case4],eta[case4],r1[case4],r2[case4],r3[case4],r4[case4],up[case4],um[case4],inc,nmax,4,adap_fac=adap_fac,axisymmetric=axisymmetric,nmin=nmin)
-    
-
-    #stitch together cases
-    all_rvecs = []
-    all_phivecs = []
-    all_Irmasks = []
-    all_signprs = []
-    for ni in range(len(ns)):#nmin, nmax+1):
-        # n = ns[ni]
-        r_all = np.zeros_like(rho)
-        phi_all = np.zeros_like(rho)
-        Irmask_all = np.ones_like(rho)
-        signpr_all = np.ones_like(rho)
-        r_all[case1]=rvecs1[ni]
-        r_all[case2]=rvecs2[ni]
-        r_all[case3]=rvecs3[ni]
-        # r_all[case4]=rvecs4[ni]
-        all_rvecs.append(r_all)
+        x3ro = (Agl*(r_o-q1) - Bgl*(r_o-q2))/(Agl*(r_o-q1) + Bgl*(r_o-q2))
+    rtAB = jnp.sqrt(Agl*Bgl)
+    Ir_o = ellipf_cos(x3ro, k3)/rtAB
+    Ir_total3 = Ir_o - ellipf_cos(x3rp, k3)/rtAB
+    reached3 = jax.lax.stop_gradient(Ir < Ir_total3)
+    snnum, cnnum, dnnum, amnum = ellipj(rtAB*(-jnp.where(reached3, Ir, Ir_o) + Ir_o), k3)
+    rvec3 = ((Bgl*q2 - Agl*q1) + (Bgl*q2 + Agl*q1)*cnnum) / ((Bgl-Agl)+(Bgl+Agl)*cnnum)
+    if full:
+        tau = Ir
+        rm1 = rm - q1
+        rm2 = rm - q2
+        alp = -1/x3rp
+        x3rm = (Agl*rm1 - Bgl*rm2)/(Agl*rm1 + Bgl*rm2) # GL19a, B55
+        alm = -1/x3rm
+        al0 = (Agl+Bgl)/(Bgl-Agl)
+        auxarg = jnp.arccos(x3ro)
+        R1_a_0, R2_a_0 = R1_R2(al0,amnum,k3)
+        R1_b_0, R2_b_0 = R1_R2(al0,auxarg,k3)
+        R1_a_p, _ = R1_R2(alp,amnum,k3,ret_r2=False)
+        R1_b_p, _ = R1_R2(alp,auxarg,k3,ret_r2=False)
+        R1_a_m, _ = R1_R2(alm,amnum,k3,ret_r2=False)
+        R1_b_m, _ = R1_R2(alm,auxarg,k3,ret_r2=False)
+        #signpr is one throughout case 3
+        Pi_1 = ((2*r21*rtAB)/(Bgl**2-Agl**2)) * (R1_a_0 - R1_b_0) # B81
+        Pi_2 = ((2*r21*rtAB)/(Bgl**2-Agl**2))**2 * (R2_a_0 - R2_b_0) # B81
+        Pi_p = ((2*r21*rtAB)/(Bgl*rp2 - Agl*rp1))*(R1_a_p - R1_b_p) # B82
+        Pi_m = ((2*r21*rtAB)/(Bgl*rm2 - Agl*rm1))*(R1_a_m - R1_b_m) # B82
+        pref = ((Bgl*q2 + Agl*q1)/(Bgl+Agl))
+        I1_3 = pref*(-tau) + Pi_1 # B78
+        I2_3 = pref**2*(-tau) + 2*pref*Pi_1 + rtAB*Pi_2 # B79
+        Ip_3 = -((Bgl+Agl)*(-tau) + Pi_p) / (Bgl*rp2 + Agl*rp1) # B80
+        Im_3 = -((Bgl+Agl)*(-tau) + Pi_m) / (Bgl*rm2 + Agl*rm1) # B80
+
+    rvec = jnp.where(case12, rvec12, rvec3)
+    Ir_total = jax.lax.stop_gradient(jnp.where(case12, Ir_total12, Ir_total3))
+    Irmask = traced & (jax.lax.stop_gradient(Ir) < Ir_total)
+    mask = Irmask & jnp.isfinite(jax.lax.stop_gradient(rvec))
+    rvec = jnp.where(mask, rvec, 0.)
+    signptheta = jnp.where(m % 2 == 0, 1., -1.)*sb
+    phivec = jnp.zeros_like(rvec)
+    tvec = jnp.zeros_like(rvec)
+    if full:
+        Ip = jnp.where(case12, Ip_12, Ip_3)
+        Im = jnp.where(case12, Im_12, Im_3)
+        I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam_t)*Ip - (rm - 0.5*a*lam_t)*Im) # B1
+        snarg = jnp.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
+        Phi_tau = get_Phi_tau(snarg, urat)
         if not axisymmetric:
-            phi_all[case1]=phivecs1[ni]
-            phi_all[case2]=phivecs2[ni]
-            phi_all[case3]=phivecs3[ni]
-        # phi_all[case4]=phivecs4[ni]
-        all_phivecs.append(phi_all)
-        Irmask_all[case1]=Irmasks1[ni]
-        Irmask_all[case2]=Irmasks2[ni]
-        Irmask_all[case3]=Irmasks3[ni]
-        # Irmask_all[case4]=Irmasks4[ni]
-        all_Irmasks.append(Irmask_all)
-        signpr_all[case1]=signprs1[ni]
-        signpr_all[case2]=signprs2[ni]
-        signpr_all[case3]=signprs3[ni]
-        # signpr_all[case4]=signprs4[ni]
-        all_signprs.append(signpr_all)
-
-    alphas = [alpha for n in ns]
-    betas = [beta for n in ns]
-    lams = [lam for n in ns]
-    etas = [eta for n in ns]
-
-    adap_masks = [0]
-    #do adaptive raytracing; for each except the lowest n subimage,
-    #ray trace higher ns at higher resolution around the Irmask.
-    if adap_fac > 1 and nmax>nmin:
-        for ni in range(1,len(ns)):
-            n = ns[ni]
-
-            Irmask = all_Irmasks[ni]
-            Irmask = Irmask.reshape((xdim,xdim))
-            Irmask = convolve2d(Irmask, kernel,mode='same')
-            Irmask = rescale(Irmask, adap_fac, order=0)
-            Irmask = np.array(Irmask,dtype=bool).flatten()
-
-            adap_masks.append(Irmask)
-
-            submudists = mudists[ni:]
-            subvarphi = varphi[ni:]
-            # submudists, subvarphi = get_rho_varphi_from_FOV_npix(fov_uas, adap_fac*xdim)
-            submudists[0] = submudists[0][Irmask]
-            subvarphi[0] = subvarphi[0][Irmask]
-            # subrho = rescale(rho.reshape((xdim,xdim)),adap_fac,order=1).flatten()[Irmask]
-            # subvarphi = varphi_grid_from_npix(adap_fac*xdim)[Irmask]
-            # subvarphi = rescale(varphi.reshape((xdim,xdim)),adap_fac,order=1).flatten()[Irmask]
-            sub_rvecs, sub_phivecs, sub_signprs, sub_signpthetas, sub_alphas, sub_betas, sub_lams, sub_etas, _ = ray_trace_all(submudists, MoDuas, subvarphi, inc, a, n, axisymmetric=axisymmetric, nmin=n, adap_fac=adap_fac)
-            all_rvecs[ni]=sub_rvecs[0].flatten()
-            all_phivecs[ni]=sub_phivecs[0].flatten()
-            all_signprs[ni]=sub_signprs[0].flatten()
-            all_signpthetas[ni]=sub_signpthetas[0].flatten()
-            lams[ni] = sub_lams[0].flatten()
-            etas[ni] = sub_etas[0].flatten()
-            alphas[ni] = sub_alphas[0].flatten()
-            betas[ni] = sub_betas[0].flatten()
-    
-    return all_rvecs, all_phivecs, all_signprs, all_signpthetas, alphas, betas, lams, etas, adap_masks
-
-#want to disentangle ray-tracing quantities (mudists, fov_uas, MoDuas, varphi, inc, a, nmax, adap_fac, axisymmetric)
-#from fluid properties (boost, chi, fluid_eta, iota)
-
-
-def sub_in_adap(size, mask, vals):
-    out = np.zeros(size)
-    out[mask]=vals
-    return out
-
-def emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=False):
-    """
-    Given the r and phi coordinates impacted by photons, evaluate the all-space (that is, pre-envelope) emissivity model for
-    Q, U, and V there.
+            Gph = (1/jnp.sqrt(-a2um)*ellippi(up, Phi_tau, urat)-sb*Gph_o)
+            phi = phi_o + I_phi + lam_t * Gph
+            phivec = jnp.nan_to_num(jnp.where(Irmask, phi, 0.))
+        if not stationary:
+            I0 = -tau
+            I_tA = (4/(rp-rm))*((rp**2 - 0.5*a*lam_t*rp)*Ip - (rm**2 - 0.5*a*lam_t*rm)*Im) # B2
+            It = I_tA + 4*I0 + 2*jnp.where(case12, I1_12, I1_3) + jnp.where(case12, I2_12, I2_3)
+            Gt = -(2*up/jnp.sqrt(-um*a**2)* (ellipeinc(Phi_tau,urat) - ellipkinc(Phi_tau,urat))/(2*urat)) - sb * Gt_o
+            t = It+a**2*Gt
+            t = t+(r_o + 2*np.log(r_o))
+            tvec = jnp.nan_to_num(jnp.where(Irmask, t, 0.), nan=0)
+    return rvec, phivec, tvec, signpr, signptheta, mask, lam, eta
+
+trace_jit = jit(ray_trace_grid, static_argnames=('nmin', 'nmax', 'axisymmetric', 'stationary', 'r_o'))
+
+def screen_grids(mudists, MoDuas, varphi, nmax, adap_fac=1, nmin=0):
+    """
+    The screen grids of kerrexact.ray_trace_all, as a list of (ns, rho, varphi): one grid for all
+    subimages nmin..nmax, or with adap_fac > 1 one native grid per subimage.
     """
+    if type(mudists) is not list:
+        mudists = [mudists for n in range(nmax+1)]
+        varphi = [varphi for n in range(nmax+1)]
+    if adap_fac == 1:
+        return [(list(range(nmin, nmax+1)), mudists[0]/MoDuas, varphi[0])]
+    return [([n], mudists[n]/MoDuas, varphi[n]) for n in range(nmin, nmax+1)]
 
+@x64
+def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmetric=True, stationary=True, nmin=0, r_o=np.inf):
+    """
+    kerrexact.ray_trace_all with jit-compiled ray tracing. Returns rvecs, phivecs, tvecs, signprs,
+    signpthetas, alphas, betas, lams, etas and the masks of pixels whose rays reach the emitter,
+    as lists over subimages; with adap_fac > 1, subimage n covers the whole grid mudists[n].
+    """
+    outs = [[] for i in range(10)]
+    for ns, rho, phis in screen_grids(mudists, MoDuas, varphi, nmax, adap_fac=adap_fac, nmin=nmin):
+        alpha = jnp.asarray(rho*np.cos(phis))
+        beta = jnp.asarray(rho*np.sin(phis))
+        rvec, phivec, tvec, signpr, signptheta, mask, lam, eta = trace_jit(alpha, beta, a, inc, ns[0], ns[-1], axisymmetric=axisymmetric, stationary=stationary, r_o=float(r_o))
+        for i in range(len(ns)):
+            for out, val in zip(outs, [rvec[i], phivec[i], tvec[i], signpr[i], signptheta[i], alpha, beta, lam, eta, mask[i]]):
+                out.append(val)
+    return tuple(outs)
+
+def emissivity(r, signpr, signptheta, alpha, beta, lam, eta, a, inc, boost, chi, fluid_eta, iota, alpha_zeta, compute_V=False, intensity_only=False):
+    """
+    kerrexact.emissivity_block, taking the fluid parameters themselves.
+    Returns ivec, qvec, uvec, vvec, redshift and lp, with nan wherever numpy gives nan.
+    """
+    bz = jnp.cos(iota)
+    beq = jnp.sqrt(1-bz**2)
+    br = beq*jnp.cos(fluid_eta)
+    bphi = beq*jnp.sin(fluid_eta)
+    #kerrexact.getlorentzboost(-boost, chi)
+    gamma = 1/jnp.sqrt(1-boost**2)
+    gammaboostr = -gamma*boost*jnp.cos(chi)
+    gammaboostphi = -gamma*boost*jnp.sin(chi)
+    brr = (gamma-1)*jnp.cos(chi)**2+1
+    brphi = (gamma-1)*jnp.sin(chi)*jnp.cos(chi)
+    bphiphi = (gamma-1)*jnp.sin(chi)**2+1
+
+    rteta = jnp.sqrt(eta)
+    rpowneg2 = 1/r**2
+    rasqsum = r**2+a**2
+    bigDelta = rasqsum-2*r
+    ralamnum = rasqsum - a*lam
+    ralamnumdDelta = ralamnum/bigDelta
+    bigXi = rasqsum**2 - bigDelta * a**2
+    littleomega = 2*a*r/bigXi
+    rtbigR = jnp.sqrt(ralamnum**2 - bigDelta*(eta+(a-lam)**2))
+    rtXiDelta = jnp.sqrt(bigXi/bigDelta)/r
+    rtDeltaor = jnp.sqrt(bigDelta)/r
+    rortXi = r/jnp.sqrt(bigXi)
+
+    pr_low = signpr * rtbigR/bigDelta
+    ptheta_low = signptheta*rteta
+
+    zt = rtXiDelta*(littleomega*lam - 1)
+    zr = rtDeltaor*pr_low
+    zphi = rortXi*lam
+    ztheta = -ptheta_low/r
+
+    pfluidt = -(gamma*zt - gammaboostr*zr - gammaboostphi*zphi)
+    pfluidr = -gammaboostr*zt + brr*zr + brphi*zphi
+    pfluidphi = -gammaboostphi*zt + brphi*zr + bphiphi*zphi
+    pfluidtheta = ztheta
+    redshift = 1 / pfluidt
+    lp = jnp.abs(pfluidt/pfluidtheta)
+
+    fr = (pfluidphi*bz - pfluidtheta*bphi)*redshift
+    fphi = (pfluidtheta*br - pfluidr*bz)*redshift
+    ftheta = (pfluidr*bphi - pfluidphi*br)*redshift
+    sinzeta = jnp.sqrt(fr**2+fphi**2+ftheta**2)
+    #equal to sqrt(qvec**2 + uvec**2), as in emissivity_block
+    ivec = sinzeta**(alpha_zeta+1)
+    zeros = jnp.zeros_like(ivec)
+    if intensity_only:
+        return ivec, zeros, zeros, zeros, redshift, lp
+
+    if compute_V:
+        vvec = pfluidr*br + pfluidphi*bphi + pfluidtheta*bz
+    else:
+        vvec = zeros
+
+    gt = -gammaboostr*fr - gammaboostphi*fphi
+    gr = brr*fr + brphi*fphi
+    gphi = brphi*fr + bphiphi*fphi
+    kft = rtXiDelta*gt
+    kfr = rtDeltaor*gr
+    kftheta = -ftheta/r
+    kfphi = littleomega*rtXiDelta*gt + rortXi*gphi
+
+    pt = rpowneg2 * (-a*(a-lam) + rasqsum * ralamnumdDelta)
+    pr = signpr * rpowneg2 * rtbigR
+    pphi = rpowneg2 * (-(a-lam)+a*ralamnumdDelta)
+    ptheta = signptheta*rteta *rpowneg2
+    prekappa1 = (pt * kfr - pr * kft) + a * (pr * kfphi - pphi * kfr)
+    prekappa2 = rasqsum * (pphi * kftheta - ptheta * kfphi) - a * (pt * kftheta - ptheta * kft)
+    kappa1 = r * prekappa1
+    kappa2 = -r * prekappa2
+
+    nu = -(alpha + a * jnp.sin(inc))
+    norm = jnp.sqrt((nu**2 + beta**2) * (kappa1**2+kappa2**2))/sinzeta**((alpha_zeta+1)/2)
+    ealpha = (beta * kappa2 - nu * kappa1) / norm
+    ebeta = (beta * kappa1 + nu * kappa2) / norm
+    qvec = -(ealpha**2 - ebeta**2)
+    uvec = -2*ealpha*ebeta
+    return ivec, qvec, uvec, vvec, redshift, lp
+
+def masked_emissivity(mask, r, signpr, signptheta, alpha, beta, lam, eta, a, inc, boost, chi, fluid_eta, iota, alpha_zeta, compute_V=False, intensity_only=False):
+    """
+    emissivity on the pixels of mask where every output is finite, and zeros elsewhere. The valid
+    pixels are found from a pass without gradients, and the others are evaluated at placeholder inputs.
+    Returns the valid pixels and the six outputs of emissivity.
+    """
+    fluid = [a, inc, boost, chi, fluid_eta, iota, alpha_zeta]
+    nograd = [jax.lax.stop_gradient(x) for x in [r, signpr, signptheta, alpha, beta, lam, eta]+fluid]
+    valid = mask
+    for out in emissivity(*nograd, compute_V=compute_V, intensity_only=intensity_only):
+        valid = valid & jnp.isfinite(out)
+    r = jnp.where(valid, r, PLACEHOLDER_R)
+    lam = jnp.where(valid, lam, 0.)
+    eta = jnp.where(valid, eta, PLACEHOLDER_ETA)
+    alpha = jnp.where(valid, alpha, 1.)
+    beta = jnp.where(valid, beta, 1.)
+    outs = emissivity(r, signpr, signptheta, alpha, beta, lam, eta, *fluid, compute_V=compute_V, intensity_only=intensity_only)
+    return valid, [jnp.where(valid, out, 0.) for out in outs]
+
+emissivity_jit = jit(masked_emissivity, static_argnames=('compute_V', 'intensity_only'))
+
+@x64
+def emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=False, intensity_only=False):
+    """
+    kerrexact.emissivity_model_sep_lp with a jit-compiled emissivity. Outputs vanish on pixels that
+    never reach the emitter, and also where numpy would give nan.
+    """
     if fluid_eta is None:
         fluid_eta = chi+np.pi
     if alpha_zeta is None:
         alpha_zeta = spec
-    bz = np.cos(iota)
-    beq = np.sqrt(1-bz**2)
-    br = beq*np.cos(fluid_eta)
-    bphi = beq*np.sin(fluid_eta)
-    
-    bvec = np.array([br, bphi, bz])
-    ivecs = []
-    qvecs = []
-    uvecs = []
-    vvecs = []
-    redshifts = []
-    lps = []
+    outs = [[] for i in range(6)]
     for n in range(len(rvecs)):
+        mask = jnp.isfinite(rvecs[n]) & (rvecs[n] != 0)
+        valid, vals = emissivity_jit(mask, rvecs[n], signprs[n], signpthetas[n], alphas[n], betas[n], lams[n], etas[n], a, inc, boost, chi, fluid_eta, iota, alpha_zeta, compute_V=compute_V, intensity_only=intensity_only)
+        for out, val in zip(outs, vals):
+            out.append(val)
+    return tuple(outs)
+
+@x64
+def kerr_exact_sep_lp(mudists, MoDuas, varphi, inc, a, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, adap_fac = 1, compute_V=False, axisymmetric=True, stationary=True, r_o=np.inf, intensity_only=False):
+    """
+    kerrexact.kerr_exact_sep_lp on the jax backend. Returns rvecs, phivecs, tvecs, ivecs, qvecs,
+    uvecs, vvecs, redshifts and lps as lists of writable numpy arrays over subimages.
+    """
+    rvecs, phivecs, tvecs, signprs, signpthetas, alphas, betas, lams, etas, masks = ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac=adap_fac, axisymmetric=axisymmetric, stationary=stationary, nmin=0, r_o=r_o)
+    ivecs, qvecs, uvecs, vvecs, redshifts, lps = emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=compute_V, intensity_only=intensity_only)
+    return tuple([[np.array(vec) for vec in vecs] for vecs in [rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps]])
+
+def make_grid(rho, varphi, fov, ns, weight=1, pulse=trianglePulse2D):
+    """
+    A square screen grid for subimages ns, with rho and varphi as from get_rho_varphi_from_FOV_npix,
+    the field of view fov (in radians) and the pixel pulse of its ehtim image. weight multiplies
+    every pixel.
+    """
+    xdim = int(np.sqrt(len(rho)))
+    psize = fov/xdim
+    offsets = np.arange(0, -xdim, -1)*psize + (psize*xdim)/2.0 - psize/2.0
+    return {'ns':list(ns), 'rho':np.asarray(rho), 'cosvarphi':np.cos(varphi), 'sinvarphi':np.sin(varphi),
+            'weight':weight, 'xlist':offsets, 'ylist':offsets, 'psize':psize, 'pulse':pulse}
 
-        r = rvecs[n]
-        phi = phivecs[n]
-        signpr = signprs[n]
-        signptheta = signpthetas[n]
-        alpha = alphas[n]
-        beta = betas[n]
-        lam = lams[n]
-        eta = etas[n]        
-        npix = len(r)
-        zeros = np.zeros_like(r)
-        #I realize how bad this looks, but computing everything here without using
-        #helper functions helps minimize the number of array operations
-        
-        rteta = np.sqrt(eta)
-        rpowneg2 = 1/r**2
-        rasqsum = r**2+a**2
-        bigDelta = rasqsum-2*r
-        ralamnum = rasqsum - a*lam
-        ralamnumdDelta = ralamnum/bigDelta
-        bigXi = rasqsum**2 - bigDelta * a**2 #note Xi is being evaluated at theta = pi/2
-        littleomega = 2*a*r/bigXi
-        rtbigR = np.sqrt(ralamnum**2 - bigDelta*(eta+(a-lam)**2))
-        rtXiDelta = np.sqrt(bigXi/bigDelta)/r
-        
-        #lowered
-        pt_low = -1*np.ones_like(r)
-        pr_low = signpr * rtbigR/bigDelta
-
-        # pr_low[pr_low>10] = 10
-        # pr_low[pr_low<-10] = -10
-        pphi_low = lam
-        ptheta_low = signptheta*rteta
-
-        prep = np.array([pt_low,pr_low,ptheta_low,pphi_low])
-        plowers = np.expand_dims(np.transpose(prep),2)
-        # plowers = np.array(np.hsplit(np.array([pt_low, pr_low, ptheta_low, pphi_low]),npix))
-
-        #raised
-        pt = rpowneg2 * (-a*(a-lam) + rasqsum * ralamnumdDelta)
-        pr = signpr * rpowneg2 * rtbigR
-        pphi = rpowneg2 * (-(a-lam)+a*ralamnumdDelta)
-        ptheta = signptheta*rteta *rpowneg2
-
-        # praised.append([pt_up, pr_up, pphi_up, ptheta_up])
-        #now everything to generate polarization
-        
-        emutetrad = np.array([[rtXiDelta, zeros, zeros, littleomega*rtXiDelta], [zeros, np.sqrt(bigDelta)/r, zeros, zeros], [zeros, zeros, zeros, r/np.sqrt(bigXi)], [zeros, zeros, -1/r, zeros]])
-        emutetrad = np.transpose(emutetrad,(2,0,1))
-        boostmatrix = getlorentzboost(-boost, chi)
-        #fluid frame tetrad
-        coordtransform = np.matmul(np.matmul(minkmetric, boostmatrix), emutetrad)
-        coordtransforminv = np.transpose(np.matmul(boostmatrix, emutetrad), (0,2, 1))
-        rs = r
-        pupperfluid = np.matmul(coordtransform, plowers)
-        redshift = 1 / (pupperfluid[:,0,0])
-        lp = np.abs(pupperfluid[:,0,0]/pupperfluid[:,3,0])
-        lp = np.real(np.nan_to_num(lp))
-        lps.append(lp)
-
-        #fluid frame polarization
-        pspatialfluid = pupperfluid[:,1:]
-        # print(pspatialfluid)
-        # print(pspatialfluid.shape)
-        # pspatialnorm = np.sqrt(np.sum(pspatialfluid[:,:,0]**2,axis=1))
-        fupperfluid = np.cross(pspatialfluid, bvec, axisa = 1)
-        # fupcopy = fupperfluid.copy()
-        fupperfluid[:,0,0] = fupperfluid[:,0,0] *redshift#/ pspatialnorm#would normally be a bmag here
-        fupperfluid[:,0,1] = fupperfluid[:,0,1] *redshift#/ pspatialnorm
-        fupperfluid[:,0,2] = fupperfluid[:,0,2] *redshift#/ pspatialnorm
-        sinzeta = np.sqrt(np.sum(fupperfluid[:,0,:]**2,axis=1))
-        # print(fupperfluid.shape)
-        # fupperfluid = fupperfluid / pspatialnorm
-        # print(pupperfluid[:,0,0]-pspatialnorm)
-        fupperfluid = np.insert(fupperfluid, 0, 0, axis=2)# / (np.linalg.norm(pupperfluid[1:]))
-        fupperfluid = np.swapaxes(fupperfluid, 1,2)
-
-        if compute_V:
-            vvec = np.dot(np.swapaxes(pspatialfluid,1,2), bvec).T[0]/pspatialnorm
+def grid_stokes(grid, MoDuas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, h, jfunc, jargs, optical_depth='thin', polflux=True, compute_P=True, compute_V=False, intensity_only=False, axisymmetric=True, stationary=True, r_o=np.inf, time=0.):
+    """
+    Ray tracing, emissivity and envelope on grid: the Stokes I, Q, U and V images, of shape (4, npix),
+    summed over the subimages of the grid and multiplied by its weight, before normalization,
+    polfrac and dEVPA, as in KerrBam.compute_image. fluid_eta and alpha_zeta must be given.
+    """
+    compute_P = compute_P and not(intensity_only)
+    compute_V = compute_V and not(intensity_only)
+    rho = grid['rho']/MoDuas
+    alpha = rho*grid['cosvarphi']
+    beta = rho*grid['sinvarphi']
+    ns = grid['ns']
+    rvec, phivec, tvec, signpr, signptheta, mask, lam, eta = ray_trace_grid(alpha, beta, a, inc, ns[0], ns[-1], axisymmetric=axisymmetric, stationary=stationary, r_o=r_o)
+    support, (ivecs, qvecs, uvecs, vvecs, redshifts, lps) = masked_emissivity(mask, rvec, signpr, signptheta, alpha, beta, lam, eta, a, inc, boost, chi, fluid_eta, iota, alpha_zeta, compute_V=compute_V, intensity_only=intensity_only)
+    ivecs, qvecs, uvecs, vvecs = list(ivecs), list(qvecs), list(uvecs), list(vvecs)
+    for i in reversed(range(len(ns))):
+        r = jnp.where(support[i], rvec[i], PLACEHOLDER_R)
+        redshift = jnp.where(support[i], redshifts[i], 1.)
+        if axisymmetric and stationary:
+            jfunc_vals = jfunc(r, jargs)
+        elif stationary:
+            jfunc_vals = jfunc(r, phivec[i], jargs)
+        else:
+            jfunc_vals = jfunc(r, phivec[i], tvec[i]+time, jargs)
+        profile = jnp.where(support[i], jfunc_vals*redshift**(3+spec), 0.)
+        if optical_depth == 'thin':
+            profile = profile*lps[i]
+        elif optical_depth == 'varying':
+            exptau = jnp.exp(-h*lps[i])
+            profile = profile*(1-exptau)
+            if i < len(ns)-1:
+                ivecs[i+1] = ivecs[i+1]*exptau
+                qvecs[i+1] = qvecs[i+1]*exptau
+                uvecs[i+1] = uvecs[i+1]*exptau
+                vvecs[i+1] = vvecs[i+1]*exptau
+        elif optical_depth != 'thick':
+            raise Exception("Unrecognized optical depth prescription "+str(optical_depth)+"!")
+        if polflux:
+            ivecs[i] = ivecs[i]*profile
         else:
-            vvec = zeros
-        #apply the tetrad to get kerr f
-        kfuppers = np.matmul(coordtransforminv, fupperfluid)
-
-
-        kft = kfuppers[:,0,0]
-        kfr = kfuppers[:,1,0]
-        kftheta = kfuppers[:,2,0]
-        kfphi = kfuppers[:, 3,0]
-        spin = a
-        #kappa1 and kappa2
-        prekappa1 = (pt * kfr - pr * kft) + spin * (pr * kfphi - pphi * kfr)
-        prekappa2 = rasqsum * (pphi * kftheta - ptheta * kfphi) - spin * (pt * kftheta - ptheta * kft)
-        kappa1 = rs * prekappa1
-        kappa2 = -rs * prekappa2
-        # kappa1 = np.clip(np.real(kappa1), -20, 20)
-        
-        #screen appearance
-        nu = -(alpha + spin * np.sin(inc))
-
-        norm = (nu**2 + beta**2) * np.sqrt(kappa1**2+kappa2**2)/sinzeta**((alpha_zeta+1)/2)
-        ealpha = (beta * kappa2 - nu * kappa1) / norm  
-        ebeta = (beta * kappa1 + nu * kappa2) / norm 
-
-        qvec = -(ealpha**2 - ebeta**2)
-        uvec = -2*ealpha*ebeta
-        
-        # qvec *= lp
-        # uvec *= lp
-        qvec = np.real(np.nan_to_num(qvec))
-        uvec = np.real(np.nan_to_num(uvec))
-        if compute_V:
-            vvec = np.real(np.nan_to_num(vvec))
-        redshift = np.real(np.nan_to_num(redshift))
-        ivec = np.sqrt(qvec**2+uvec**2)
-        ivecs.append(ivec)
-        qvecs.append(qvec)
-        uvecs.append(uvec)
-        vvecs.append(vvec)
-        redshifts.append(redshift)
-
-    
-    return ivecs, qvecs, uvecs, vvecs, redshifts, lps
-
-
-
-
-def kerr_exact_sep_lp(mudists, MoDuas, varphi, inc, a, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, adap_fac = 1, compute_V=False, axisymmetric=True):
-    """
-    Numerical: get rs from rho, varphi, inc, a, and subimage index n.
-    """
-    rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, adap_masks = ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = adap_fac, axisymmetric=axisymmetric, nmin=0)
-    ivecs, qvecs, uvecs, vvecs, redshifts, lps = emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=compute_V)
-    if adap_fac > 1 and nmax > 0:
-        for n in range(1,nmax+1):
-            newsize = (adap_fac**nmax)**2*len(mudists[0])
-            rvecs[n] = sub_in_adap(newsize, adap_masks[n], rvecs[n])
-            phivecs[n] = sub_in_adap(newsize, adap_masks[n], phivecs[n])
-            ivecs[n] = sub_in_adap(newsize, adap_masks[n], ivecs[n])
-            qvecs[n] = sub_in_adap(newsize, adap_masks[n], qvecs[n])
-            uvecs[n] = sub_in_adap(newsize, adap_masks[n], uvecs[n])
-            vvecs[n] = sub_in_adap(newsize, adap_masks[n], vvecs[n])
-            redshifts[n] = sub_in_adap(newsize, adap_masks[n], redshifts[n])
-            lps[n] = sub_in_adap(newsize, adap_masks[n], lps[n])
-    return rvecs, phivecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps
+            ivecs[i] = profile
+        qvecs[i] = qvecs[i]*profile
+        uvecs[i] = uvecs[i]*profile
+        vvecs[i] = vvecs[i]*profile
+    vecs = [jnp.sum(jnp.array(vecs), axis=0)*grid['weight'] for vecs in [ivecs, qvecs, uvecs, vvecs]]
+    if not compute_P or not polflux:
+        vecs[1] = vecs[2] = jnp.zeros_like(vecs[0])
+    if not compute_V or not polflux:
+        vecs[3] = jnp.zeros_like(vecs[0])
+    return jnp.array(vecs)
+
+def pulse_factor(pulse, psize, u, v):
+    """
+    The pixel pulse of ehtim at uv points; triangle and delta pulses are supported.
+    """
+    if pulse is trianglePulse2D:
+        return jnp.sinc(psize*u)**2*jnp.sinc(psize*v)**2
+    if pulse is deltaPulse2D:
+        return jnp.ones_like(u)
+    raise Exception("The jax backend supports triangle and delta pixel pulses only.")
+
+def dft(images, grid, uv, pa, uvscale=1.):
+    """
+    Direct Fourier transform of the stacked images, of shape (nimages, npix), on grid at the uv points,
+    with the conventions of fourier.DFTEngine. The phases are built on the fly, so pa and uvscale
+    may be traced.
+    """
+    u = uvscale*(jnp.cos(pa)*uv[:,0] - jnp.sin(pa)*uv[:,1])
+    v = uvscale*(jnp.sin(pa)*uv[:,0] + jnp.cos(pa)*uv[:,1])
+    xphase = jnp.exp(2j*jnp.pi*jnp.outer(u, grid['xlist']))*pulse_factor(grid['pulse'], grid['psize'], u, v)[:,None]
+    yphase = jnp.exp(2j*jnp.pi*jnp.outer(v, grid['ylist']))
+    images = images.reshape((len(images), len(grid['ylist']), len(grid['xlist'])))
+    return jnp.einsum('ky,jyx,kx->jk', yphase, images, xphase)
+
+@x64
+def kerr_exact_vis(grids, uv, imparams, jfunc, optical_depth='thin', polflux=True, compute_P=True, compute_V=False, axisymmetric=True, stationary=True, r_o=np.inf, mass_invariant=False, time=0.):
+    """
+    Model visibilities of Stokes I, Q, U and V at the uv points, of shape (4, nuv), from the dict
+    imparams of KerrBam image parameters, summed over grids; the image is normalized to total
+    flux zbl, rotated by PA and shifted by xuas, yuas, as in KerrBam. With mass_invariant, grids are
+    in units of M and imparams['MoDuas'] scales the uv points instead.
+    """
+    spec = imparams['spec']
+    fluid_eta = imparams['eta']
+    if fluid_eta is None:
+        fluid_eta = imparams['chi']+np.pi
+    alpha_zeta = imparams['alpha_zeta']
+    if alpha_zeta is None:
+        alpha_zeta = spec
+    MoDuas = 1. if mass_invariant else imparams['MoDuas']
+    uvscale = imparams['MoDuas'] if mass_invariant else 1.
+    vis = 0.
+    tf = 0.
+    for grid in grids:
+        stokes = grid_stokes(grid, MoDuas, imparams['a'], imparams['inc'], imparams['beta'], imparams['chi'], fluid_eta, imparams['iota'], spec, alpha_zeta, imparams['h'], jfunc, imparams['jargs'],
+                             optical_depth=optical_depth, polflux=polflux, compute_P=compute_P, compute_V=compute_V, axisymmetric=axisymmetric, stationary=stationary, r_o=r_o, time=time)
+        vis = vis + dft(stokes, grid, uv, imparams['PA'], uvscale)
+        tf = tf + jnp.sum(stokes[0])
+    ivis, qvis, uvis, vvis = imparams['zbl']*vis/tf
+    cos2 = jnp.cos(2*imparams['dEVPA'])
+    sin2 = jnp.sin(2*imparams['dEVPA'])
+    pfac = imparams['polfrac']
+    qvis, uvis, vvis = pfac*(cos2*qvis - sin2*uvis), pfac*(sin2*qvis + cos2*uvis), pfac*vvis
+    phasor = jnp.exp(-1j*2*np.pi*(uv[:,0]*imparams['xuas']+uv[:,1]*imparams['yuas'])*RADPERUAS)
+    return jnp.array([ivis, qvis, uvis, vvis])*phasor
+
+@x64
+def build_vis_batch(grids, uv, jfunc, optical_depth='thin', polflux=True, compute_P=True, compute_V=False, axisymmetric=True, stationary=True, r_o=np.inf, mass_invariant=False, time=0.):
+    """
+    Compile kerr_exact_vis, vectorized with vmap over a batch of parameters. Returns
+    vis_batch(imparams), where every entry of the dict imparams holds one value per batch member
+    along its first axis (jargs has shape (nbatch, njargs); eta and alpha_zeta may be None), and
+    which gives visibilities of shape (nbatch, 4, nuv).
+    """
+    uv = jnp.asarray(uv)
+    def vis(imparams):
+        return kerr_exact_vis.__wrapped__(grids, uv, imparams, jfunc, optical_depth=optical_depth, polflux=polflux, compute_P=compute_P, compute_V=compute_V, axisymmetric=axisymmetric, stationary=stationary, r_o=r_o, mass_invariant=mass_invariant, time=time)
+    return x64(jit(vmap(vis)))
+
+@x64
+def test_jax_kerrexact(npix=12, tol=1e-8):
+    """
+    Check kerr_exact_sep_lp against kerrexact.kerr_exact_sep_lp for one non-axisymmetric,
+    non-stationary configuration, grid_stokes and dft against the numpy envelope and Fourier
+    transform, and the vmapped visibilities of build_vis_batch against kerr_exact_vis at each
+    batch member. The grid is small so that the jit compilations stay affordable.
+    """
+    from bam.inference import kerrexact
+    from bam.inference.model_helpers import get_rho_varphi_from_FOV_npix
+    from bam.inference.jfuncs import ring_jfunc
+    fov = 20.
+    rho, varphi = get_rho_varphi_from_FOV_npix(fov, npix, nmax=1)
+    maxerr = 0.
+    maxmismatch = 0.
+    settings = [(0.3, 2.8, False, False, 1e3)]
+    for a, inc, axisymmetric, stationary, r_o in settings:
+        for boost, chi, fluid_eta, iota in [(0.2, 0.7, 1.1, 0.6)]:
+            args = (rho, 1., varphi, inc, a, 1, boost, chi, fluid_eta, iota, 1., None)
+            kwargs = {'compute_V':True, 'axisymmetric':axisymmetric, 'stationary':stationary, 'r_o':r_o}
+            new = kerr_exact_sep_lp(*args, **kwargs)
+            old = kerrexact.kerr_exact_sep_lp(*args, **kwargs)
+            for n in range(2):
+                newmask = new[0][n] != 0
+                oldmask = kerrexact.emitting_pixels(old[0][n])
+                oldmask = np.isin(np.arange(len(old[0][n])), oldmask)
+                #rays grazing the horizon or the turning point may be classified differently
+                maxmismatch = max(maxmismatch, np.mean(newmask != oldmask))
+                both = newmask & oldmask
+                for i, (x, y) in enumerate(zip(new, old)):
+                    if (i == 1 and axisymmetric) or (i == 2 and stationary):
+                        continue
+                    y = np.nan_to_num(y[n][both])
+                    scale = np.max(np.abs(y))
+                    if scale > 0:
+                        maxerr = max(maxerr, np.max(np.abs(x[n][both]-y))/scale)
+    print("Max error relative to the largest value of each output: "+str(maxerr))
+    print("Largest fraction of pixels reaching the emitter in only one backend: "+str(maxmismatch))
+    if not (maxerr <= tol and maxmismatch <= 0.01):
+        raise Exception("jax_kerrexact does not match kerrexact!")
+
+    #thin envelope and direct Fourier transform
+    a, inc, boost, chi, iota, spec = 0.6, 0.9, 0.4, -1.8, 1.2, 1.
+    jargs = np.array([5., 2.])
+    #without adap_fac, every subimage shares the screen grid of n = 0
+    grid = make_grid(rho[0], varphi[0], fov, [0, 1], pulse=deltaPulse2D)
+    stokes = np.asarray(grid_stokes(grid, 1., a, inc, boost, chi, chi+np.pi, iota, spec, spec, 1., ring_jfunc, jnp.asarray(jargs)))
+    rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = kerrexact.kerr_exact_sep_lp(rho, 1., varphi, inc, a, 1, boost, chi, None, iota, spec, None)
+    old = np.zeros((4, len(rho[0])))
+    for n in range(2):
+        support = kerrexact.emitting_pixels(rvecs[n])
+        profile = np.zeros(len(rho[0]))
+        profile[support] = ring_jfunc(rvecs[n][support], jargs)*redshifts[n][support]**(3+spec)*lps[n][support]
+        old += np.array([ivecs[n], qvecs[n], uvecs[n], np.zeros(len(rho[0]))])*profile
+    imerr = np.max(np.abs(stokes-old))/np.max(np.abs(old[0]))
+    uv = np.random.RandomState(0).uniform(-0.2, 0.2, size=(30, 2))
+    x, y = np.meshgrid(grid['xlist'], grid['ylist'])
+    direct = np.exp(2j*np.pi*(np.outer(uv[:,0], x.flatten())+np.outer(uv[:,1], y.flatten()))).dot(old.T).T
+    viserr = np.max(np.abs(np.asarray(dft(jnp.asarray(stokes), grid, uv, 0.))-direct))/np.max(np.abs(direct[0]))
+    print("Max error of the thin image and its visibilities, relative to the total flux: "+str(max(imerr, viserr)))
+    if not max(imerr, viserr) <= tol:
+        raise Exception("grid_stokes or dft does not match the numpy envelope and Fourier transform!")
+
+    #vmap over a batch of parameters
+    imparams = {'MoDuas':np.array([1., 1.1]), 'a':np.array([0.6, -0.3]), 'inc':np.array([0.9, 0.4]), 'zbl':np.array([0.6, 1.2]), 'PA':np.array([0., 0.4]),
+                'beta':np.array([0.4, 0.1]), 'chi':np.array([-1.8, 0.3]), 'eta':None, 'iota':np.array([1.2, 0.4]), 'spec':np.array([1., 1.5]), 'alpha_zeta':None,
+                'h':np.array([1., 1.]), 'jargs':np.array([[5., 2.], [6., 3.]]), 'polfrac':np.array([0.7, 0.5]), 'dEVPA':np.array([0., 0.3]),
+                'xuas':np.array([0., 1.]), 'yuas':np.array([0., -2.])}
+    batch = np.asarray(build_vis_batch([grid], uv, ring_jfunc)(imparams))
+    single = np.array([np.asarray(kerr_exact_vis([grid], jnp.asarray(uv), {k:(v if v is None else v[i]) for k, v in imparams.items()}, ring_jfunc)) for i in range(2)])
+    batcherr = np.max(np.abs(batch-single))/np.max(np.abs(single))
+    print("Max error of vmapped visibilities: "+str(batcherr))
+    if not batcherr <= tol:
+        raise Exception("build_vis_batch does not match kerr_exact_vis!")
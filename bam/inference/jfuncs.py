@@ -1,18 +1,22 @@
 import numpy as np
 from numpy import exp, log, cos, sin
 import matplotlib.pyplot as plt
+from bam.inference.model_helpers import array_module
 
 
+#jfuncs take their array functions from array_module(r), so that they can also be differentiated with jax
+
 def ring_jfunc(r, jargs):
+    xp = array_module(r)
     peak_r = jargs[0]
     thickness = jargs[1]
-    return exp(-4.*log(2)*((r-peak_r)/thickness)**2)
+    return xp.exp(-4.*log(2)*((r-peak_r)/thickness)**2)
 
 def power_law_jfunc(r, jargs):
+    xp = array_module(r)
     alpha = jargs[0]
     out = r**(-alpha)
-    out[np.isinf(out)]=0
-    return out
+    return xp.where(xp.isinf(out), 0., out)
 
 def ring_plus_power_law_jfunc(r, jargs):
     peak_r = jargs[0]
@@ -25,6 +29,31 @@ def double_power_law_jfunc(r, jargs):
     r0, a, b = jargs
     return (r/r0)**a / (1+(r/r0)**(a+b))
 
+def make_radial_basis_jfunc(knots):
+    """
+    Return a jfunc(r, jargs) that linearly interpolates the values jargs at the radii knots
+    and vanishes outside them. It is linear in every jarg, so all of them can be linear jargs.
+    """
+    knots = np.asarray(knots)
+    def radial_basis_jfunc(r, jargs):
+        xp = array_module(r)
+        return xp.interp(r, knots, xp.asarray(jargs), left=0., right=0.)
+    return radial_basis_jfunc
+
+def make_azimuthal_jfunc(radial_jfunc, nradial, mmax):
+    """
+    Return a jfunc(r, phi, jargs) that modulates radial_jfunc, which takes the first nradial jargs,
+    by 1 + sum over m of a_m cos(m phi) + b_m sin(m phi) for m up to mmax, with the remaining
+    jargs ordered a_1, b_1, a_2, b_2, .... It is affine in the a_m and b_m, so they can be linear jargs.
+    """
+    def azimuthal_jfunc(r, phi, jargs):
+        xp = array_module(phi)
+        modulation = 1.
+        for m in range(1, mmax+1):
+            modulation = modulation + jargs[nradial+2*m-2]*xp.cos(m*phi) + jargs[nradial+2*m-1]*xp.sin(m*phi)
+        return radial_jfunc(r, jargs[:nradial])*modulation
+    return azimuthal_jfunc
+
 
 
 #temporarily removed with recent switch to axisymmetry
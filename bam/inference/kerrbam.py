@@ -4,15 +4,22 @@ import numpy as np
 import ehtim as eh
 import matplotlib.pyplot as plt
 import random
-from bam.inference.model_helpers import Gpercsq, M87_ra, M87_dec, M87_mass, M87_dist, M87_inc, isiterable, get_rho_varphi_from_FOV_npix, rescale_veclist, rice
-from bam.inference.data_helpers import make_log_closure_amplitude, amp_add_syserr, vis_add_syserr, logcamp_add_syserr, cphase_add_syserr, get_cphase_uvpairs, cphase_uvdists, get_logcamp_uvpairs, logcamp_uvdists, get_camp_amp_sigma, get_cphase_vis_sigma, var_sys, get_minimal_logcamps, get_minimal_cphases
+from bam.inference.model_helpers import Gpercsq, M87_ra, M87_dec, M87_mass, M87_dist, M87_inc, isiterable, get_rho_varphi_from_FOV_npix, LRUCache, compact_dft
+from bam.inference.geodesic_tables import GeodesicTable
+from bam.inference.fourier import DFTEngine, FFTEngine, engine_key, dft_size, DFT_MAX_ELEMENTS, FFT_OVERSAMPLE, FFT_KERNEL_WIDTH
+from bam.inference.face_on import is_face_on, face_on_grid, default_face_on_grid, window_harmonics, FACE_ON_TOL
+from bam.inference.image_model import primitives_from_caches, face_on_primitives_from_cache, image_from_primitives, face_on_profile_from_primitives
+from bam.inference.likelihood import Likelihood
+from bam.inference.data_helpers import make_log_closure_amplitude, vis_add_syserr, get_cphase_uvpairs, get_logcamp_uvpairs, var_sys, get_minimal_logcamps, get_minimal_cphases
 from numpy import arctan2, sin, cos, exp, log, clip, sqrt,sign
 import dynesty
 from dynesty import plotting as dyplot
 from dynesty import utils as dyfunc
+from dynesty.utils import LoglOutput
 from scipy.optimize import dual_annealing
-from scipy.special import ive
+from scipy.stats import truncnorm
 import time
+from functools import partial
 from ehtim.plotting.summary_plots import imgsum
 from ehtim.calibrating.self_cal import self_cal
 # from bam.inference.schwarzschildexact import getscreencoords, getwindangle, getpsin, getalphan
@@ -30,18 +37,71 @@ def get_uniform_transform(lower, upper):
 
 NOISE_DEFAULT_DICT = {'f':0,'e':0,'var_a':0,'var_b':0,'var_c':0,'var_u0':4e9}
 
+class BatchPool:
+    """
+    A pool for dynesty that evaluates maps of loglike over arrays of points with loglike_batch,
+    in chunks of batch_size spread over pool if one is given. Other maps, like the evolution of
+    live points, go to pool.map or the builtin map.
+    """
+    def __init__(self, loglike, loglike_batch, pool=None, batch_size=64):
+        self.loglike = loglike
+        self.loglike_batch = loglike_batch
+        self.pool = pool
+        self.batch_size = batch_size
+        self.size = (getattr(pool, '_processes', None) or getattr(pool, 'size', None) or 1) if pool is not None else 1
+
+    def wraps_loglike(self, func):
+        #dynesty wraps the likelihood in LogLikelihood and _function_wrapper objects
+        while func is not None:
+            if func is self.loglike:
+                return True
+            func = getattr(func, 'loglikelihood', getattr(func, 'func', None))
+        return False
+
+    def map(self, func, iterable):
+        mapper = map if self.pool is None else self.pool.map
+        if not self.wraps_loglike(func):
+            return mapper(func, iterable)
+        points = np.array(list(iterable))
+        chunks = [points[i:i+self.batch_size] for i in range(0, len(points), self.batch_size)]
+        values = np.concatenate(list(mapper(self.loglike_batch, chunks)))
+        if func is self.loglike:
+            return list(values)
+        return [LoglOutput(value, func.blob) for value in values]
+
 class KerrBam:
     '''The Bam class is a collection of accretion flow and black hole parameters.
     jfunc: a callable that takes (r, phi, jargs)
     if Bam is in modeling mode, jfunc should use pm functions
+    linear_jarg_names: jargs in which jfunc is affine, such as the coefficients of a basis; the likelihood
+    then transforms one image per coefficient and combines their visibilities for each draw
     '''
     #class contains knowledge of a grid in Boyer-Lindquist coordinates, priors on each pixel, and the machinery to fit them
-    def __init__(self, fov, npix, jfunc, jarg_names, jargs, MoDuas, a, inc, zbl,  xuas = 0., yuas = 0., PA=0.,  nmax=0, beta=0., chi=0., eta = None, iota=np.pi/2, spec=1., alpha_zeta = None, h = 1, polfrac=0.7, dEVPA=0, f=0., e=0., var_a = 0, var_b = 0, var_c = 0, var_u0=4e9, polflux=True, source='', periodic=False, adap_fac =1, axisymmetric = True, stationary = True, optical_depth='thin',compute_P=True,compute_V=False,interp_order=1, use_jax=False, rice_amps=False, times=np.array([0]), r_o=np.inf):
+    def __init__(self, fov, npix, jfunc, jarg_names, jargs, MoDuas, a, inc, zbl,  xuas = 0., yuas = 0., PA=0.,  nmax=0, beta=0., chi=0., eta = None, iota=np.pi/2, spec=1., alpha_zeta = None, h = 1, polfrac=0.7, dEVPA=0, f=0., e=0., var_a = 0, var_b = 0, var_c = 0, var_u0=4e9, polflux=True, source='', periodic=False, adap_fac =1, axisymmetric = True, stationary = True, optical_depth='thin',compute_P=True,compute_V=False,interp_order=1, use_jax=False, rice_amps=False, times=np.array([0]), r_o=np.inf, cache_size=8, mass_invariant=False, fov_M=None, geodesic_table=None, use_numba=False, symmetric=False, face_on=False, face_on_nrho=None, chunk_size=None, max_memory=None, nthreads=None, native_vis=False, fft_oversample=FFT_OVERSAMPLE, fft_kernel_width=FFT_KERNEL_WIDTH, linear_jarg_names=None):
+        self.use_jax = use_jax
+        self.use_numba = use_numba
+        #trace each pixel with beta > 0 together with its mirror image at -beta
+        self.symmetric = symmetric
+        #stream pixel blocks of at most chunk_size, or max_memory bytes of temporaries, through ray tracing and emissivity
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        #trace pixel blocks on a pool of nthreads threads; meant for fixed-mode renders and MAP searches,
+        #not for samplers that already run likelihood calls in parallel
+        self.nthreads = nthreads
         if use_jax:
             print("Using jax is not recommended for an adaptive model.")
             self.rtfunc = bam.inference.jax_kerrexact.kerr_exact_sep_lp
         else:
-            self.rtfunc = bam.inference.kerrexact.kerr_exact_sep_lp   
+            if use_numba:
+                #the first call compiles the kernel, which is then cached on disk
+                from bam.inference import numba_kerrexact
+            self.rtfunc = partial(bam.inference.kerrexact.kerr_exact_sep_lp, use_numba=use_numba, symmetric=symmetric, chunk_size=chunk_size, max_memory=max_memory, nthreads=nthreads)
+        #level one holds ray tracing results, level two adds the fluid emissivity model
+        self.cache_size = cache_size
+        self.geometry_cache = LRUCache(cache_size)
+        self.emissivity_cache = LRUCache(cache_size)
+        #sparse resize operators for rescale_veclists, keyed on source size, target size, interp_order and mode
+        self.resize_operators = LRUCache(16)
         self.rice_amps = rice_amps      
         self.interp_order = interp_order
         self.compute_P = compute_P
@@ -57,8 +117,11 @@ class KerrBam:
         self.fov_uas = fov/eh.RADPERUAS
         self.npix = npix
         self.recent_loglike = None
+        self.recent_loglike_batch = None
         self.recent_sampler = None
         self.recent_results = None
+        self.recent_loglike_and_grad = None
+        self.recent_hmc_results = None
         # self.MAP_values = None
         self.jfunc = jfunc
         self.jarg_names = jarg_names
@@ -151,6 +214,77 @@ class KerrBam:
         #                 self.periodic_names.append(i)
         #                 self.periodic_indices.append(self.modeled_names.index(i))
         self.model_dim = len(self.modeled_names)
+        #modeled parameters that the most recent likelihood integrates out instead of sampling
+        self.marginalized_names = []
+
+        self.geodesic_table = geodesic_table
+        if self.geodesic_table is not None:
+            if self.mode == 'fixed':
+                print("Geodesic tables only apply in model mode. Ray tracing directly.")
+                self.geodesic_table = None
+            elif self.axisymmetric and self.stationary:
+                print("Geodesic tables only supply phi and t, which axisymmetric, stationary models do not use. Ray tracing directly.")
+                self.geodesic_table = None
+            else:
+                if isinstance(self.geodesic_table, str):
+                    self.geodesic_table = GeodesicTable(self.geodesic_table)
+                table = self.geodesic_table
+                if (table.npix, table.nmax, table.adap_fac, table.axisymmetric, table.stationary, table.r_o) != (self.npix, self.nmax, self.adap_fac, self.axisymmetric, self.stationary, float(self.r_o)):
+                    raise Exception("Geodesic table does not match this KerrBam's npix, nmax, adap_fac, axisymmetry, stationarity, or r_o!")
+                if not table.covers(a, inc):
+                    raise Exception("Geodesic table does not cover the prior ranges of a and inc!")
+                print("Ray tracing with the geodesic table at "+str(table.path)+", which supplies phi and t.")
+                #tables are in units of M, so they imply mass-invariant mode
+                mass_invariant = True
+                fov_M = table.fov_M
+
+        self.mass_invariant = mass_invariant
+        if self.mass_invariant and self.mode == 'fixed':
+            print("Mass-invariant ray tracing only applies in model mode. Turning it off.")
+            self.mass_invariant = False
+        if self.mass_invariant:
+            #ray trace once in units of M; MoDuas then only rescales the uv plane
+            if fov_M is None:
+                fov_M = self.fov_uas/np.min(MoDuas)
+            self.fov_M = fov_M
+            self.rho_M, _ = get_rho_varphi_from_FOV_npix(self.fov_M, self.npix, adap_fac=self.adap_fac, nmax=nmax)
+            print("Using mass-invariant ray tracing with a field of view of "+str(self.fov_M)+" M.")
+
+        #face-on models are traced along one radial cut, and their Stokes I visibilities are Hankel transforms
+        self.face_on = face_on
+        if self.face_on:
+            if not (self.axisymmetric and self.stationary and is_face_on(inc)):
+                print("The face-on fast path needs an axisymmetric, stationary model at a fixed inc with |sin(inc)| <= "+str(FACE_ON_TOL)+". Turning it off.")
+                self.face_on = False
+            else:
+                if self.mass_invariant:
+                    face_on_fov = self.fov_M
+                else:
+                    face_on_fov = self.fov_uas
+                #the radial grid reaches the corners of the image, whose square crop enters through its harmonics
+                if face_on_nrho is None:
+                    #refine around the rings of every mass in the prior, and sample at least as finely as the model image
+                    scale = (1., 1.) if self.mass_invariant else (np.min(MoDuas), np.max(MoDuas))
+                    self.face_on_rho, self.face_on_drho = default_face_on_grid(face_on_fov, self.nmax, scale=scale, min_nrho=self.npix)
+                else:
+                    self.face_on_rho, self.face_on_drho = face_on_grid(face_on_fov, face_on_nrho)
+                self.face_on_window = window_harmonics(self.face_on_rho, face_on_fov)
+                print("Using the face-on fast path with "+str(len(self.face_on_rho))+" radial samples.")
+
+        #with adaptive subimages, Fourier transform each subimage on its own grid and sum the visibilities
+        self.native_vis = native_vis
+        #likelihoods plan Fourier engines for their fixed uv points; grids too large for DFT matrices
+        #use a padded FFT with a Kaiser-Bessel kernel of fft_kernel_width cells
+        self.fft_oversample = fft_oversample
+        self.fft_kernel_width = fft_kernel_width
+        if self.native_vis and not (self.adap_fac > 1 and self.nmax > 0 and self.stationary and self.optical_depth == 'thin'):
+            print("Native-resolution visibilities need adap_fac > 1, nmax > 0 and a stationary, optically thin model. Turning them off.")
+            self.native_vis = False
+        #indices in jargs of the coefficients in which jfunc is affine
+        self.linear_jarg_names = [] if linear_jarg_names is None else list(linear_jarg_names)
+        if any([not ljn in jarg_names for ljn in self.linear_jarg_names]):
+            raise Exception("linear_jarg_names must be a subset of jarg_names.")
+        self.linear_jargs = [jarg_names.index(ljn) for ljn in self.linear_jarg_names]
 
         if self.mode == 'fixed':
             self.imparams = [self.MoDuas, self.a, self.inc, self.zbl, self.xuas, self.yuas, self.PA, self.beta, self.chi, self.eta, self.iota, self.spec, self.alpha_zeta, self.h, self.polfrac, self.dEVPA, self.jargs]
@@ -193,150 +327,51 @@ class KerrBam:
         print("Returning: rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps.")
         return self.rtfunc(self.rho_uas, MoDuas, self.varphivec, inc, a, self.nmax, beta, chi, eta, iota, spec, alpha_zeta, adap_fac = self.adap_fac, axisymmetric=self.axisymmetric, stationary=self.stationary, compute_V = self.compute_V, r_o = self.r_o)        
 
+    def cached_primitives(self, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=False):
+        """
+        Return the output of kerr_exact_sep_lp on the current grid, reusing cached ray tracing
+        (keyed on geometry) and emissivity (keyed on geometry and fluid parameters) when possible.
+        Stokes vectors are returned as copies, since compute_image modifies them in place.
+        With intensity_only, the reduced emissivity kernel is used and q, u, v are shared zeros.
+        """
+        mudists = self.rho_M if self.mass_invariant else self.rho_uas
+        return primitives_from_caches(self, mudists, self.varphivec, self.geometry_cache, self.emissivity_cache, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=intensity_only)
 
+    def cache_info(self):
+        """
+        Return hit and miss counts for the geometry and emissivity caches.
+        """
+        return {'geometry':self.geometry_cache.info(), 'emissivity':self.emissivity_cache.info()}
+
+    def clear_cache(self):
+        self.geometry_cache.clear()
+        self.emissivity_cache.clear()
 
-    def compute_image(self, imparams):
+
+    def compute_image(self, imparams, intensity_only=False, native=False, normalize=True):
         """
         Given a list of values of modeled parameters in imparams,
-        compute the resulting i, q, u, v
+        compute the resulting i, q, u, v.
+        With intensity_only, or when polflux is False, only Stokes I is computed
+        and q, u, v are returned as zeros.
+        With native (stationary, optically thin models only), subimages are left on their own
+        adaptive grids and hold the flux in each of their pixels, instead of being resized to the finest grid.
+        Without normalize, the images are scaled by zbl but not divided by their total flux.
         """
         # print(imparams)
         MoDuas, a, inc, zbl, xuas, yuas, PA, beta, chi, eta, iota, spec, alpha_zeta, h, polfrac, dEVPA, jargs = imparams
+        intensity_only = intensity_only or not(self.polflux)
+        prims = self.cached_primitives(MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta, intensity_only=intensity_only)
+        return image_from_primitives(self, prims, imparams, intensity_only=intensity_only, native=native, normalize=normalize)
 
-        
-        #convert rho_uas to gravitational units
-        rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps = self.rtfunc(self.rho_uas, MoDuas, self.varphivec, inc, a, self.nmax, beta, chi, eta, iota, spec, alpha_zeta, adap_fac = self.adap_fac, axisymmetric=self.axisymmetric, stationary=self.stationary, compute_V = self.compute_V, r_o=self.r_o)
-        if not(self.compute_P) or not(self.compute_V):
-            zvecs = [np.zeros_like(rvecs[n]) for n in range(self.nmax+1)]
-        if self.optical_depth == 'varying' or self.optical_depth == 'thick':
-            rvecs = rescale_veclist(rvecs,order=self.interp_order,anti_aliasing=False)
-            if not self.axisymmetric:
-                phivecs = rescale_veclist(phivecs,order=self.interp_order,anti_aliasing=False)
-            if not self.stationary:
-                tvecs = rescale_veclist(tvecs,order=self.interp_order,anti_aliasing=False)
-            redshifts = rescale_veclist(redshifts,order=self.interp_order,anti_aliasing=False)
-            lps = rescale_veclist(lps,order=self.interp_order,anti_aliasing=False)
-            ivecs = rescale_veclist(ivecs,order=self.interp_order,anti_aliasing=False)
-            if self.compute_P:
-                qvecs = rescale_veclist(qvecs,order=self.interp_order,anti_aliasing=False)
-                uvecs = rescale_veclist(uvecs,order=self.interp_order,anti_aliasing=False)
-            if self.compute_V:
-                vvecs = rescale_veclist(vvecs,order=self.interp_order,anti_aliasing=False)
-        if self.stationary:
-
-            for n in reversed(range(self.nmax+1)):
-                if self.axisymmetric:
-                    jfunc_vals = self.jfunc(rvecs[n], jargs) 
-                else:
-                    jfunc_vals = self.jfunc(rvecs[n],phivecs[n],jargs)
-
-                profile = jfunc_vals*redshifts[n]**(3+spec)
-
-                if self.optical_depth == 'thin':
-                    profile = profile * lps[n]
-                elif self.optical_depth == 'varying':
-                    tau = h*lps[n]
-                    exptau = np.exp(-tau)
-                    profile = profile * (1-exptau)
-                    if n < self.nmax:
-                        ivecs[n+1] *= exptau
-                        if self.compute_P:
-                            qvecs[n+1] *= exptau
-                            uvecs[n+1] *= exptau
-                        if self.compute_V:
-                            vvecs[n+1] *= exptau
-                elif self.optical_depth == 'thick':
-                    #this is the optically thick case, where h is a constant
-                    pass
-                else:
-                    print("Unrecognized optical depth prescription! Defaulting to optically thick.")
-                    
-                if self.polflux:
-                    ivecs[n]*=profile
-                else:
-                    ivecs[n] = profile
-                    qvecs[n] = zvecs[n]
-                    uvecs[n] = zvecs[n]
-                    vvecs[n] = zvecs[n]
-                if self.compute_P:
-                    qvecs[n]*=profile
-                    uvecs[n]*=profile
-                if self.compute_V:
-                    vvecs[n]*=profile
-            if self.optical_depth == 'thin':
-                ivecs = rescale_veclist(ivecs,order=self.interp_order,anti_aliasing=False)
-                qvecs = rescale_veclist(qvecs,order=self.interp_order,anti_aliasing=False)
-                uvecs = rescale_veclist(uvecs,order=self.interp_order,anti_aliasing=False)
-                vvecs = rescale_veclist(vvecs,order=self.interp_order,anti_aliasing=False)
-            tf = np.sum(ivecs)
-            ivecs = [ivec*zbl/tf for ivec in ivecs]
-            if self.compute_P:
-                qvecs = [qvec*zbl/tf*polfrac for qvec in qvecs]
-                uvecs = [uvec*zbl/tf*polfrac for uvec in uvecs]
-                if not np.isclose(0.,dEVPA):
-                    pvecs = [(qvecs[i]+1j*uvecs[i])*np.exp(2j*dEVPA) for i in range(len(qvecs))]
-                    qvecs = [np.real(pvec) for pvec in pvecs]
-                    uvecs = [np.imag(pvec) for pvec in pvecs]
-            if self.compute_V:
-                vvecs = [vvec*zbl/tf*polfrac for vvec in vvecs]
-            return ivecs, qvecs, uvecs, vvecs 
-        else:
-            out = []
-            for time in self.times:
-                for n in reversed(range(self.nmax+1)):
-                    jfunc_vals = self.jfunc(rvecs[n],phivecs[n],tvecs[n]+time,jargs)
-                    profile = jfunc_vals*redshifts[n]**(3+spec)
-
-                    if self.optical_depth == 'thin':
-                        profile = profile * lps[n]
-                    elif self.optical_depth == 'varying':
-                        tau = h*lps[n]
-                        exptau = np.exp(-tau)
-                        profile = profile * (1-exptau)
-                        if n < self.nmax:
-                            ivecs[n+1] *= exptau
-                            if self.compute_P:
-                                qvecs[n+1] *= exptau
-                                uvecs[n+1] *= exptau
-                            if self.compute_V:
-                                vvecs[n+1] *= exptau
-                    elif self.optical_depth == 'thick':
-                        #this is the optically thick case, where h is a constant
-                        pass
-                    else:
-                        print("Unrecognized optical depth prescription! Defaulting to optically thick.")
-                        
-                    if self.polflux:
-                        ivecs[n]*=profile
-                    else:
-                        ivecs[n] = profile
-                        qvecs[n] = zvecs[n]
-                        uvecs[n] = zvecs[n]
-                        vvecs[n] = zvecs[n]
-                    if self.compute_P:
-                        qvecs[n]*=profile
-                        uvecs[n]*=profile
-                    if self.compute_V:
-                        vvecs[n]*=profile
-                if self.optical_depth == 'thin':
-                    ivecs = rescale_veclist(ivecs,order=self.interp_order,anti_aliasing=False)
-                    qvecs = rescale_veclist(qvecs,order=self.interp_order,anti_aliasing=False)
-                    uvecs = rescale_veclist(uvecs,order=self.interp_order,anti_aliasing=False)
-                    vvecs = rescale_veclist(vvecs,order=self.interp_order,anti_aliasing=False)
-                tf = np.sum(ivecs)
-                ivecs = [ivec*zbl/tf for ivec in ivecs]
-                if self.compute_P:
-                    qvecs = [qvec*zbl/tf*polfrac for qvec in qvecs]
-                    uvecs = [uvec*zbl/tf*polfrac for uvec in uvecs]
-                    if not np.isclose(0.,dEVPA):
-                        pvecs = [(qvecs[i]+1j*uvecs[i])*np.exp(2j*dEVPA) for i in range(len(qvecs))]
-                        qvecs = [np.real(pvec) for pvec in pvecs]
-                        uvecs = [np.imag(pvec) for pvec in pvecs]
-                if self.compute_V:
-                    vvecs = [vvec*zbl/tf*polfrac for vvec in vvecs]
-                out.append([ivecs, qvecs, uvecs, vvecs])
-            return out
-
+    def compute_face_on_profile(self, imparams):
+        """
+        Face-on counterpart of compute_image: given imparams, return the Stokes I profile
+        on self.face_on_rho, normalized so that the flux inside the field of view is zbl.
+        """
+        MoDuas, a, inc, zbl, xuas, yuas, PA, beta, chi, eta, iota, spec, alpha_zeta, h, polfrac, dEVPA, jargs = imparams
+        prims = face_on_primitives_from_cache(self, self.emissivity_cache, MoDuas, a, inc, beta, chi, eta, iota, spec, alpha_zeta)
+        return face_on_profile_from_primitives(self, prims, imparams)
 
 
     def observe_same(self, obs, ampcal=True,phasecal=True,add_th_noise=True,seed=None):
@@ -348,11 +383,89 @@ class KerrBam:
         im = self.make_image(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd = obs.mjd, source=obs.source)
         return im.observe_same(obs, ampcal=ampcal,phasecal=phasecal, add_th_noise=add_th_noise, seed=seed)
 
+    def make_modelim(self, ra=M87_ra, dec=M87_dec, rf=230e9, mjd=57854, source=''):
+        """
+        Build the empty image that each likelihood call fills in with the model.
+        In mass-invariant mode its pixels are in units of M, at 1 uas per M.
+        """
+        if self.mass_invariant:
+            fov = self.fov_M*eh.RADPERUAS
+        else:
+            fov = self.fov
+        return eh.image.make_empty(self.npix*self.adap_fac**self.nmax, fov, ra=ra, dec=dec, rf=rf, mjd=mjd, source=source)#, pulse=deltaPulse2D)
+
     def modelim_ivis(self, uv, ttype='nfft'):
-        return self.modelim.sample_uv(uv,ttype=ttype)[0]
+        return self.sample_image(self.modelim, uv, ttype=ttype, ivis_only=True)[0]
 
     def modelim_allvis(self, uv, ttype='nfft'):
-        return self.modelim.sample_uv(uv,ttype=ttype)
+        return self.sample_image(self.modelim, uv, ttype=ttype)
+
+    def sample_image(self, im, uv, ttype='nfft', ivis_only=False):
+        """
+        Stokes I, Q, U, V visibilities of the ehtim Image im at uv, or only [I] with ivis_only.
+        The direct transform goes through compact_vis, and other transforms through ehtim.
+        """
+        if ttype == 'direct':
+            if ivis_only:
+                return self.compact_vis(uv, [im.ivec], im=im)
+            return self.compact_vis(uv, [im.ivec, im.qvec, im.uvec, im.vvec], im=im)
+        vis = im.sample_uv(uv,ttype=ttype)
+        if ivis_only:
+            return vis[:1]
+        return vis
+
+    def build_fourier_engines(self, images, uvsets, ttype='nfft'):
+        """
+        Plan a Fourier engine for every image in images at every array of uv points in uvsets, keyed with engine_key.
+        Precomputed DFTEngine matrices are used if their total size is at most DFT_MAX_ELEMENTS.
+        Otherwise, with ttype 'nfft', FFTEngine gridding is planned instead, and with ttype 'direct'
+        None is returned, leaving the exact transforms to compact_vis. The images must already have their final pa.
+        """
+        size = np.sum([dft_size(im, uv) for im in images for uv in uvsets])
+        if size <= DFT_MAX_ELEMENTS:
+            print("Precomputed DFT matrices with "+str(size)+" entries.")
+            engine = DFTEngine
+        elif ttype == 'nfft':
+            print("DFT matrices would have "+str(size)+" entries. Precomputing FFT gridding with oversampling "+str(self.fft_oversample)+" and a kernel width of "+str(self.fft_kernel_width)+".")
+            engine = partial(FFTEngine, oversample=self.fft_oversample, width=self.fft_kernel_width)
+        else:
+            print("DFT matrices would have "+str(size)+" entries. Using ttype "+ttype+".")
+            return None
+        engines = {}
+        for im in images:
+            for uv in uvsets:
+                key = engine_key(im, uv)
+                if not key in engines:
+                    engines[key] = engine(im, uv)
+        return engines
+
+    def make_subimages(self, im):
+        """
+        Empty images on the native grid of each subimage, with the field of view and metadata of im.
+        """
+        return [eh.image.make_empty(self.npix*self.adap_fac**n, im.fovx(), ra=im.ra, dec=im.dec, rf=im.rf, mjd=im.mjd, source=im.source) for n in range(self.nmax+1)]
+
+    def compact_vis(self, uv, vecs, im=None):
+        """
+        Direct Fourier transform of the flattened image vectors in vecs, which live on the grid of
+        the ehtim Image im (modelim by default), summing only over the pixel rows and columns where
+        one of them is nonzero. Matches im.sample_uv with ttype='direct', including the pa rotation
+        and pixel pulse; empty or all-zero vectors give zeros.
+        """
+        if im is None:
+            im = self.modelim
+        uv = np.array(uv)
+        if im.pa != 0.0:
+            c = np.cos(im.pa)
+            s = np.sin(im.pa)
+            uv = np.column_stack([c*uv[:,0] - s*uv[:,1], s*uv[:,0] + c*uv[:,1]])
+        filled = [i for i in range(len(vecs)) if vecs[i] is not None and len(vecs[i]) and np.any(vecs[i])]
+        out = [np.zeros(len(uv)) for vec in vecs]
+        if len(filled) > 0:
+            vis = compact_dft([vecs[i] for i in filled], im.psize, im.xdim, im.ydim, uv, im.pulse)
+            for i, visi in zip(filled, vis):
+                out[i] = visi
+        return out
 
     def modelim_logcamp(self, uv1, uv2, uv3, uv4, ttype='nfft'):
         vis12 = self.modelim_ivis(uv1,ttype=ttype)
@@ -395,6 +508,41 @@ class KerrBam:
         to_eval['jargs'] = jargs
         return to_eval
 
+    def set_marginalized(self, names):
+        """
+        Drop the modeled parameters in names from modeled_names, modeled_params and model_dim,
+        since a likelihood marginalizes them analytically. An empty list restores all of them.
+        """
+        self.marginalized_names = list(names)
+        self.modeled_names = [self.all_names[i] for i in self.modeled_indices if not self.all_names[i] in names]
+        self.modeled_params = [self.all_params[i] for i in self.modeled_indices if not self.all_names[i] in names]
+        self.model_dim = len(self.modeled_names)
+
+    def recover_marginalized(self, samples, seed=None):
+        """
+        Given samples of modeled_names from the most recent likelihood built with marginalize_zbl,
+        draw zbl for each from its conditional posterior and return samples of every modeled
+        parameter, with zbl back in its place. Call set_marginalized([]) before using them with build_eval.
+        """
+        if not 'zbl' in self.marginalized_names:
+            raise Exception("The most recent likelihood does not marginalize zbl.")
+        rng = np.random.default_rng(seed)
+        zbls = []
+        for mean, std, lo, hi, logz in self.recent_loglike_batch(samples, zbl_conditional=True):
+            if np.isinf(std):
+                zbls.append(rng.uniform(lo, hi))
+            else:
+                zbls.append(truncnorm.rvs((lo-mean)/std, (hi-mean)/std, loc=mean, scale=std, random_state=rng))
+        names = [self.all_names[i] for i in self.modeled_indices]
+        return np.insert(np.atleast_2d(samples), names.index('zbl'), zbls, axis=1)
+
+    def loglike_batch(self, params_matrix):
+        """
+        Evaluate the most recent likelihood at each row of params_matrix, sharing the image
+        and Fourier work across rows.
+        """
+        return self.recent_loglike_batch(np.atleast_2d(params_matrix))
+
     def loglike_of_Bam(self, fbam):
         """
         Given a fixed-mode Bam object, compute the log likelihood of its parameters given
@@ -413,6 +561,9 @@ class KerrBam:
         if not self.stationary:
             print("Can't use NxCorr in time-dependent mode!")
             return
+        if self.mass_invariant:
+            print("Can't use NxCorr in mass-invariant mode!")
+            return
         def nxcorr(params):
             to_eval = self.build_eval(params)
 
@@ -451,6 +602,9 @@ class KerrBam:
         if not self.stationary:
             print("Can't use NRMSE in time-dependent mode!")
             return
+        if self.mass_invariant:
+            print("Can't use NRMSE in mass-invariant mode!")
+            return
 
         def nrmse(params):
             to_eval = self.build_eval(params)
@@ -475,256 +629,36 @@ class KerrBam:
         self.nrmse = nrmse
         return nrmse
 
-    def build_likelihood(self, obs, data_types=['vis'], ttype='nfft', debias = True, compute_minimal=True,load_recent=False):
+    def build_likelihood(self, obs, data_types=['vis'], ttype='nfft', debias = True, compute_minimal=True,load_recent=False, marginalize_zbl=False, zbl_prior=None):
         """
         Given an observation and a list of data product names, 
         return a likelihood function that accounts for each contribution. 
+        It is a Likelihood, which holds copies of everything it needs and never modifies this
+        KerrBam, so one can be shared between threads and pickled on its own.
+        With marginalize_zbl, the model visibilities are linear in zbl, which is integrated out
+        analytically under a uniform prior within its bounds, or a Gaussian zbl_prior=(mean, std) truncated to zbl > 0,
+        and dropped from modeled_names; recover_marginalized draws it afterwards.
         """
-
-        u = obs.data['u']
-        v = obs.data['v']
-        uvdists = np.sqrt(u**2+v**2)
-        
-        if 'vis' in data_types:
-            vis = obs.data['vis']
-            sigma = obs.data['sigma']
-            amp = obs.unpack('amp',debias=debias)['amp']
-            if not(self.error_modeling) and self.adding_syserr:
-                _, sigma = amp_add_syserr(amp, sigma, fractional=self.f, additive = self.e, var_a = self.var_a, var_b=self.var_b, var_c=self.var_c, var_u0=self.var_u0, u = uvdists)
-            
-            # u = obs.data['u']
-            # v = obs.data['v']
-            visuv = np.vstack([u,v]).T
-            Nvis = len(vis)
-            print("Building vis likelihood!")
-        if 'qvis' in data_types:
-            qvis = obs.data['qvis']
-            qsigma = obs.data['qsigma']
-            qamp = np.abs(qvis)
-            # u = obs.data['u']
-            # v = obs.data['v']
-            visuv = np.vstack([u,v]).T
-            Nqvis = len(qvis)
-        if 'uvis' in data_types:
-            uvis = obs.data['uvis']
-            usigma = obs.data['usigma']
-            uamp = np.abs(uvis)
-            # u = obs.data['u']
-            # v = obs.data['v']
-            visuv = np.vstack([u,v]).T
-            Nuvis = len(uvis)
-        if 'vvis' in data_types:
-            vvis = obs.data['vvis']
-            vsigma = obs.data['vsigma']
-            vamp = np.abs(vvis)
-            # u = obs.data['u']
-            # v = obs.data['v']
-            visuv = np.vstack([u,v]).T
-            Nvvis = len(vvis)
-        if 'mvis' in data_types:
-            vis = obs.data['vis']
-            qvis = obs.data['qvis']
-            uvis = obs.data['uvis']
-            pvis = qvis+1j*uvis
-            sigma = obs.data['sigma']
-            amp = obs.unpack('amp', debias=debias)['amp']
-            if not(self.error_modeling) and self.adding_syserr:
-                _, sigma = amp_add_syserr(amp, sigma, fractional=self.f, additive = self.e, var_a = self.var_a, var_b=self.var_b, var_c=self.var_c, var_u0=self.var_u0, u = uvdists)
-            mvis = pvis/vis
-            msigma = sigma * np.sqrt(2/np.abs(vis)**2 + np.abs(pvis)**2 / np.abs(vis)**4)
-            mvis_ln_norm = -2*np.sum(np.log((2.0*np.pi)**0.5*msigma))
-            # u = obs.data['u']
-            # v = obs.data['v']
-            visuv = np.vstack([u,v]).T
-            Nmvis = len(mvis)
-        if 'amp' in data_types:
-            sigma = obs.data['sigma']
-            amp = obs.unpack('amp', debias=debias)['amp']
-            
-            ampuv = np.vstack([u,v]).T
-            Namp = len(amp)
-            print("Building amp likelihood!")
-        if 'logcamp' in data_types:
-            print("Building logcamp likelihood!")
-            if compute_minimal:
-                if load_recent:
-                    logcamp_data = np.genfromtxt('logcamps.txt',dtype=None,names=['time','t1','t2','t3','t4','u1','u2','u3','u4','v1','v2','v3','v4','camp','sigmaca'])
-                    logcamp_design_mat = np.loadtxt('logcamp_design_matrix.txt')
-                    logcamp_uvpairs = np.loadtxt('logcamp_uvpairs.txt')
-                else:
-                    logcamp_data, logcamp_design_mat, logcamp_uvpairs = get_minimal_logcamps(obs,debias=debias)
-            else:
-                logcamp_data = obs.c_amplitudes(ctype='logcamp', debias=debias)
-            logcamp = logcamp_data['camp']
-            logcamp_sigma = logcamp_data['sigmaca']
-            campuv1, campuv2, campuv3, campuv4 = get_logcamp_uvpairs(logcamp_data)
-            if self.error_modeling or self.adding_syserr:
-                print("Back-fetching quadrangle ampltudes and sigmas.")
-                n1amp, n2amp, d1amp, d2amp, n1err, n2err, d1err, d2err = get_camp_amp_sigma(obs, logcamp_data)
-                campd1, campd2, campd3, campd4 = logcamp_uvdists(logcamp_data)
-                print("Done!")
-            if not(self.error_modeling):
-                if self.adding_syserr:
-                    _, logcamp_sigma = logcamp_add_syserr(n1amp, n2amp, d1amp, d2amp, n1err, n2err, d1err, d2err, campd1, campd2, campd3, campd4, fractional=self.f, additive = self.e, var_a = self.var_a, var_b=self.var_b, var_c=self.var_c, var_u0=self.var_u0, debias=debias)
-                logcamp_ln_norm = -np.sum(np.log((2.0*np.pi)**0.5 * logcamp_sigma))
-                
-            Ncamp = len(logcamp)
-        if 'cphase' in data_types:
-            print("Building cphase likelihood!")
-            if compute_minimal:
-                if load_recent:
-                    cphase_data = np.genfromtxt('cphases.txt',dtype=None,names=['time','t1','t2','t3','u1','u2','u3','v1','v2','v3','cphase','sigmacp'])
-                    cphase_design_mat = np.loadtxt('cphase_design_matrix.txt')
-                    cphase_uvpairs = np.loadtxt('cphase_uvpairs.txt')
-                else:
-                    cphase_data, cphase_design_mat, cphase_uvpairs = get_minimal_cphases(obs)
-            else:
-                cphase_data = obs.c_phases(ang_unit='rad')
-            cphaseuv1, cphaseuv2, cphaseuv3 = get_cphase_uvpairs(cphase_data)
-            cphase = cphase_data['cphase']
-            cphase_sigma = cphase_data['sigmacp']
-            if self.error_modeling or self.adding_syserr:
-                print("Back-fetching triangle amplitudes and sigmas.")
-                v1, v2, v3, v1err, v2err, v3err = get_cphase_vis_sigma(obs, cphase_data)
-                cphased1, cphased2, cphased3 = cphase_uvdists(cphase_data)
-                v1err = np.abs(v1err)
-                v2err = np.abs(v2err)
-                v3err = np.abs(v3err)
-                print("Done!")
-            if not(self.error_modeling):
-                if self.adding_syserr:
-                    _, cphase_sigma = cphase_add_syserr(v1, v2, v3, v1err, v2err, v3err, cphased1, cphased2, cphased3, fractional=self.f, additive = self.e, var_a = self.var_a, var_b=self.var_b, var_c=self.var_c, var_u0=self.var_u0)
-                cphase_ln_norm = -np.sum(np.log(2.0*np.pi*ive(0, 1.0/(cphase_sigma)**2))) 
-            Ncphase = len(cphase)
-        def loglike(params):
-            to_eval = self.build_eval(params)
-
-            imparams = [to_eval[ipn] for ipn in self.imparam_names]
-            ivecs, qvecs, uvecs, vvecs = self.compute_image(imparams)
-            out = 0.
-            ivec = np.sum(ivecs,axis=0)
-            if self.compute_P:
-                qvec = np.sum(qvecs,axis=0)
-                uvec = np.sum(uvecs,axis=0)
-            else:
-                qvec = np.zeros_like(ivec)
-                uvec = np.zeros_like(ivec)
-            if self.compute_V:
-                vvec = np.sum(vvecs,axis=0)
-            else:
-                vvec = np.zeros_like(ivec)
-            self.modelim.ivec = ivec
-            self.modelim.qvec = qvec
-            self.modelim.uvec = uvec
-            self.modelim_vvec = vvec
-            self.modelim.pa = to_eval['PA']
-            if 'vis' in data_types or 'qvis' in data_types or 'uvis' in data_types or 'vvis' in data_types or 'mvis' in data_types:
-                model_ivis, model_qvis, model_uvis, model_vvis = self.modelim_allvis(visuv, ttype=ttype)
-                if 'mvis' in data_types:
-                    model_mvis = (model_qvis+1j*model_uvis)/model_ivis
-                translation_phasor = np.exp(-1j*2*np.pi*(u*to_eval['xuas']+v*to_eval['yuas'])*eh.RADPERUAS)
-                model_ivis = model_ivis * translation_phasor
-                model_qvis = model_qvis * translation_phasor
-                model_uvis = model_uvis * translation_phasor
-                model_vvis = model_vvis * translation_phasor
-
-            if 'vis' in data_types:
-                if self.error_modeling:
-                    _, sd = amp_add_syserr(amp, sigma, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], u = uvdists)
-                else:
-                    sd = sigma
-                # sd = sqrt(sigma**2.0 + (to_eval['f']*amp)**2.0+to_eval['e']**2.0)
-                # model_vis = self.modelim_ivis(visuv, ttype=ttype)
-                vislike = -0.5 * np.sum(np.abs(model_ivis-vis)**2 / sd**2)
-                ln_norm = vislike-2*np.sum(np.log((2.0*np.pi)**0.5 * sd)) 
-                out+=ln_norm
-            if 'qvis' in data_types:
-                if self.error_modeling:
-                    _, sd = amp_add_syserr(qamp, qsigma, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], u = uvdists)
-                else:
-                    sd = qsigma
-                # sd = sqrt(qsigma**2.0 +(to_eval['f']*qamp)**2.0+to_eval['e']**2.0)
-                qvislike = -0.5 * np.sum(np.abs(model_qvis-qvis)**2.0/sd**2)
-                ln_norm = qvislike-2*np.sum(np.log((2.0*np.pi)**0.5*sd))
-                out += ln_norm
-            if 'uvis' in data_types:
-                if self.error_modeling:
-                    _, sd = amp_add_syserr(uamp, usigma, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], u = uvdists)
-                else:
-                    sd = usigma
-                # sd = sqrt(usigma**2.0 +(to_eval['f']*uamp)**2.0+to_eval['e']**2.0)
-                uvislike = -0.5 * np.sum(np.abs(model_uvis-uvis)**2.0/sd**2)
-                ln_norm = uvislike-2*np.sum(np.log((2.0*np.pi)**0.5*sd))
-                out += ln_norm
-            if 'vvis' in data_types:
-                if self.error_modeling:
-                    _, sd = amp_add_syserr(vamp, vsigma, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], u = uvdists)
-                else:
-                    sd = vsigma
-                # sd = sqrt(vsigma**2.0 +(to_eval['f']*vamp)**2.0+to_eval['e']**2.0)
-                vvislike = -0.5 * np.sum(np.abs(model_vvis-vvis)**2.0/sd**2)
-                ln_norm = vvislike-2*np.sum(np.log((2.0*np.pi)**0.5*sd))
-                out += ln_norm
-            if 'mvis' in data_types:
-                if self.error_modeling:
-                    _, sd = amp_add_syserr(amp, msigma, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], u = uvdists)
-                    msd = sd * np.sqrt(2/np.abs(vis)**2 + np.abs(pvis)**2 / np.abs(vis)**4)
-                    mln = -2*np.sum(np.log((2.0*np.pi)**0.5*msd))
-                else:
-                    msd = msigma
-                    mln = mvis_ln_norm
-                # sd = sqrt(msigma**2.0 + (to_eval['f']*amp)**2.0+to_eval['e']**2.0)
-                #sd = vsigma*sd/sigma
-                mvislike = -0.5 * np.sum(np.abs(model_mvis-mvis)**2.0/msd**2)
-                ln_norm = mvislike + mln
-                out+=ln_norm
-            if 'amp' in data_types:
-                if self.error_modeling:
-                    _, sd = amp_add_syserr(amp, sigma, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], u = uvdists)
-                else:
-                    sd = sigma
-                model_amp = np.abs(self.modelim_ivis(ampuv, ttype=ttype))    
-                if self.rice_amps:
-                    ricelike = np.sum(np.log(rice(model_amp,sd,amp)))
-                    out += ricelike
-                else:
-                    # sd = sqrt(sigma**2.0 + (to_eval['f']*amp)**2.0+to_eval['e']**2.0)
-                    # model_amp = np.abs(self.vis(ivec, rotimxvec, rotimyvec, u, v))
-                    # amplike = -1/Namp * np.sum(np.abs(model_amp-amp)**2 / sd**2)
-                    amplike = -0.5*np.sum((model_amp-amp)**2 / sd**2)
-                    ln_norm = amplike-np.sum(np.log((2.0*np.pi)**0.5 * sd)) 
-                    out+=ln_norm
-            if 'logcamp' in data_types:
-                if compute_minimal:
-                    model_logcamp = logcamp_design_mat.dot(np.log(np.abs(self.modelim_ivis(logcamp_uvpairs,ttype=ttype))))
-                else:
-                    model_logcamp = self.modelim_logcamp(campuv1, campuv2, campuv3, campuv4, ttype=ttype)
-                if self.error_modeling:
-                    _, new_logcamp_err = logcamp_add_syserr(n1amp, n2amp, d1amp, d2amp, n1err, n2err, d1err, d2err, campd1, campd2, campd3, campd4, fractional=to_eval['f'], additive = to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'], debias=debias)
-                    logcamplike = -0.5*np.sum((logcamp-model_logcamp)**2/new_logcamp_err**2)
-                    ln_norm = logcamplike-np.sum(np.log((2.0*np.pi)**0.5 * new_logcamp_err)) 
-                else:
-                    logcamplike = -0.5*np.sum((logcamp-model_logcamp)**2 / logcamp_sigma**2)
-                    ln_norm = logcamplike + logcamp_ln_norm
-                out += ln_norm
-            if 'cphase' in data_types:
-                if compute_minimal:
-                    model_cphase = cphase_design_mat.dot(np.angle(self.modelim_ivis(cphase_uvpairs,ttype=ttype)))
-                else:
-                    model_cphase = self.modelim_cphase(cphaseuv1, cphaseuv2, cphaseuv3, ttype=ttype)
-                if self.error_modeling:
-                    _, new_cphase_err = cphase_add_syserr(v1, v2, v3, v1err, v2err, v3err, cphased1, cphased2, cphased3, fractional=to_eval['f'], additive=to_eval['e'], var_a = to_eval['var_a'], var_b=to_eval['var_b'], var_c=to_eval['var_c'], var_u0=to_eval['var_u0'])
-                    cphaselike = -np.sum((1-np.cos(cphase-model_cphase))/new_cphase_err**2)
-                    ln_norm = cphaselike-np.sum(np.log(2.0*np.pi*ive(0, 1.0/(new_cphase_err)**2))) 
-                else:
-                    cphaselike = -np.sum((1-np.cos(cphase-model_cphase))/cphase_sigma**2)
-                    ln_norm = cphaselike + cphase_ln_norm
-                out += ln_norm
-            return out
+        loglike = Likelihood(self, obs, data_types=data_types, ttype=ttype, debias=debias, compute_minimal=compute_minimal, load_recent=load_recent, marginalize_zbl=marginalize_zbl, zbl_prior=zbl_prior)
+        self.set_marginalized(loglike.marginalized_names)
         print("Built combined likelihood function!")
         self.recent_loglike = loglike
+        self.recent_loglike_batch = loglike.batch
         return loglike
 
+    def build_loglike_and_grad(self, obs, data_types=['vis'], debias=True, compute_minimal=True, load_recent=False):
+        """
+        Given an observation and a list of data product names, return loglike_and_grad(params), which
+        gives the log likelihood of build_likelihood and its gradient in the modeled parameters.
+        The whole chain is differentiated with jax (see bam.inference.gradients); it covers stationary,
+        axisymmetric models without error modeling parameters, and jfuncs written with array_module.
+        """
+        from bam.inference import gradients
+        loglike_and_grad = gradients.build_loglike_and_grad(self, obs, data_types=data_types, debias=debias, compute_minimal=compute_minimal, load_recent=load_recent)
+        print("Built differentiable likelihood function!")
+        self.recent_loglike_and_grad = loglike_and_grad
+        return loglike_and_grad
+
 
     def KerrBam_from_eval(self, to_eval):
         new = KerrBam(self.fov, self.npix, self.jfunc, self.jarg_names, to_eval['jargs'], to_eval['MoDuas'], to_eval['a'], to_eval['inc'], to_eval['zbl'], xuas=to_eval['xuas'], yuas=to_eval['yuas'], PA=to_eval['PA'],  nmax=self.nmax, beta=to_eval['beta'], chi=to_eval['chi'], eta = to_eval['eta'], iota=to_eval['iota'], spec=to_eval['spec'], alpha_zeta=to_eval['alpha_zeta'], h = to_eval['h'], polfrac = to_eval['polfrac'], dEVPA = to_eval['dEVPA'], f=to_eval['f'], e=to_eval['e'],var_a = to_eval['var_a'], var_b = to_eval['var_b'], var_c = to_eval['var_c'], var_u0=to_eval['var_u0'],  polflux=self.polflux,source=self.source,adap_fac=self.adap_fac, interp_order=self.interp_order,axisymmetric=self.axisymmetric,stationary=self.stationary)
@@ -736,7 +670,7 @@ class KerrBam:
         find the MAP using scipy's dual annealing.
         """
         self.source = obs.source
-        self.modelim = eh.image.make_empty(self.npix*self.adap_fac,self.fov, ra=obs.ra, dec=obs.dec, rf= obs.rf, mjd = obs.mjd, source=obs.source)#, pulse=deltaPulse2D)
+        self.modelim = self.make_modelim(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd=obs.mjd, source=obs.source)
         ll = self.build_likelihood(obs, data_types=data_types,ttype=ttype, debias=debias)
         
         print("Running dual annealing...")
@@ -753,7 +687,7 @@ class KerrBam:
         Given an image, find the nxcorr MAP using scipy's dual annealing.
         """
         self.source = im.source
-        self.modelim = eh.image.make_empty(self.npix*self.adap_fac,self.fov, ra=im.ra, dec=im.dec, rf= im.rf, mjd = im.mjd, source=im.source)#, pulse=deltaPulse2D)
+        self.modelim = self.make_modelim(ra=im.ra, dec=im.dec, rf=im.rf, mjd=im.mjd, source=im.source)
         nn = self.build_nxcorr(im)
         print("Running dual annealing...")
         res =  dual_annealing(lambda x: -nn(x), self.modeled_params, args=args, maxiter=maxiter, local_search_options=local_search_options, initial_temp=initial_temp)
@@ -769,7 +703,7 @@ class KerrBam:
         Given an image, find the nxcorr MAP using scipy's dual annealing.
         """
         self.source = im.source
-        self.modelim = eh.image.make_empty(self.npix*self.adap_fac,self.fov, ra=im.ra, dec=im.dec, rf= im.rf, mjd = im.mjd, source=im.source)#, pulse=deltaPulse2D)
+        self.modelim = self.make_modelim(ra=im.ra, dec=im.dec, rf=im.rf, mjd=im.mjd, source=im.source)
         nn = self.build_nrmse(im)
         print("Running dual annealing...")
         res =  dual_annealing(lambda x: nn(x), self.modeled_params, args=args, maxiter=maxiter, local_search_options=local_search_options, initial_temp=initial_temp)
@@ -780,6 +714,69 @@ class KerrBam:
         new.modelim = new.make_image(modelim=True)
         return new, res
 
+    def gradient_MAP(self, obs, data_types=['vis'], x0=None, nstarts=1, maxiter=1000, debias=True, seed=4, options={}):
+        """
+        Given an observation and a list of data product names, find the MAP with L-BFGS-B over the
+        prior box, using the gradients of build_loglike_and_grad. Without x0, each of nstarts searches
+        starts from a random point of the prior box, and the best one is kept.
+        """
+        from scipy.optimize import minimize
+        self.source = obs.source
+        self.modelim = self.make_modelim(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd=obs.mjd, source=obs.source)
+        llg = self.build_loglike_and_grad(obs, data_types=data_types, debias=debias)
+        bounds = np.array(self.modeled_params, dtype=float)
+        rng = np.random.default_rng(seed)
+        if x0 is None:
+            starts = rng.uniform(bounds[:,0], bounds[:,1], size=(nstarts, self.model_dim))
+        else:
+            starts = [x0]
+
+        def negative(x):
+            ll, grad = llg(x)
+            if not np.isfinite(ll):
+                return np.inf, np.zeros_like(x)
+            return -ll, -grad
+
+        print("Running L-BFGS-B...")
+        res = None
+        for start in starts:
+            trial = minimize(negative, start, jac=True, method='L-BFGS-B', bounds=bounds, options=dict(options, maxiter=maxiter))
+            print("Found log likelihood "+str(-trial.fun)+" after "+str(trial.nfev)+" evaluations.")
+            if res is None or trial.fun < res.fun:
+                res = trial
+        print("Done!")
+
+        to_eval = self.build_eval(res.x)
+        new = self.KerrBam_from_eval(to_eval)
+        new.modelim = new.make_image(modelim=True)
+        return new, res
+
+    def run_hmc(self, obs, data_types=['vis'], nsamples=1000, nwarmup=500, x0=None, nleapfrog=None, step_size=None, target_accept=0.8, max_depth=10, debias=True, seed=None, print_progress=True):
+        """
+        Given an observation and a list of data product names, sample the posterior under uniform priors
+        over modeled_params with Hamiltonian Monte Carlo, using the gradients of build_loglike_and_grad.
+        Trajectories are built by the No-U-Turn Sampler, or with nleapfrog leapfrog steps each. Sampling
+        runs in logistic coordinates of the prior box, starting from x0 or a random point of the box.
+        Returns samples of modeled_names, and keeps them with the sampler statistics in recent_hmc_results.
+        """
+        from bam.inference import gradients
+        self.source = obs.source
+        self.modelim = self.make_modelim(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd=obs.mjd, source=obs.source)
+        llg = self.build_loglike_and_grad(obs, data_types=data_types, debias=debias)
+        bounds = np.array(self.modeled_params, dtype=float)
+        rng = np.random.default_rng(seed)
+        if x0 is None:
+            x0 = rng.uniform(bounds[:,0], bounds[:,1])
+        logp_and_grad = gradients.box_posterior(llg, bounds)
+        print("Running Hamiltonian Monte Carlo...")
+        zs, stats = gradients.hmc_sample(logp_and_grad, gradients.box_inverse(x0, bounds), nsamples, nwarmup, nleapfrog=nleapfrog, step_size=step_size, target_accept=target_accept, max_depth=max_depth, seed=rng.integers(2**32), print_progress=print_progress)
+        print("Done! Mean acceptance "+str(np.mean(stats['accept']))+", "+str(np.sum(stats['divergent']))+" divergent transitions.")
+        samples = np.array([gradients.box_transform(z, bounds)[0] for z in zs])
+        stats['logl'] = stats['logp'] - np.array([gradients.box_transform(z, bounds)[1] for z in zs])
+        stats['samples'] = samples
+        self.recent_hmc_results = stats
+        return samples
+
     def build_prior_transform(self):
         functions = [get_uniform_transform(bounds[0],bounds[1]) for bounds in self.modeled_params]
 
@@ -792,17 +789,21 @@ class KerrBam:
         return ptform
 
     
-    def build_sampler(self, loglike, ptform, bound='multi', sample='auto', pool=None, queue_size=None):
+    def build_sampler(self, loglike, ptform, bound='multi', sample='auto', pool=None, queue_size=None, batch_size=None):
+        if batch_size is not None:
+            #maps of the likelihood over arrays of points, like the initial live points, go through loglike_batch
+            pool = BatchPool(loglike, self.recent_loglike_batch, pool=pool, batch_size=batch_size)
         sampler = dynesty.DynamicNestedSampler(loglike, ptform,self.model_dim, bound=bound, sample=sample, pool=pool, queue_size=queue_size)
         self.recent_sampler=sampler
         return sampler
 
-    def setup(self, obs, data_types=['vis'], bound='multi', ttype='nfft', sample='auto', debias=True, pool=None, queue_size=None, compute_minimal=True, load_recent=False):
+    def setup(self, obs, data_types=['vis'], bound='multi', ttype='nfft', sample='auto', debias=True, pool=None, queue_size=None, compute_minimal=True, load_recent=False, marginalize_zbl=False, zbl_prior=None, batch_size=None):
         self.source = obs.source
-        self.modelim = eh.image.make_empty(self.npix*self.adap_fac,self.fov, ra=obs.ra, dec=obs.dec, rf= obs.rf, mjd = obs.mjd, source=obs.source)#, pulse=deltaPulse2D)
+        self.modelim = self.make_modelim(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd=obs.mjd, source=obs.source)
+        #the likelihood decides which parameters are sampled, so it is built before the prior transform
+        loglike = self.build_likelihood(obs, data_types=data_types, ttype=ttype, debias=debias, compute_minimal=compute_minimal, load_recent=load_recent, marginalize_zbl=marginalize_zbl, zbl_prior=zbl_prior)
         ptform = self.build_prior_transform()
-        loglike = self.build_likelihood(obs, data_types=data_types, ttype=ttype, debias=debias, compute_minimal=compute_minimal, load_recent=load_recent)
-        sampler = self.build_sampler(loglike,ptform, bound=bound, sample=sample, pool=pool, queue_size=queue_size)
+        sampler = self.build_sampler(loglike,ptform, bound=bound, sample=sample, pool=pool, queue_size=queue_size, batch_size=batch_size)
         print("Ready to model with this BAM's recent_sampler! Call run_nested!")
         return sampler
 
@@ -16,6 +16,8 @@ from scipy.signal import convolve2d
 from bam.inference.model_helpers import get_rho_varphi_from_FOV_npix
 from bam.inference.scipy_ellip_binding import ellip_pi_arr
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 
 minkmetric = np.diag([-1, 1, 1, 1])
@@ -43,7 +45,7 @@ def R1_R2(al,phi,j,ret_r2=True): #B62 and B65
         R2 = R2 + (2*j - nn)*R1 / (j + (1-j)*al2)
 
     else:
-        R2=np.NaN
+        R2=np.nan
 
     return (R1,R2)
 
@@ -120,16 +122,37 @@ def getlorentzboost(boost, chi):
 #these should return r, phi, tau, tau_tot
 
 
+def get_Phi_tau(snarg, urat):
+    """
+    Function by Andrew Chael to get the Jacobi amplitude Phi(tau) of the polar motion.
+    urat is broadcast against snarg, which may be stacked over subimages.
+    """
+    Phi_tau = np.zeros_like(snarg)
+    jmask = np.abs(snarg)<1e-12
+    if np.any(jmask):
+        Phi_tau[jmask] = snarg[jmask]
+    if np.any(~jmask):
+        mk = np.broadcast_to(urat/(urat-1), snarg.shape)[~jmask] # real, in (0,1) since k<0
+        #am(sqrt(1-m)x | k) = pi/2 - am(K(m) - x | m for m <=1
+        Phi_tau[~jmask] = 0.5*np.pi-ellipj(ellipk(mk) - snarg[~jmask]/np.sqrt(1-mk), mk)[3]
+    return Phi_tau
+
 def ray_trace_by_case(a, rm, rp, sb, lam, eta, r1, r2, r3, r4, up, um, inc, nmax, case, adap_fac= 1,axisymmetric = True, stationary=True,nmin=0, r_o = np.inf):
     """
     Case 1: r1, r2, r3, r4 are real, r2<rp<r3.
     Case 2: r1, r2, r3, r4 are real and less than rp.
     Case 3: r1, r2 real, r3, r4 complex and conjugate.
     Case 4: All complex, r1,r2 conjugate and r3,r4 conjugate.
+
+    All subimages nmin..nmax are evaluated at once; outputs are (nmax+1-nmin, npix) arrays.
+    sb may also be a (2, npix) array holding the signs of beta for each pixel and its mirror
+    image across beta = 0, which shares every other input; outputs are then (nmax+1-nmin, 2, npix).
     """
-    if len(sb) == 0:
+    nn = nmax+1-nmin
+    outshape = (nn,)+np.shape(sb)
+    if np.shape(sb)[-1] == 0:
         # print("No support in case "+str(case))
-        return [[] for n in range(nmin, nmax+1)],[[] for n in range(nmin, nmax+1)], [[] for n in range(nmin, nmax+1)], [[] for n in range(nmin, nmax+1)], [[] for n in range(nmin, nmax+1)]
+        return np.zeros(outshape), np.zeros(outshape), np.zeros(outshape), np.zeros(outshape,dtype=bool), np.zeros(outshape)
     r21 = r2-r1
     r31 = r3-r1
     r32 = r3-r2
@@ -140,18 +163,16 @@ def ray_trace_by_case(a, rm, rp, sb, lam, eta, r1, r2, r3, r4, up, um, inc, nmax
     k = (r32*r41 / (r31*r42))
     urat = up/um
     Kurat = ellipk(urat)
-    # print(nmin)
-    #option 1
+    #stack the subimages along the first axis; row i holds n = nmin+i
     m = sb.copy()
     m[m>0] = 0
-    m+= nmin
-    rvecs = []
-    phivecs = []
-    tvecs = []
-    Irmasks = []
-    signprs = []
-    Fobs_arg = np.arcsin(np.cos(inc)/np.sqrt(up))
+    m = m + nmin + np.arange(1, nn+1).reshape((nn,)+(1,)*np.ndim(sb))
+    phivecs = np.zeros(outshape)
+    tvecs = np.zeros(outshape)
+    #clipped, since rounding can push the argument just past 1 when up ~ 1 (nearly face-on)
+    Fobs_arg = np.arcsin(np.clip(np.cos(inc)/np.sqrt(up), -1, 1))
     Fobs = ellipkinc(Fobs_arg, urat)
+    Ir = 1/np.sqrt(-um*a**2)*(2*m*Kurat - sb*Fobs)
         
     if not axisymmetric:
         a2um = a**2*um
@@ -192,114 +213,90 @@ def ray_trace_by_case(a, rm, rp, sb, lam, eta, r1, r2, r3, r4, up, um, inc, nmax
         Ir_total = I2ro-I2rp      
 
     if case == 1 or case == 2:
-
-        for n in range(nmin, nmax+1):
-            m+= 1
-            # print('m',m)
-            #Is the sb on Fobs correct?
-            Ir = 1/np.sqrt(-um*a**2)*(2*m*Kurat - sb*Fobs)
-            if case == 1:
-                signpr = np.sign(Ir_turn-Ir)
-                # signpr = np.ones_like(Ir)    
-
-            else:
-                signpr = np.ones_like(Ir)
-            Irmask = Ir<Ir_total
-
-            #Note discrepancy with kgeo: no sb on I2ro
-            # X2 = 1/2*r3142sqrt *(-Ir + signpr*I2ro)
-            X2 = 1/2*r3142sqrt *(-Ir + I2ro)
-            snnum, cnnum, dnnum, amnum = ellipj(X2,k)
-
-            snsqr = snnum**2
-            r =(r4*r31 - r3*r41*snsqr)/(r31-r41*snsqr)
-            r[~Irmask] = np.nan
-            rvec = np.nan_to_num(r)
-            rvecs.append(rvec)
-            signprs.append(signpr)
-            Irmasks.append(Irmask)
-            if not axisymmetric:  
-                tau = Ir
-                auxarg = np.arcsin(x2ro)
-
-                rp3 = rp - r3
-                rm3 = rm - r3
-                rp4 = rp - r4
-                rm4 = rm - r4
-
-                # signpr = np.ones_like(signpr)
-                dX2dtau = -0.5*r3142sqrt
-                dsn2dtau = 2*snnum*cnnum*dnnum*dX2dtau
-                drsdtau = -r31*r43*r41*dsn2dtau / ((r31-r41*snsqr)**2)
-                Rpot_o = (r_o-r1)*(r_o-r2)*(r_o-r3)*(r_o-r4)
-                #Note discrepancy with kgeo: missing sb on drsdtau_o
-                drsdtau_o = signpr*np.sqrt(Rpot_o)
-
-
-                H = drsdtau / (r - r3) - drsdtau_o/(r_o-r3)
-                #Note discrepancy with kgeo: missing sb on ellipeinc
-                E = np.sqrt(r31*r42)*(ellipkinc(amnum,k) - signpr*ellipeinc(auxarg, k))
-                Pi_1 = (2./np.sqrt(r31*r42))*(ellip_pi_arr(r41/r31,amnum,k)-signpr*ellip_pi_arr(r41/r31,auxarg,k))
-                Pi_p = (2./np.sqrt(r31*r42))*(r43/(rp3*rp4))*(ellip_pi_arr((rp3*r41)/(rp4*r31),amnum,k)-
-                                                                 signpr*ellip_pi_arr((rp3*r41)/(rp4*r31),auxarg,k))
-                Pi_m = (2./np.sqrt(r31*r42))*(r43/(rm3*rm4))*(ellip_pi_arr((rm3*r41)/(rm4*r31),amnum,k)-
-                                                                 signpr*ellip_pi_arr((rm3*r41)/(rm4*r31),auxarg,k))
-                # final integrals
-                I1 = r3*(-tau) + r43*Pi_1 # B48
-                I2 = H - 0.5*(r1*r4 + r2*r3)*(-tau) - E # B49
-                Ip = Ir/rp3 - Pi_p # B50
-                Im = Ir/rm3 - Pi_m # B50
-                I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
-
-
-                #finish Gph calculation
-                snarg = np.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
-
-                snarg = snarg.astype(float)
-                sinPhi_tau = np.zeros_like(snarg)
-                Phi_tau = np.zeros_like(snarg)
-                jmask = np.abs(snarg)<1e-12
-                if np.any(jmask):
-                    sinPhi_tau[jmask] = snarg[jmask]
-                    Phi_tau[jmask] = snarg[jmask]
-                if np.any(~jmask):
-                    mk = (urat/(urat-1))[~jmask] # real, in (0,1) since k<0
-                    # mk = np.outer(np.ones(1),mk)[~jmask]
-                    ellipfuns = ellipj(snarg[~jmask]/np.sqrt(1-mk), mk)
-                    #sn(sqrt(1-m)x | k) = sqrt(1-m)*sn(x|m)/dn(x|m)
-                    sinPhi_tau[~jmask] = np.sqrt(1-mk) * ellipfuns[0]/ellipfuns[2]
-                    #am(sqrt(1-m)x | k) = pi/2 - am(K(m) - x | m for m <=1
-                    Phi_tau[~jmask] = 0.5*np.pi-ellipj(ellipk(mk) - snarg[~jmask]/np.sqrt(1-mk), mk)[3]
-
-                Gph = (1/np.sqrt(-a2um)*ellip_pi_arr(up, Phi_tau, urat)-sb*Gph_o)#.astype(float)
-                # print(Gph)
-                # print('Gph_o',Gph_o)
-
-                phi = phi_o + I_phi + lam * Gph
-                phi[~Irmask] = np.nan
-                # phi[jmask]=10
-                phivecs.append(np.nan_to_num(phi))
-            if not stationary:
-                # get I_phi, I_t, I_sigma
-                #I_0 = -tausteps
-                I0 = -tau
-                I_tA = (4/(rp-rm))*((rp**2 - 0.5*a*lam*rp)*Ip - (rm**2 - 0.5*a*lam*rm)*Im) # B2
-                It = I_tA + 4*I0 + 2*I1 + I2
-                # I_sig = I_2
-
-                #finish Gt calculation
-                Gt = -(2*up/np.sqrt(-um*a**2)* (ellipeinc(Phi_tau,urat) - ellipkinc(Phi_tau,urat))/(2*urat)) - sb * Gt_o
-                
-                t = It+a**2*Gt 
-                t = t+(r_o + 2*np.log(r_o))
-                # t = I2
-                t[~Irmask]=np.nan
-                # t = -1000*np.ones_like()
-                tvecs.append(np.nan_to_num(t,nan=0))
-                # plt.plot(r,t,'.')
-                # plt.title('case 2')
-                # plt.show()
-                #return (r_s, I_phi, I_t, I_sig)
+        #Is the sb on Fobs correct?
+        if case == 1:
+            signpr = np.sign(Ir_turn-Ir)
+            # signpr = np.ones_like(Ir)    
+        else:
+            signpr = np.ones_like(Ir)
+        Irmask = Ir<Ir_total
+
+        #Note discrepancy with kgeo: no sb on I2ro
+        # X2 = 1/2*r3142sqrt *(-Ir + signpr*I2ro)
+        X2 = 1/2*r3142sqrt *(-Ir + I2ro)
+        snnum, cnnum, dnnum, amnum = ellipj(X2,k)
+
+        snsqr = snnum**2
+        r =(r4*r31 - r3*r41*snsqr)/(r31-r41*snsqr)
+        r[~Irmask] = np.nan
+        rvecs = np.nan_to_num(r)
+        if not axisymmetric:  
+            tau = Ir
+            auxarg = np.arcsin(x2ro)
+
+            rp3 = rp - r3
+            rm3 = rm - r3
+            rp4 = rp - r4
+            rm4 = rm - r4
+
+            # signpr = np.ones_like(signpr)
+            dX2dtau = -0.5*r3142sqrt
+            dsn2dtau = 2*snnum*cnnum*dnnum*dX2dtau
+            drsdtau = -r31*r43*r41*dsn2dtau / ((r31-r41*snsqr)**2)
+            Rpot_o = (r_o-r1)*(r_o-r2)*(r_o-r3)*(r_o-r4)
+            #Note discrepancy with kgeo: missing sb on drsdtau_o
+            drsdtau_o = signpr*np.sqrt(Rpot_o)
+
+
+            H = drsdtau / (r - r3) - drsdtau_o/(r_o-r3)
+            #Note discrepancy with kgeo: missing sb on ellipeinc
+            #the auxarg terms do not depend on n, so they are evaluated once per pixel
+            E = np.sqrt(r31*r42)*(ellipkinc(amnum,k) - signpr*ellipeinc(auxarg, k))
+            Pi_1 = (2./np.sqrt(r31*r42))*(ellip_pi_arr(r41/r31,amnum,k)-signpr*ellip_pi_arr(r41/r31,auxarg,k))
+            Pi_p = (2./np.sqrt(r31*r42))*(r43/(rp3*rp4))*(ellip_pi_arr((rp3*r41)/(rp4*r31),amnum,k)-
+                                                             signpr*ellip_pi_arr((rp3*r41)/(rp4*r31),auxarg,k))
+            Pi_m = (2./np.sqrt(r31*r42))*(r43/(rm3*rm4))*(ellip_pi_arr((rm3*r41)/(rm4*r31),amnum,k)-
+                                                             signpr*ellip_pi_arr((rm3*r41)/(rm4*r31),auxarg,k))
+            # final integrals
+            I1 = r3*(-tau) + r43*Pi_1 # B48
+            I2 = H - 0.5*(r1*r4 + r2*r3)*(-tau) - E # B49
+            Ip = Ir/rp3 - Pi_p # B50
+            Im = Ir/rm3 - Pi_m # B50
+            I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
+
+
+            #finish Gph calculation
+            snarg = np.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
+
+            snarg = snarg.astype(float)
+            Phi_tau = get_Phi_tau(snarg, urat)
+
+            Gph = (1/np.sqrt(-a2um)*ellip_pi_arr(up, Phi_tau, urat)-sb*Gph_o)#.astype(float)
+            # print(Gph)
+            # print('Gph_o',Gph_o)
+
+            phi = phi_o + I_phi + lam * Gph
+            phi[~Irmask] = np.nan
+            # phi[jmask]=10
+            phivecs = np.nan_to_num(phi)
+        if not stationary:
+            # get I_phi, I_t, I_sigma
+            #I_0 = -tausteps
+            I0 = -tau
+            I_tA = (4/(rp-rm))*((rp**2 - 0.5*a*lam*rp)*Ip - (rm**2 - 0.5*a*lam*rm)*Im) # B2
+            It = I_tA + 4*I0 + 2*I1 + I2
+            # I_sig = I_2
+
+            #finish Gt calculation
+            Gt = -(2*up/np.sqrt(-um*a**2)* (ellipeinc(Phi_tau,urat) - ellipkinc(Phi_tau,urat))/(2*urat)) - sb * Gt_o
+            
+            t = It+a**2*Gt 
+            t = t+(r_o + 2*np.log(r_o))
+            # t = I2
+            t[~Irmask]=np.nan
+            # t = -1000*np.ones_like()
+            tvecs = np.nan_to_num(t,nan=0)
+            #return (r_s, I_phi, I_t, I_sig)
     if case == 3:
         Agl = np.real(np.sqrt(r32*r42))
         Bgl = np.real(np.sqrt(r31*r41))
@@ -339,106 +336,125 @@ def ray_trace_by_case(a, rm, rp, sb, lam, eta, r1, r2, r3, r4, up, um, inc, nmax
         I3rp = ellipkinc(I3rp_angle, k3) / np.sqrt(Agl*Bgl)    
         # Ir_total = I3r - I3rp
 
-        signpr = np.ones_like(Agl)
-        for n in range(nmin, nmax+1):
-            m += 1
-            Ir = 1/np.sqrt(-um*a**2)*(2*m*Kurat - sb*Fobs)
-            Irmask = Ir<Ir_total
+        signpr = np.ones_like(Ir)
+        Irmask = Ir<Ir_total
 
-            #note discrepancy with kgeo: no sb on Ir_o
-            X3 = np.sqrt(Agl*Bgl)*(-Ir +signpr*Ir_o)
+        #note discrepancy with kgeo: no sb on Ir_o
+        X3 = np.sqrt(Agl*Bgl)*(-Ir +signpr*Ir_o)
 
-            snnum, cnnum, dnnum, amnum = ellipj(X3, k3)
-            signptheta = (-1)**m * sb
-            ffac = 1 / 2 * np.real(r31 * r42)**(1/2)
+        snnum, cnnum, dnnum, amnum = ellipj(X3, k3)
 
-            r = ((Bgl*r2 - Agl*r1) + (Bgl*r2+Agl*r1)*cnnum) / ((Bgl-Agl)+(Bgl+Agl)*cnnum)
-            r[~Irmask] = np.nan
-            rvec = np.nan_to_num(r)
-            # rvecs.append(np.nan_to_num(r))
-            rvecs.append(rvec)
-            signprs.append(signpr)
-            Irmasks.append(Irmask)
+        r = ((Bgl*r2 - Agl*r1) + (Bgl*r2+Agl*r1)*cnnum) / ((Bgl-Agl)+(Bgl+Agl)*cnnum)
+        r[~Irmask] = np.nan
+        rvecs = np.nan_to_num(r)
 
-            if not axisymmetric:
-                # pass
-                #TODO figure out conversion to Andrew's definitions
-                tau = Ir
-                #need:
-                # al0
-                amX3 = amnum
-                # auxarg
-
-                R1_a_0, R2_a_0 = R1_R2(al0,amX3,k3)
-                R1_b_0, R2_b_0 = R1_R2(al0,auxarg,k3)
-                R1_a_p, _ = R1_R2(alp,amX3,k3,ret_r2=False)
-                R1_b_p, _ = R1_R2(alp,auxarg,k3,ret_r2=False)
-                R1_a_m, _ = R1_R2(alm,amX3,k3,ret_r2=False)
-                R1_b_m, _ = R1_R2(alm,auxarg,k3,ret_r2=False)
-
-                Pi_1 = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl**2-Agl**2)) * (R1_a_0 - signpr *R1_b_0) # B81
-                Pi_2 = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl**2-Agl**2))**2 * (R2_a_0 - signpr*R2_b_0) # B81
-                Pi_p = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl*rp2 - Agl*rp1))*(R1_a_p - signpr* R1_b_p) # B82
-                Pi_m = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl*rm2 - Agl*rm1))*(R1_a_m - signpr*R1_b_m) # B82
-
-                # final integrals
-                pref = ((Bgl*r2 + Agl*r1)/(Bgl+Agl))
-                I1 = pref*(-tau) + Pi_1 # B78
-                I2 = pref**2*(-tau) + 2*pref*Pi_1 + np.sqrt(Agl*Bgl)*Pi_2 # B79
-                Ip = -((Bgl+Agl)*(-tau) + Pi_p) / (Bgl*rp2 + Agl*rp1) # B80
-                Im = -((Bgl+Agl)*(-tau) + Pi_m) / (Bgl*rm2 + Agl*rm1) # B80
-                I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
-
-                #finish Gph calculation
-                snarg = np.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
-                sinPhi_tau = np.zeros_like(snarg)
-                Phi_tau = np.zeros_like(snarg)
-                jmask = np.abs(snarg)<1e-12
-                if np.any(jmask):
-                    sinPhi_tau[jmask] = snarg[jmask]
-                    Phi_tau[jmask] = snarg[jmask]
-                if np.any(~jmask):
-                    mk = (urat/(urat-1))[~jmask] # real, in (0,1) since k<0
-                    # mk = np.outer(np.ones(snarg.shape[0]),mk)[~jmask]
-                    ellipfuns = ellipj(snarg[~jmask]/np.sqrt(1-mk), mk)
-                    #sn(sqrt(1-m)x | k) = sqrt(1-m)*sn(x|m)/dn(x|m)
-                    sinPhi_tau[~jmask] = np.sqrt(1-mk) * ellipfuns[0]/ellipfuns[2]
-                    #am(sqrt(1-m)x | k) = pi/2 - am(K(m) - x | m for m <=1
-                    Phi_tau[~jmask] = 0.5*np.pi-ellipj(ellipk(mk) - snarg[~jmask]/np.sqrt(1-mk), mk)[3]
-
-                Gph = (1/np.sqrt(-a2um)*ellip_pi_arr(up, Phi_tau, urat)-sb*Gph_o)
-
-
-
-                phi = phi_o + I_phi + lam * Gph
-                phi[~Irmask] = np.nan
-                phivecs.append(np.nan_to_num(phi))
-            if not stationary:
-                # get I_phi, I_t, I_sigma
-                #I_0 = -tausteps
-                I0 = -tau
-                #I_phi = (2*a/(rplus-rminus))*((rplus - 0.5*a*lam)*I_p - (rminus - 0.5*a*lam)*I_m) # B1
-                I_tA = (4/(rp-rm))*((rp**2 - 0.5*a*lam*rp)*Ip - (rm**2 - 0.5*a*lam*rm)*Im) # B2
-                It = I_tA + 4*I0 + 2*I1 + I2
-                # I_sig = I_2
-                #finish Gt calculation
-                Gt = -(2*up/np.sqrt(-um*a**2)* (ellipeinc(Phi_tau,urat) - ellipkinc(Phi_tau,urat))/(2*urat)) - sb * Gt_o
-
-                t = It+a**2*Gt
-                t = t+(r_o + 2*np.log(r_o))
-                # t = I2
-                t[~Irmask]=np.nan
-
-                # plt.plot(r,t,'.')
-                # plt.title('case 3')
-                # plt.show()
-                tvecs.append(np.nan_to_num(t,nan=0))
+        if not axisymmetric:
+            # pass
+            #TODO figure out conversion to Andrew's definitions
+            tau = Ir
+            #need:
+            # al0
+            amX3 = amnum
+            # auxarg
+
+            R1_a_0, R2_a_0 = R1_R2(al0,amX3,k3)
+            R1_b_0, R2_b_0 = R1_R2(al0,auxarg,k3)
+            R1_a_p, _ = R1_R2(alp,amX3,k3,ret_r2=False)
+            R1_b_p, _ = R1_R2(alp,auxarg,k3,ret_r2=False)
+            R1_a_m, _ = R1_R2(alm,amX3,k3,ret_r2=False)
+            R1_b_m, _ = R1_R2(alm,auxarg,k3,ret_r2=False)
+
+            Pi_1 = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl**2-Agl**2)) * (R1_a_0 - signpr *R1_b_0) # B81
+            Pi_2 = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl**2-Agl**2))**2 * (R2_a_0 - signpr*R2_b_0) # B81
+            Pi_p = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl*rp2 - Agl*rp1))*(R1_a_p - signpr* R1_b_p) # B82
+            Pi_m = ((2*r21*np.sqrt(Agl*Bgl))/(Bgl*rm2 - Agl*rm1))*(R1_a_m - signpr*R1_b_m) # B82
+
+            # final integrals
+            pref = ((Bgl*r2 + Agl*r1)/(Bgl+Agl))
+            I1 = pref*(-tau) + Pi_1 # B78
+            I2 = pref**2*(-tau) + 2*pref*Pi_1 + np.sqrt(Agl*Bgl)*Pi_2 # B79
+            Ip = -((Bgl+Agl)*(-tau) + Pi_p) / (Bgl*rp2 + Agl*rp1) # B80
+            Im = -((Bgl+Agl)*(-tau) + Pi_m) / (Bgl*rm2 + Agl*rm1) # B80
+            I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
+
+            #finish Gph calculation
+            snarg = np.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
+            Phi_tau = get_Phi_tau(snarg, urat)
+
+            Gph = (1/np.sqrt(-a2um)*ellip_pi_arr(up, Phi_tau, urat)-sb*Gph_o)
+
+
+
+            phi = phi_o + I_phi + lam * Gph
+            phi[~Irmask] = np.nan
+            phivecs = np.nan_to_num(phi)
+        if not stationary:
+            # get I_phi, I_t, I_sigma
+            #I_0 = -tausteps
+            I0 = -tau
+            #I_phi = (2*a/(rplus-rminus))*((rplus - 0.5*a*lam)*I_p - (rminus - 0.5*a*lam)*I_m) # B1
+            I_tA = (4/(rp-rm))*((rp**2 - 0.5*a*lam*rp)*Ip - (rm**2 - 0.5*a*lam*rm)*Im) # B2
+            It = I_tA + 4*I0 + 2*I1 + I2
+            # I_sig = I_2
+            #finish Gt calculation
+            Gt = -(2*up/np.sqrt(-um*a**2)* (ellipeinc(Phi_tau,urat) - ellipkinc(Phi_tau,urat))/(2*urat)) - sb * Gt_o
+
+            t = It+a**2*Gt
+            t = t+(r_o + 2*np.log(r_o))
+            # t = I2
+            t[~Irmask]=np.nan
+
+            # plt.plot(r,t,'.')
+            # plt.title('case 3')
+            # plt.show()
+            tvecs = np.nan_to_num(t,nan=0)
 
     if case ==4:
         pass
-    return rvecs, phivecs, tvecs, Irmasks, signprs
+    return rvecs, phivecs, tvecs, Irmask, signpr
 
-def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmetric=True, stationary=True, nmin=0, prev_Irmask = None, r_o=np.inf):
+def get_mirror_pairs(alpha, beta, prev_Irmask=None):
+    """
+    Pair pixels with their mirror images across beta = 0 on a square screen grid.
+    If prev_Irmask is given, the pixels are the subset of a full grid selected by it.
+    Returns the positions of beta > 0 pixels whose mirror is also present, the positions
+    of those mirrors, and the positions of all other pixels, or None if the screen is
+    not mirror symmetric.
+    """
+    if prev_Irmask is None:
+        full_idx = np.arange(len(alpha))
+        fullsize = len(alpha)
+    else:
+        full_idx = np.flatnonzero(prev_Irmask)
+        fullsize = len(prev_Irmask)
+    xdim = int(np.round(np.sqrt(fullsize)))
+    if xdim**2 != fullsize or len(full_idx) != len(alpha):
+        return None
+    row, col = np.divmod(full_idx, xdim)
+    mirror_idx = (xdim-1-row)*xdim + col
+    positions = -np.ones(fullsize, dtype=int)
+    positions[full_idx] = np.arange(len(full_idx))
+    mirror_pos = positions[mirror_idx]
+    paired = (mirror_pos >= 0) & (mirror_idx != full_idx) & (beta > 0)
+    prim = np.flatnonzero(paired)
+    mirr = mirror_pos[paired]
+    scale = np.max(np.abs(beta)) if len(beta) else 1.
+    if not (np.allclose(alpha[mirr], alpha[prim], rtol=1e-10, atol=1e-12*scale) and np.allclose(beta[mirr], -beta[prim], rtol=1e-10, atol=1e-12*scale)):
+        return None
+    single = np.ones(len(alpha), dtype=bool)
+    single[prim] = False
+    single[mirr] = False
+    return prim, mirr, np.flatnonzero(single)
+
+def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmetric=True, stationary=True, nmin=0, prev_Irmask = None, r_o=np.inf, use_numba=False, symmetric=False, chunk_size=None, max_memory=None, nthreads=None):
+    """
+    Ray trace a screen grid for subimages nmin..nmax. With symmetric=True, every pixel with
+    beta > 0 is traced together with its mirror image at -beta, sharing all beta-independent
+    quantities (roots, classification and the n-independent integrals); if the grid is not
+    mirror symmetric, each pixel is traced on its own. Cases are traced in blocks of at most
+    chunk_size pixels, or as many as fit in max_memory bytes of temporaries; with nthreads > 1
+    the blocks are traced concurrently on a thread pool.
+    """
     if r_o < np.inf:
         r_o = np.float64(r_o)
     if np.isclose(a,0):
@@ -466,8 +482,28 @@ def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmet
         alpha = rho*np.cos(varphi[0])
         beta = rho*np.sin(varphi[0])        
     lam, eta = get_lam_eta(alpha,beta, inc, a)
-    up, um = get_up_um(lam, eta, a)
-    r1, r2, r3, r4 = get_radroots(np.complex128(lam), np.complex128(eta), a)
+    pairs = None
+    if symmetric:
+        pairs = get_mirror_pairs(alpha, beta, prev_Irmask=prev_Irmask)
+        if pairs is None and prev_Irmask is None:
+            print("Screen grid is not mirror symmetric; tracing every pixel.")
+    if pairs is None:
+        up, um = get_up_um(lam, eta, a)
+        r1, r2, r3, r4 = get_radroots(np.complex128(lam), np.complex128(eta), a)
+    else:
+        #lam and eta depend on beta only through beta**2, so mirrored pixels reuse their partner's
+        prim, mirr, single = pairs
+        source = np.arange(npix)
+        source[mirr] = prim
+        lam = lam[source]
+        eta = eta[source]
+        traced = np.concatenate([prim, single])
+        back = np.zeros(npix, dtype=int)
+        back[traced] = np.arange(len(traced))
+        back = back[source]
+        up, um = get_up_um(lam[traced], eta[traced], a)
+        r1, r2, r3, r4 = get_radroots(np.complex128(lam[traced]), np.complex128(eta[traced]), a)
+        up, um, r1, r2, r3, r4 = [x[back] for x in [up, um, r1, r2, r3, r4]]
     rr1 = np.real(r1)
     rr2 = np.real(r2)
     rr3 = np.real(r3)
@@ -524,55 +560,64 @@ def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmet
         m+=1
         all_signpthetas[ni] = (-1)**m*sb
 
-    #for now, don't raytrace case 4
-
-    rvecs1, phivecs1, tvecs1, Irmasks1, signprs1 = ray_trace_by_case(a,rm,rp,sb[case1],lam[case1],eta[case1],rr1[case1],rr2[case1],rr3[case1],rr4[case1],up[case1],um[case1],inc,nmax,1,adap_fac=adap_fac,axisymmetric=axisymmetric,stationary=stationary,nmin=nmin,r_o=r_o)
-    rvecs2, phivecs2, tvecs2, Irmasks2, signprs2 = ray_trace_by_case(a,rm,rp,sb[case2],lam[case2],eta[case2],rr1[case2],rr2[case2],rr3[case2],rr4[case2],up[case2],um[case2],inc,nmax,2,adap_fac=adap_fac,axisymmetric=axisymmetric,stationary=stationary,nmin=nmin,r_o=r_o)
-    rvecs3, phivecs3, tvecs3, Irmasks3, signprs3 = ray_trace_by_case(a,rm,rp,sb[case3],lam[case3],eta[case3],rr1[case3],rr2[case3],r3[case3],r4[case3],up[case3],um[case3],inc,nmax,3,adap_fac=adap_fac,axisymmetric=axisymmetric,stationary=stationary,nmin=nmin,r_o=r_o)
-    # rvecs4, phivecs4, Irmasks4, signprs4 = ray_trace_by_case(a,rm,rp,sb[case4],lam[case4],eta[case4],r1[case4],r2[case4],r3[case4],r4[case4],up[case4],um[case4],inc,nmax,4,adap_fac=adap_fac,axisymmetric=axisymmetric,nmin=nmin)
-
-
-
-    #stitch together cases
-    all_rvecs = []
-    all_phivecs = []
-    all_tvecs = []
-    all_Irmasks = []
-    all_signprs = []
-    for ni in range(len(ns)):#nmin, nmax+1):
-        # n = ns[ni]
-        r_all = np.zeros_like(rho)
-        phi_all = np.zeros_like(rho)
-        t_all = np.zeros_like(rho)
-        Irmask_all = np.ones_like(rho)
-        signpr_all = np.ones_like(rho)
-        r_all[case1]=rvecs1[ni]
-        r_all[case2]=rvecs2[ni]
-        r_all[case3]=rvecs3[ni]
-        # r_all[case4]=rvecs4[ni]
-        all_rvecs.append(r_all)
-        if not axisymmetric:
-            phi_all[case1]=phivecs1[ni]
-            phi_all[case2]=phivecs2[ni]
-            phi_all[case3]=phivecs3[ni]
-        if not stationary:
-            t_all[case1]=tvecs1[ni]
-            t_all[case2]=tvecs2[ni]
-            t_all[case3]=tvecs3[ni]
-        # phi_all[case4]=phivecs4[ni]
-        all_phivecs.append(phi_all)
-        all_tvecs.append(t_all)
-        Irmask_all[case1]=Irmasks1[ni]
-        Irmask_all[case2]=Irmasks2[ni]
-        Irmask_all[case3]=Irmasks3[ni]
-        # Irmask_all[case4]=Irmasks4[ni]
-        all_Irmasks.append(Irmask_all)
-        signpr_all[case1]=signprs1[ni]
-        signpr_all[case2]=signprs2[ni]
-        signpr_all[case3]=signprs3[ni]
-        # signpr_all[case4]=signprs4[ni]
-        all_signprs.append(signpr_all)
-    
+    if use_numba:
+        #fused per-pixel kernel over all cases and subimages
+        from bam.inference.numba_kerrexact import trace_pixels
+        all_rvecs, all_phivecs, all_tvecs, all_Irmasks, all_signprs = trace_pixels(a,rm,rp,sb,lam,eta,r1,r2,r3,r4,up,um,inc,nmin,nmax,case1,case2,case3,axisymmetric=axisymmetric,stationary=stationary,r_o=r_o)
+    else:
+        #for now, don't raytrace case 4
+        def trace_subset(idx, case, sbs):
+            if case == 3:
+                return ray_trace_by_case(a,rm,rp,sbs,lam[idx],eta[idx],rr1[idx],rr2[idx],r3[idx],r4[idx],up[idx],um[idx],inc,nmax,3,adap_fac=adap_fac,axisymmetric=axisymmetric,stationary=stationary,nmin=nmin,r_o=r_o)
+            return ray_trace_by_case(a,rm,rp,sbs,lam[idx],eta[idx],rr1[idx],rr2[idx],rr3[idx],rr4[idx],up[idx],um[idx],inc,nmax,case,adap_fac=adap_fac,axisymmetric=axisymmetric,stationary=stationary,nmin=nmin,r_o=r_o)
+
+        nn = len(ns)
+        r_all = np.zeros((nn, npix))
+        phi_all = np.zeros((nn, npix))
+        t_all = np.zeros((nn, npix))
+        Irmask_all = np.ones((nn, npix))
+        signpr_all = np.ones((nn, npix))
+        def store(pix, outputs):
+            rvecs_j, phivecs_j, tvecs_j, Irmasks_j, signprs_j = outputs
+            r_all[:,pix] = rvecs_j
+            if not axisymmetric:
+                phi_all[:,pix] = phivecs_j
+            if not stationary:
+                t_all[:,pix] = tvecs_j
+            Irmask_all[:,pix] = Irmasks_j
+            signpr_all[:,pix] = signprs_j
+
+        def trace_block(pix, case):
+            store(pix, trace_subset(pix, case, sb[pix]))
+        def trace_pair_block(pix_p, pix_q, case):
+            outputs = trace_subset(pix_p, case, np.array([sb[pix_p], sb[pix_q]]))
+            store(pix_p, [x[:,0] for x in outputs])
+            store(pix_q, [x[:,1] for x in outputs])
+
+        #trace each case in blocks of pixels, stitching every block straight into the outputs
+        block = get_chunk_size(npix, chunk_size=chunk_size, max_memory=max_memory, bytes_per_pixel=nn*RAY_TRACE_BYTES_PER_PIXEL, nthreads=nthreads)
+        tasks = []
+        for case, casemask in [(1, case1), (2, case2), (3, case3)]:
+            if pairs is None:
+                idx = np.flatnonzero(casemask)
+                tasks += [partial(trace_block, idx[sl], case) for sl in get_blocks(len(idx), block, nthreads=nthreads)]
+            else:
+                p = prim[casemask[prim]]
+                q = mirr[casemask[prim]]
+                s = single[casemask[single]]
+                #each pair traces two pixels
+                tasks += [partial(trace_pair_block, p[sl], q[sl], case) for sl in get_blocks(len(p), max(block//2, 1), nthreads=nthreads)]
+                tasks += [partial(trace_block, s[sl], case) for sl in get_blocks(len(s), block, nthreads=nthreads)]
+        run_blocks(tasks, nthreads=nthreads)
+        # rvecs4, phivecs4, Irmasks4, signprs4 = ray_trace_by_case(a,rm,rp,sb[case4],lam[case4],eta[case4],r1[case4],r2[case4],r3[case4],r4[case4],up[case4],um[case4],inc,nmax,4,adap_fac=adap_fac,axisymmetric=axisymmetric,nmin=nmin)
+
+        #rows are replaced by adaptive subimages below, so hand back lists
+        all_rvecs = list(r_all)
+        all_phivecs = list(phi_all)
+        all_tvecs = list(t_all)
+        all_Irmasks = list(Irmask_all)
+        all_signprs = list(signpr_all)
+
     # test = all_signprs[0]
     # test[case1]=0
     # test[case2]=0
@@ -618,7 +663,7 @@ def ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = 1, axisymmet
             # subvarphi = varphi_grid_from_npix(adap_fac*xdim)[Irmask]
             # subvarphi = rescale(varphi.reshape((xdim,xdim)),adap_fac,order=1).flatten()[Irmask]
             prev_Irmask = Irmask
-            sub_rvecs, sub_phivecs, sub_tvecs, sub_signprs, sub_signpthetas, sub_alphas, sub_betas, sub_lams, sub_etas, sub_masks = ray_trace_all(submudists, MoDuas, subvarphi, inc, a, min(nmax,n+1), axisymmetric=axisymmetric, stationary=stationary, nmin=n, adap_fac=1, prev_Irmask=prev_Irmask,r_o=r_o)
+            sub_rvecs, sub_phivecs, sub_tvecs, sub_signprs, sub_signpthetas, sub_alphas, sub_betas, sub_lams, sub_etas, sub_masks = ray_trace_all(submudists, MoDuas, subvarphi, inc, a, min(nmax,n+1), axisymmetric=axisymmetric, stationary=stationary, nmin=n, adap_fac=1, prev_Irmask=prev_Irmask,r_o=r_o, use_numba=use_numba, symmetric=symmetric, chunk_size=chunk_size, max_memory=max_memory, nthreads=nthreads)
             all_rvecs[ni]=sub_rvecs[0].flatten()
             all_phivecs[ni]=sub_phivecs[0].flatten()
             all_tvecs[ni]=sub_tvecs[0].flatten()
@@ -648,10 +693,73 @@ def sub_in_adap(size, mask, vals):
     out[mask]=vals
     return out
 
-def emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=False):
+def emitting_pixels(r):
+    """
+    Indices of the pixels of one subimage whose rays reach the emitter: pixels outside every
+    traced case keep r = 0, and rays that fall into the horizon first have r = nan.
+    """
+    return np.flatnonzero(np.isfinite(r) & (r != 0))
+
+#approximate peak bytes of per-block temporaries for each pixel and subimage, measured with tracemalloc;
+#the roots and outputs of ray_trace_all take another ~350 bytes per pixel that are not chunked
+RAY_TRACE_BYTES_PER_PIXEL = 150
+EMISSIVITY_BYTES_PER_PIXEL = 450
+
+def get_chunk_size(npix, chunk_size=None, max_memory=None, bytes_per_pixel=EMISSIVITY_BYTES_PER_PIXEL, nthreads=None):
+    """
+    Number of pixels to process at once: at most chunk_size, and few enough that the
+    temporaries of nthreads concurrent blocks fit in max_memory bytes. With neither set,
+    all npix pixels go in one block.
+    """
+    block = npix
+    if chunk_size is not None:
+        block = min(block, int(chunk_size))
+    if max_memory is not None:
+        block = min(block, int(max_memory//(bytes_per_pixel*max(nthreads or 1, 1))))
+    return max(block, 1)
+
+def get_blocks(npix, block, nthreads=None):
+    """
+    Split range(npix) into slices of at most block pixels, and into at least nthreads slices
+    when running on a thread pool.
+    """
+    if nthreads is not None and nthreads > 1:
+        block = min(block, -(-npix//nthreads))
+    block = max(block, 1)
+    return [slice(start, start+block) for start in range(0, npix, block)]
+
+#thread pools are kept per size at module level, so KerrBam objects stay picklable
+_thread_pools = {}
+
+def run_blocks(tasks, nthreads=None):
+    """
+    Call each function in tasks, on a pool of nthreads threads if nthreads > 1.
+    The scipy.special elliptic functions and numpy array operations that dominate
+    ray tracing and emissivity release the GIL, so pixel blocks run concurrently.
+    """
+    if nthreads is None or nthreads <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            task()
+        return
+    if not nthreads in _thread_pools:
+        _thread_pools[nthreads] = ThreadPoolExecutor(max_workers=nthreads)
+    #numpy error settings are per thread, so hand the caller's on to the workers
+    errstate = np.geterr()
+    def run(task):
+        with np.errstate(**errstate):
+            task()
+    futures = [_thread_pools[nthreads].submit(run, task) for task in tasks]
+    for future in futures:
+        future.result()
+
+def emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=False, chunk_size=None, max_memory=None, nthreads=None, intensity_only=False):
     """
     Given the r and phi coordinates impacted by photons, evaluate the all-space (that is, pre-envelope) emissivity model for
-    Q, U, and V there.
+    Q, U, and V there. Only pixels that reach the emitter are evaluated, and all outputs are zero
+    elsewhere. Pixels are processed in blocks of at most chunk_size, or as many as fit in
+    max_memory bytes of temporaries, and written into preallocated outputs; with nthreads > 1
+    the blocks run concurrently on a thread pool. With intensity_only, Q, U and V are
+    returned as zeros and the EVPA is never computed.
     """
 
     if fluid_eta is None:
@@ -664,6 +772,7 @@ def emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas,
     bphi = beq*np.sin(fluid_eta)
     
     bvec = np.array([br, bphi, bz])
+    boostmatrix = getlorentzboost(-boost, chi)
     ivecs = []
     qvecs = []
     uvecs = []
@@ -671,139 +780,283 @@ def emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas,
     redshifts = []
     lps = []
     for n in range(len(rvecs)):
-
-        r = rvecs[n]
-        phi = phivecs[n]
-        signpr = signprs[n]
-        signptheta = signpthetas[n]
-        alpha = alphas[n]
-        beta = betas[n]
-        lam = lams[n]
-        eta = etas[n]        
-        npix = len(r)
-        zeros = np.zeros_like(r)
-        #I realize how bad this looks, but computing everything here without using
-        #helper functions helps minimize the number of array operations
-        
-        rteta = np.sqrt(eta)
-        rpowneg2 = 1/r**2
-        rasqsum = r**2+a**2
-        bigDelta = rasqsum-2*r
-        ralamnum = rasqsum - a*lam
-        ralamnumdDelta = ralamnum/bigDelta
-        bigXi = rasqsum**2 - bigDelta * a**2 #note Xi is being evaluated at theta = pi/2
-        littleomega = 2*a*r/bigXi
-        rtbigR = np.sqrt(ralamnum**2 - bigDelta*(eta+(a-lam)**2))
-        rtXiDelta = np.sqrt(bigXi/bigDelta)/r
-        
-        #lowered
-        pt_low = -1*np.ones_like(r)
-        pr_low = signpr * rtbigR/bigDelta
-
-        # pr_low[pr_low>10] = 10
-        # pr_low[pr_low<-10] = -10
-        pphi_low = lam
-        ptheta_low = signptheta*rteta
-
-        prep = np.array([pt_low,pr_low,ptheta_low,pphi_low])
-        plowers = np.expand_dims(np.transpose(prep),2)
-        # plowers = np.array(np.hsplit(np.array([pt_low, pr_low, ptheta_low, pphi_low]),npix))
-
-        #raised
-        pt = rpowneg2 * (-a*(a-lam) + rasqsum * ralamnumdDelta)
-        pr = signpr * rpowneg2 * rtbigR
-        pphi = rpowneg2 * (-(a-lam)+a*ralamnumdDelta)
-        ptheta = signptheta*rteta *rpowneg2
-
-        # praised.append([pt_up, pr_up, pphi_up, ptheta_up])
-        #now everything to generate polarization
-        
-        emutetrad = np.array([[rtXiDelta, zeros, zeros, littleomega*rtXiDelta], [zeros, np.sqrt(bigDelta)/r, zeros, zeros], [zeros, zeros, zeros, r/np.sqrt(bigXi)], [zeros, zeros, -1/r, zeros]])
-        emutetrad = np.transpose(emutetrad,(2,0,1))
-        boostmatrix = getlorentzboost(-boost, chi)
-        #fluid frame tetrad
-        coordtransform = np.matmul(np.matmul(minkmetric, boostmatrix), emutetrad)
-        coordtransforminv = np.transpose(np.matmul(boostmatrix, emutetrad), (0,2, 1))
-        rs = r
-        pupperfluid = np.matmul(coordtransform, plowers)
-        redshift = 1 / (pupperfluid[:,0,0])
-        lp = np.abs(pupperfluid[:,0,0]/pupperfluid[:,3,0])
-        lp = np.real(np.nan_to_num(lp))
-        lps.append(lp)
-
-        #fluid frame polarization
-        pspatialfluid = pupperfluid[:,1:]
-        # print(pspatialfluid)
-        # print(pspatialfluid.shape)
-        # pspatialnorm = np.sqrt(np.sum(pspatialfluid[:,:,0]**2,axis=1))
-        fupperfluid = np.cross(pspatialfluid, bvec, axisa = 1)
-        # fupcopy = fupperfluid.copy()
-        fupperfluid[:,0,0] = fupperfluid[:,0,0] *redshift#/ pspatialnorm#would normally be a bmag here
-        fupperfluid[:,0,1] = fupperfluid[:,0,1] *redshift#/ pspatialnorm
-        fupperfluid[:,0,2] = fupperfluid[:,0,2] *redshift#/ pspatialnorm
-        sinzeta = np.sqrt(np.sum(fupperfluid[:,0,:]**2,axis=1))
-        # print(fupperfluid.shape)
-        # fupperfluid = fupperfluid / pspatialnorm
-        # print(pupperfluid[:,0,0]-pspatialnorm)
-        fupperfluid = np.insert(fupperfluid, 0, 0, axis=2)# / (np.linalg.norm(pupperfluid[1:]))
-        fupperfluid = np.swapaxes(fupperfluid, 1,2)
-
-        if compute_V:
-            vvec = np.dot(np.swapaxes(pspatialfluid,1,2), bvec).T[0]#/pspatialnorm
-        else:
-            vvec = zeros
-        #apply the tetrad to get kerr f
-        kfuppers = np.matmul(coordtransforminv, fupperfluid)
-
-
-        kft = kfuppers[:,0,0]
-        kfr = kfuppers[:,1,0]
-        kftheta = kfuppers[:,2,0]
-        kfphi = kfuppers[:, 3,0]
-        spin = a
-        #kappa1 and kappa2
-        prekappa1 = (pt * kfr - pr * kft) + spin * (pr * kfphi - pphi * kfr)
-        prekappa2 = rasqsum * (pphi * kftheta - ptheta * kfphi) - spin * (pt * kftheta - ptheta * kft)
-        kappa1 = rs * prekappa1
-        kappa2 = -rs * prekappa2
-        # kappa1 = np.clip(np.real(kappa1), -20, 20)
-        
-        #screen appearance
-        nu = -(alpha + spin * np.sin(inc))
-
-        norm = np.sqrt((nu**2 + beta**2) * (kappa1**2+kappa2**2))/sinzeta**((alpha_zeta+1)/2)
-        ealpha = (beta * kappa2 - nu * kappa1) / norm  
-        ebeta = (beta * kappa1 + nu * kappa2) / norm 
-
-        qvec = -(ealpha**2 - ebeta**2)
-        uvec = -2*ealpha*ebeta
-        
-        # qvec *= lp
-        # uvec *= lp
-        qvec = np.real(np.nan_to_num(qvec))
-        uvec = np.real(np.nan_to_num(uvec))
-        if compute_V:
-            vvec = np.real(np.nan_to_num(vvec))
-        redshift = np.real(np.nan_to_num(redshift))
-        ivec = np.sqrt(qvec**2+uvec**2)
+        npix = len(rvecs[n])
+        #every output vanishes on pixels that never reach the emitter, so only the support is evaluated
+        support = emitting_pixels(rvecs[n])
+        nsup = len(support)
+        block = get_chunk_size(nsup, chunk_size=chunk_size, max_memory=max_memory, bytes_per_pixel=EMISSIVITY_BYTES_PER_PIXEL, nthreads=nthreads)
+        outs = [np.zeros(npix) for i in range(6)]
+        def emit(sl, n=n, outs=outs, support=support):
+            pix = support[sl]
+            for out, val in zip(outs, emissivity_block(rvecs[n][pix], signprs[n][pix], signpthetas[n][pix], alphas[n][pix], betas[n][pix], lams[n][pix], etas[n][pix], a, inc, boostmatrix, bvec, alpha_zeta, compute_V=compute_V, intensity_only=intensity_only)):
+                out[pix] = val
+        run_blocks([partial(emit, sl) for sl in get_blocks(nsup, block, nthreads=nthreads)], nthreads=nthreads)
+        ivec, qvec, uvec, vvec, redshift, lp = outs
         ivecs.append(ivec)
         qvecs.append(qvec)
         uvecs.append(uvec)
         vvecs.append(vvec)
         redshifts.append(redshift)
+        lps.append(lp)
 
     
     return ivecs, qvecs, uvecs, vvecs, redshifts, lps
 
+def emissivity_block(r, signpr, signptheta, alpha, beta, lam, eta, a, inc, boostmatrix, bvec, alpha_zeta, compute_V=False, intensity_only=False):
+    """
+    Emissivity model for one block of pixels of a single subimage; returns ivec, qvec, uvec, vvec, redshift, lp.
+    The ZAMO tetrad, the fluid boost and their inverses are applied component by component
+    on flat per-pixel vectors, which is equivalent to emissivity_block_matrix.
+    With intensity_only, the EVPA is skipped and only ivec, redshift and lp are computed;
+    qvec, uvec and vvec are returned as zeros.
+    """
+    rteta = np.sqrt(eta)
+    rpowneg2 = 1/r**2
+    rasqsum = r**2+a**2
+    bigDelta = rasqsum-2*r
+    ralamnum = rasqsum - a*lam
+    ralamnumdDelta = ralamnum/bigDelta
+    bigXi = rasqsum**2 - bigDelta * a**2 #note Xi is being evaluated at theta = pi/2
+    littleomega = 2*a*r/bigXi
+    rtbigR = np.sqrt(ralamnum**2 - bigDelta*(eta+(a-lam)**2))
+    rtXiDelta = np.sqrt(bigXi/bigDelta)/r
+    rtDeltaor = np.sqrt(bigDelta)/r
+    rortXi = r/np.sqrt(bigXi)
+
+    #lowered momentum: p_t = -1, p_phi = lam
+    pr_low = signpr * rtbigR/bigDelta
+    ptheta_low = signptheta*rteta
+
+    #momentum in the ZAMO frame, with legs ordered (t, r, phi, theta) as in the tetrad
+    zt = rtXiDelta*(littleomega*lam - 1)
+    zr = rtDeltaor*pr_low
+    zphi = rortXi*lam
+    ztheta = -ptheta_low/r
+
+    #boost into the fluid frame; the boost is symmetric and only mixes the t, r and phi legs
+    gamma = boostmatrix[0,0]
+    gammaboostr = -boostmatrix[0,1]
+    gammaboostphi = -boostmatrix[0,2]
+    brr = boostmatrix[1,1]
+    brphi = boostmatrix[1,2]
+    bphiphi = boostmatrix[2,2]
+    pfluidt = -(gamma*zt - gammaboostr*zr - gammaboostphi*zphi)
+    pfluidr = -gammaboostr*zt + brr*zr + brphi*zphi
+    pfluidphi = -gammaboostphi*zt + brphi*zr + bphiphi*zphi
+    pfluidtheta = ztheta
+    redshift = 1 / pfluidt
+    lp = np.abs(pfluidt/pfluidtheta)
+    lp = np.real(np.nan_to_num(lp))
+
+    #fluid frame polarization, f = redshift * (p x b)
+    br, bphi, bz = bvec
+    fr = (pfluidphi*bz - pfluidtheta*bphi)*redshift
+    fphi = (pfluidtheta*br - pfluidr*bz)*redshift
+    ftheta = (pfluidr*bphi - pfluidphi*br)*redshift
+    sinzeta = np.sqrt(fr**2+fphi**2+ftheta**2)
+
+    if intensity_only:
+        #ealpha**2 + ebeta**2 reduces to sinzeta**(alpha_zeta+1) wherever the EVPA is defined
+        ivec = np.real(np.nan_to_num(sinzeta**(alpha_zeta+1)))
+        redshift = np.real(np.nan_to_num(redshift))
+        zeros = np.zeros_like(r)
+        return ivec, zeros, zeros, zeros, redshift, lp
 
-
-
-def kerr_exact_sep_lp(mudists, MoDuas, varphi, inc, a, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, adap_fac = 1, compute_V=False, axisymmetric=True, stationary=True, r_o=np.inf):
+    if compute_V:
+        vvec = pfluidr*br + pfluidphi*bphi + pfluidtheta*bz
+    else:
+        vvec = np.zeros_like(r)
+
+    #apply the inverse boost and tetrad to get kerr f
+    gt = -gammaboostr*fr - gammaboostphi*fphi
+    gr = brr*fr + brphi*fphi
+    gphi = brphi*fr + bphiphi*fphi
+    kft = rtXiDelta*gt
+    kfr = rtDeltaor*gr
+    kftheta = -ftheta/r
+    kfphi = littleomega*rtXiDelta*gt + rortXi*gphi
+
+    #raised momentum
+    pt = rpowneg2 * (-a*(a-lam) + rasqsum * ralamnumdDelta)
+    pr = signpr * rpowneg2 * rtbigR
+    pphi = rpowneg2 * (-(a-lam)+a*ralamnumdDelta)
+    ptheta = signptheta*rteta *rpowneg2
+    spin = a
+    #kappa1 and kappa2
+    prekappa1 = (pt * kfr - pr * kft) + spin * (pr * kfphi - pphi * kfr)
+    prekappa2 = rasqsum * (pphi * kftheta - ptheta * kfphi) - spin * (pt * kftheta - ptheta * kft)
+    kappa1 = r * prekappa1
+    kappa2 = -r * prekappa2
+
+    #screen appearance
+    nu = -(alpha + spin * np.sin(inc))
+
+    norm = np.sqrt((nu**2 + beta**2) * (kappa1**2+kappa2**2))/sinzeta**((alpha_zeta+1)/2)
+    ealpha = (beta * kappa2 - nu * kappa1) / norm  
+    ebeta = (beta * kappa1 + nu * kappa2) / norm 
+
+    qvec = -(ealpha**2 - ebeta**2)
+    uvec = -2*ealpha*ebeta
+
+    qvec = np.real(np.nan_to_num(qvec))
+    uvec = np.real(np.nan_to_num(uvec))
+    if compute_V:
+        vvec = np.real(np.nan_to_num(vvec))
+    redshift = np.real(np.nan_to_num(redshift))
+    ivec = np.sqrt(qvec**2+uvec**2)
+    return ivec, qvec, uvec, vvec, redshift, lp
+
+def emissivity_block_matrix(r, signpr, signptheta, alpha, beta, lam, eta, a, inc, boostmatrix, bvec, alpha_zeta, compute_V=False):
     """
-    Numerical: get rs from rho, varphi, inc, a, and subimage index n.
+    Original formulation of emissivity_block with per-pixel (4,4) tetrad and boost matrices,
+    kept as the reference for test_emissivity_block.
+    """
+    zeros = np.zeros_like(r)
+    #I realize how bad this looks, but computing everything here without using
+    #helper functions helps minimize the number of array operations
+
+    rteta = np.sqrt(eta)
+    rpowneg2 = 1/r**2
+    rasqsum = r**2+a**2
+    bigDelta = rasqsum-2*r
+    ralamnum = rasqsum - a*lam
+    ralamnumdDelta = ralamnum/bigDelta
+    bigXi = rasqsum**2 - bigDelta * a**2 #note Xi is being evaluated at theta = pi/2
+    littleomega = 2*a*r/bigXi
+    rtbigR = np.sqrt(ralamnum**2 - bigDelta*(eta+(a-lam)**2))
+    rtXiDelta = np.sqrt(bigXi/bigDelta)/r
+
+    #lowered
+    pt_low = -1*np.ones_like(r)
+    pr_low = signpr * rtbigR/bigDelta
+
+    # pr_low[pr_low>10] = 10
+    # pr_low[pr_low<-10] = -10
+    pphi_low = lam
+    ptheta_low = signptheta*rteta
+
+    prep = np.array([pt_low,pr_low,ptheta_low,pphi_low])
+    plowers = np.expand_dims(np.transpose(prep),2)
+    # plowers = np.array(np.hsplit(np.array([pt_low, pr_low, ptheta_low, pphi_low]),npix))
+
+    #raised
+    pt = rpowneg2 * (-a*(a-lam) + rasqsum * ralamnumdDelta)
+    pr = signpr * rpowneg2 * rtbigR
+    pphi = rpowneg2 * (-(a-lam)+a*ralamnumdDelta)
+    ptheta = signptheta*rteta *rpowneg2
+
+    # praised.append([pt_up, pr_up, pphi_up, ptheta_up])
+    #now everything to generate polarization
+
+    emutetrad = np.array([[rtXiDelta, zeros, zeros, littleomega*rtXiDelta], [zeros, np.sqrt(bigDelta)/r, zeros, zeros], [zeros, zeros, zeros, r/np.sqrt(bigXi)], [zeros, zeros, -1/r, zeros]])
+    emutetrad = np.transpose(emutetrad,(2,0,1))
+    #fluid frame tetrad
+    coordtransform = np.matmul(np.matmul(minkmetric, boostmatrix), emutetrad)
+    coordtransforminv = np.transpose(np.matmul(boostmatrix, emutetrad), (0,2, 1))
+    rs = r
+    pupperfluid = np.matmul(coordtransform, plowers)
+    redshift = 1 / (pupperfluid[:,0,0])
+    lp = np.abs(pupperfluid[:,0,0]/pupperfluid[:,3,0])
+    lp = np.real(np.nan_to_num(lp))
+
+    #fluid frame polarization
+    pspatialfluid = pupperfluid[:,1:]
+    # print(pspatialfluid)
+    # print(pspatialfluid.shape)
+    # pspatialnorm = np.sqrt(np.sum(pspatialfluid[:,:,0]**2,axis=1))
+    fupperfluid = np.cross(pspatialfluid, bvec, axisa = 1)
+    # fupcopy = fupperfluid.copy()
+    fupperfluid[:,0,0] = fupperfluid[:,0,0] *redshift#/ pspatialnorm#would normally be a bmag here
+    fupperfluid[:,0,1] = fupperfluid[:,0,1] *redshift#/ pspatialnorm
+    fupperfluid[:,0,2] = fupperfluid[:,0,2] *redshift#/ pspatialnorm
+    sinzeta = np.sqrt(np.sum(fupperfluid[:,0,:]**2,axis=1))
+    # print(fupperfluid.shape)
+    # fupperfluid = fupperfluid / pspatialnorm
+    # print(pupperfluid[:,0,0]-pspatialnorm)
+    fupperfluid = np.insert(fupperfluid, 0, 0, axis=2)# / (np.linalg.norm(pupperfluid[1:]))
+    fupperfluid = np.swapaxes(fupperfluid, 1,2)
+
+    if compute_V:
+        vvec = np.dot(np.swapaxes(pspatialfluid,1,2), bvec).T[0]#/pspatialnorm
+    else:
+        vvec = zeros
+    #apply the tetrad to get kerr f
+    kfuppers = np.matmul(coordtransforminv, fupperfluid)
+
+
+    kft = kfuppers[:,0,0]
+    kfr = kfuppers[:,1,0]
+    kftheta = kfuppers[:,2,0]
+    kfphi = kfuppers[:, 3,0]
+    spin = a
+    #kappa1 and kappa2
+    prekappa1 = (pt * kfr - pr * kft) + spin * (pr * kfphi - pphi * kfr)
+    prekappa2 = rasqsum * (pphi * kftheta - ptheta * kfphi) - spin * (pt * kftheta - ptheta * kft)
+    kappa1 = rs * prekappa1
+    kappa2 = -rs * prekappa2
+    # kappa1 = np.clip(np.real(kappa1), -20, 20)
+
+    #screen appearance
+    nu = -(alpha + spin * np.sin(inc))
+
+    norm = np.sqrt((nu**2 + beta**2) * (kappa1**2+kappa2**2))/sinzeta**((alpha_zeta+1)/2)
+    ealpha = (beta * kappa2 - nu * kappa1) / norm  
+    ebeta = (beta * kappa1 + nu * kappa2) / norm 
+
+    qvec = -(ealpha**2 - ebeta**2)
+    uvec = -2*ealpha*ebeta
+
+    # qvec *= lp
+    # uvec *= lp
+    qvec = np.real(np.nan_to_num(qvec))
+    uvec = np.real(np.nan_to_num(uvec))
+    if compute_V:
+        vvec = np.real(np.nan_to_num(vvec))
+    redshift = np.real(np.nan_to_num(redshift))
+    ivec = np.sqrt(qvec**2+uvec**2)
+    return ivec, qvec, uvec, vvec, redshift, lp
+
+
+def test_emissivity_block(npix=60, tol=1e-10):
+    """
+    Check emissivity_block, with and without intensity_only, against the matrix formulation
+    in emissivity_block_matrix on ray traced grids over a few geometries and fluid models.
+    """
+    rho, varphi = get_rho_varphi_from_FOV_npix(20., npix, nmax=1)
+    maxerr = 0.
+    for a, inc in [(-0.5, 0.3), (0.94, 1.2), (0.3, 2.8)]:
+        rvecs, phivecs, tvecs, signprs, signpthetas, alphas, betas, lams, etas, adap_masks = ray_trace_all(rho, 1., varphi, inc, a, 1)
+        for boost, chi, fluid_eta, iota in [(0.5, -2.3, None, np.pi/2), (0.2, 0.7, 1.1, 0.6), (0., 0., np.pi, 0.2)]:
+            if fluid_eta is None:
+                fluid_eta = chi+np.pi
+            bz = np.cos(iota)
+            bvec = np.array([np.sqrt(1-bz**2)*np.cos(fluid_eta), np.sqrt(1-bz**2)*np.sin(fluid_eta), bz])
+            boostmatrix = getlorentzboost(-boost, chi)
+            for n in range(2):
+                args = (rvecs[n], signprs[n], signpthetas[n], alphas[n], betas[n], lams[n], etas[n], a, inc, boostmatrix, bvec, 1.)
+                new = emissivity_block(*args, compute_V=True)
+                old = emissivity_block_matrix(*args, compute_V=True)
+                ionly = emissivity_block(*args, intensity_only=True)
+                for x, y in zip(new+(ionly[0], ionly[4], ionly[5]), old+(old[0], old[4], old[5])):
+                    scale = np.max(np.abs(y))
+                    if scale > 0:
+                        maxerr = max(maxerr, np.max(np.abs(x-y))/scale)
+    print("Max error relative to the largest value of each output: "+str(maxerr))
+    if maxerr > tol:
+        raise Exception("emissivity_block does not match emissivity_block_matrix!")
+
+
+def emissivity_from_geometry(geometry, mudists, a, inc, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, adap_fac = 1, compute_V=False, chunk_size=None, max_memory=None, nthreads=None, intensity_only=False):
     """
-    rvecs, phivecs, tvecs, signprs, signpthetas, alphas, betas, lams, etas, adap_masks = ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = adap_fac, axisymmetric=axisymmetric, stationary=stationary, nmin=0, r_o=r_o)
-    ivecs, qvecs, uvecs, vvecs, redshifts, lps = emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=compute_V)
+    Given the output of ray_trace_all, evaluate the fluid emissivity model and
+    place adaptive subimages back on their full grids. The geometry is not modified,
+    so it can be reused across fluid parameters.
+    """
+    rvecs, phivecs, tvecs, signprs, signpthetas, alphas, betas, lams, etas, adap_masks = geometry
+    ivecs, qvecs, uvecs, vvecs, redshifts, lps = emissivity_model_sep_lp(rvecs, phivecs, signprs, signpthetas, alphas, betas, lams, etas, a, inc, boost, chi, fluid_eta, iota, spec, alpha_zeta, compute_V=compute_V, chunk_size=chunk_size, max_memory=max_memory, nthreads=nthreads, intensity_only=intensity_only)
+    rvecs = list(rvecs)
+    phivecs = list(phivecs)
+    tvecs = list(tvecs)
     if adap_fac > 1 and nmax > 0:
         for n in range(1,nmax+1):
             newsize = (adap_fac**n)**2*len(mudists[0])
@@ -817,3 +1070,11 @@ def kerr_exact_sep_lp(mudists, MoDuas, varphi, inc, a, nmax, boost, chi, fluid_e
             redshifts[n] = sub_in_adap(newsize, adap_masks[n], redshifts[n])
             lps[n] = sub_in_adap(newsize, adap_masks[n], lps[n])
     return rvecs, phivecs, tvecs, ivecs, qvecs, uvecs, vvecs, redshifts, lps
+
+
+def kerr_exact_sep_lp(mudists, MoDuas, varphi, inc, a, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, adap_fac = 1, compute_V=False, axisymmetric=True, stationary=True, r_o=np.inf, use_numba=False, symmetric=False, chunk_size=None, max_memory=None, nthreads=None, intensity_only=False):
+    """
+    Numerical: get rs from rho, varphi, inc, a, and subimage index n.
+    """
+    geometry = ray_trace_all(mudists, MoDuas, varphi, inc, a, nmax, adap_fac = adap_fac, axisymmetric=axisymmetric, stationary=stationary, nmin=0, r_o=r_o, use_numba=use_numba, symmetric=symmetric, chunk_size=chunk_size, max_memory=max_memory, nthreads=nthreads)
+    return emissivity_from_geometry(geometry, mudists, a, inc, nmax, boost, chi, fluid_eta, iota, spec, alpha_zeta, adap_fac=adap_fac, compute_V=compute_V, chunk_size=chunk_size, max_memory=max_memory, nthreads=nthreads, intensity_only=intensity_only)
@@ -0,0 +1,622 @@
+"""
+Standalone likelihood for KerrBam.
+
+A Likelihood copies from a model-mode KerrBam and an observation everything its calls need: an
+ImageModel with the screen grid and image settings, the uv points of each data term with their
+Fourier engines, and the data, sigmas and design matrices. Its arrays are read-only and its caches
+belong to the calling thread, so calls never write to state another thread reads: one instance can
+be shared by threads, asynchronous evaluations and concurrent annealing chains without locks, and it
+pickles without the KerrBam it was built from or the contents of its caches.
+"""
+
+import threading
+import numpy as np
+import ehtim as eh
+from scipy.special import ive
+from bam.inference.model_helpers import isiterable, rice, compact_dft, scale_posterior, LRUCache, FrozenCache
+from bam.inference.fourier import BaselineTable, rotate_uv, engine_key
+from bam.inference.face_on import hankel_vis, bessel_matrix
+from bam.inference.image_model import ImageModel
+from bam.inference.data_helpers import amp_add_syserr, logcamp_add_syserr, cphase_add_syserr, get_cphase_uvpairs, cphase_uvdists, get_logcamp_uvpairs, logcamp_uvdists, get_camp_amp_sigma, get_cphase_vis_sigma, get_minimal_logcamps, get_minimal_cphases
+
+
+#zbl, polfrac, dEVPA and the translation act linearly on the visibilities
+LINEAR_NAMES = ['zbl','xuas','yuas','polfrac','dEVPA']
+
+
+def sample_grid(template, vecs, pa, uv, ttype='nfft', engines=None):
+    """
+    Visibilities at uv of the flattened images in vecs, [i] or [i, q, u, v], on the grid of the
+    ehtim Image template rotated by pa. An engine of engines planned for template and uv is used
+    when there is one; otherwise the direct transform goes through compact_dft, and other
+    transforms through ehtim on a copy of template, which itself is never modified.
+    """
+    if engines is not None:
+        engine = engines.get(engine_key(template, uv))
+        if engine is not None:
+            return engine.vis(vecs)
+    if ttype == 'direct':
+        filled = [i for i in range(len(vecs)) if len(vecs[i]) and np.any(vecs[i])]
+        out = [np.zeros(len(uv)) for vec in vecs]
+        if len(filled) > 0:
+            vis = compact_dft([vecs[i] for i in filled], template.psize, template.xdim, template.ydim, rotate_uv(uv, pa), template.pulse)
+            for i, visi in zip(filled, vis):
+                out[i] = visi
+        return out
+    im = template.copy()
+    im.ivec = vecs[0]
+    if len(vecs) > 1:
+        im.qvec, im.uvec, im.vvec = vecs[1:]
+    im.pa = pa
+    return im.sample_uv(uv, ttype=ttype)[:len(vecs)]
+
+
+class Likelihood:
+    """
+    Log likelihood of the data terms in data_types of obs under a model-mode KerrBam kb, whose
+    modelim must be set; the options are those of KerrBam.build_likelihood. Call it on a list of
+    values of modeled_names, or use batch for the rows of a matrix.
+    Everything is copied from kb and obs when the Likelihood is built, and it cannot be modified
+    afterwards. Unit-flux visibilities are cached as by the caches of kb, keyed on the parameters
+    that change the image shape or orientation, in a cache of cache_size entries for each thread.
+    """
+    def __init__(self, kb, obs, data_types=['vis'], ttype='nfft', debias=True, compute_minimal=True, load_recent=False, marginalize_zbl=False, zbl_prior=None):
+        if kb.mode != 'model':
+            raise Exception("A likelihood needs a KerrBam in model mode.")
+        if kb.modelim is None:
+            raise Exception("Set this KerrBam's modelim, e.g. with make_modelim, before building a likelihood.")
+        if marginalize_zbl:
+            if not isiterable(kb.all_param_dict['zbl']):
+                raise Exception("marginalize_zbl needs a modeled zbl, whose bounds set its uniform prior.")
+            if kb.rice_amps and 'amp' in data_types:
+                raise Exception("Rice amplitudes are not Gaussian in zbl, so it cannot be marginalized analytically.")
+            print("Marginalizing zbl analytically.")
+            self.zbl_bounds = kb.all_param_dict['zbl']
+        self.marginalize_zbl = marginalize_zbl
+        self.zbl_prior = zbl_prior
+        self.marginalized_names = ['zbl'] if marginalize_zbl else []
+        self.all_names = list(kb.all_names)
+        self.all_param_dict = dict(kb.all_param_dict)
+        self.modeled_names = [kb.all_names[i] for i in kb.modeled_indices if not kb.all_names[i] in self.marginalized_names]
+        self.jarg_names = list(kb.jarg_names)
+        self.imparam_names = list(kb.imparam_names)
+        self.data_types = list(data_types)
+        self.ttype = ttype
+        self.debias = debias
+        self.compute_minimal = compute_minimal
+        self.error_modeling = kb.error_modeling
+        self.rice_amps = kb.rice_amps
+        self.model = ImageModel(kb)
+        self.cache_size = kb.cache_size
+        self.local = threading.local()
+
+        u = obs.data['u']
+        v = obs.data['v']
+        self.u = u
+        self.v = v
+        self.uvdists = np.sqrt(u**2+v**2)
+        self.visuv = np.vstack([u,v]).T
+        syserr = {'fractional':kb.f, 'additive':kb.e, 'var_a':kb.var_a, 'var_b':kb.var_b, 'var_c':kb.var_c, 'var_u0':kb.var_u0}
+        self.face_on = kb.face_on and all([dt in ['vis','amp','logcamp','cphase'] for dt in data_types])
+        if kb.face_on and not self.face_on:
+            print("The face-on fast path only computes Stokes I. Using the model image for this likelihood.")
+        #closure and amplitude data only constrain Stokes I, so the polarized emissivity can be skipped
+        self.intensity_only = all([dt in ['vis','amp','logcamp','cphase'] for dt in data_types])
+        self.native_vis = kb.native_vis and not self.face_on
+        if self.native_vis:
+            self.templates = kb.make_subimages(kb.modelim)
+            print("Computing visibilities of each subimage at its native resolution.")
+        else:
+            self.templates = [kb.modelim.copy()]
+
+        if 'vis' in data_types:
+            self.vis = obs.data['vis']
+            self.sigma = obs.data['sigma']
+            self.amp = obs.unpack('amp',debias=debias)['amp']
+            if not(self.error_modeling) and kb.adding_syserr:
+                _, self.sigma = amp_add_syserr(self.amp, self.sigma, u = self.uvdists, **syserr)
+            print("Building vis likelihood!")
+        if 'qvis' in data_types:
+            self.qvis = obs.data['qvis']
+            self.qsigma = obs.data['qsigma']
+            self.qamp = np.abs(self.qvis)
+        if 'uvis' in data_types:
+            self.uvis = obs.data['uvis']
+            self.usigma = obs.data['usigma']
+            self.uamp = np.abs(self.uvis)
+        if 'vvis' in data_types:
+            self.vvis = obs.data['vvis']
+            self.vsigma = obs.data['vsigma']
+            self.vamp = np.abs(self.vvis)
+        if 'mvis' in data_types:
+            self.vis = obs.data['vis']
+            qvis = obs.data['qvis']
+            uvis = obs.data['uvis']
+            self.pvis = qvis+1j*uvis
+            self.sigma = obs.data['sigma']
+            self.amp = obs.unpack('amp', debias=debias)['amp']
+            if not(self.error_modeling) and kb.adding_syserr:
+                _, self.sigma = amp_add_syserr(self.amp, self.sigma, u = self.uvdists, **syserr)
+            self.mvis = self.pvis/self.vis
+            self.msigma = self.sigma * np.sqrt(2/np.abs(self.vis)**2 + np.abs(self.pvis)**2 / np.abs(self.vis)**4)
+            self.mvis_ln_norm = -2*np.sum(np.log((2.0*np.pi)**0.5*self.msigma))
+        if 'amp' in data_types:
+            self.sigma = obs.data['sigma']
+            self.amp = obs.unpack('amp', debias=debias)['amp']
+            ampuv = np.vstack([u,v]).T
+            print("Building amp likelihood!")
+        if 'logcamp' in data_types:
+            print("Building logcamp likelihood!")
+            if compute_minimal:
+                if load_recent:
+                    logcamp_data = np.genfromtxt('logcamps.txt',dtype=None,names=['time','t1','t2','t3','t4','u1','u2','u3','u4','v1','v2','v3','v4','camp','sigmaca'])
+                    self.logcamp_design_mat = np.loadtxt('logcamp_design_matrix.txt')
+                    logcamp_uvpairs = np.loadtxt('logcamp_uvpairs.txt')
+                else:
+                    logcamp_data, self.logcamp_design_mat, logcamp_uvpairs = get_minimal_logcamps(obs,debias=debias)
+            else:
+                logcamp_data = obs.c_amplitudes(ctype='logcamp', debias=debias)
+            self.logcamp = logcamp_data['camp']
+            self.logcamp_sigma = logcamp_data['sigmaca']
+            campuv1, campuv2, campuv3, campuv4 = get_logcamp_uvpairs(logcamp_data)
+            if self.error_modeling or kb.adding_syserr:
+                print("Back-fetching quadrangle ampltudes and sigmas.")
+                self.camp_amps = get_camp_amp_sigma(obs, logcamp_data)
+                self.camp_uvdists = logcamp_uvdists(logcamp_data)
+                print("Done!")
+            if not(self.error_modeling):
+                if kb.adding_syserr:
+                    _, self.logcamp_sigma = logcamp_add_syserr(*self.camp_amps, *self.camp_uvdists, debias=debias, **syserr)
+                self.logcamp_ln_norm = -np.sum(np.log((2.0*np.pi)**0.5 * self.logcamp_sigma))
+        if 'cphase' in data_types:
+            print("Building cphase likelihood!")
+            if compute_minimal:
+                if load_recent:
+                    cphase_data = np.genfromtxt('cphases.txt',dtype=None,names=['time','t1','t2','t3','u1','u2','u3','v1','v2','v3','cphase','sigmacp'])
+                    self.cphase_design_mat = np.loadtxt('cphase_design_matrix.txt')
+                    cphase_uvpairs = np.loadtxt('cphase_uvpairs.txt')
+                else:
+                    cphase_data, self.cphase_design_mat, cphase_uvpairs = get_minimal_cphases(obs)
+            else:
+                cphase_data = obs.c_phases(ang_unit='rad')
+            cphaseuv1, cphaseuv2, cphaseuv3 = get_cphase_uvpairs(cphase_data)
+            self.cphase = cphase_data['cphase']
+            self.cphase_sigma = cphase_data['sigmacp']
+            if self.error_modeling or kb.adding_syserr:
+                print("Back-fetching triangle amplitudes and sigmas.")
+                v1, v2, v3, v1err, v2err, v3err = get_cphase_vis_sigma(obs, cphase_data)
+                self.cphase_amps = (v1, v2, v3, np.abs(v1err), np.abs(v2err), np.abs(v3err))
+                self.cphase_uvdists = cphase_uvdists(cphase_data)
+                print("Done!")
+            if not(self.error_modeling):
+                if kb.adding_syserr:
+                    _, self.cphase_sigma = cphase_add_syserr(*self.cphase_amps, *self.cphase_uvdists, **syserr)
+                self.cphase_ln_norm = -np.sum(np.log(2.0*np.pi*ive(0, 1.0/(self.cphase_sigma)**2)))
+
+        #amplitude and closure terms, and vis without polarized terms, only need Stokes I at points that
+        #largely repeat each other, so their model visibilities come from one table of unique baselines
+        self.polvis = any([dt in ['qvis','uvis','vvis','mvis'] for dt in data_types])
+        shared_uv = {}
+        if 'vis' in data_types and not self.polvis:
+            shared_uv['vis'] = self.visuv
+        if 'amp' in data_types:
+            shared_uv['amp'] = ampuv
+        if 'logcamp' in data_types:
+            if compute_minimal:
+                shared_uv['logcamp'] = logcamp_uvpairs
+            else:
+                shared_uv.update({'campuv1':campuv1, 'campuv2':campuv2, 'campuv3':campuv3, 'campuv4':campuv4})
+        if 'cphase' in data_types:
+            if compute_minimal:
+                shared_uv['cphase'] = cphase_uvpairs
+            else:
+                shared_uv.update({'cphaseuv1':cphaseuv1, 'cphaseuv2':cphaseuv2, 'cphaseuv3':cphaseuv3})
+        if len(shared_uv) > 0:
+            self.table = BaselineTable(shared_uv)
+            print("Sharing "+str(len(self.table.uv))+" unique baselines between "+str(np.sum([len(uv) for uv in shared_uv.values()]))+" uv points.")
+        else:
+            self.table = None
+        self.shared_vis = self.table is not None and 'vis' in self.table.names
+
+        self.linear_jargs = list(kb.linear_jargs)
+        if self.face_on and len(self.linear_jargs) > 0:
+            print("The face-on fast path normalizes every profile. Evaluating linear jargs directly.")
+            self.linear_jargs = []
+        #the uv points and, with a fixed PA, the image orientation stay the same for every call,
+        #so the transforms are planned once: precomputed DFT matrices for small grids, FFT gridding for large ones
+        self.engines = None
+        if ttype in ['nfft','direct'] and not self.face_on and not kb.mass_invariant and not 'PA' in self.modeled_names:
+            uvsets = []
+            if self.polvis:
+                uvsets.append(self.visuv)
+            if self.table is not None:
+                uvsets.append(self.table.uv)
+            for im in self.templates:
+                im.pa = self.all_param_dict['PA']
+            self.engines = kb.build_fourier_engines(self.templates, uvsets, ttype=ttype)
+        #Bessel matrices of the face-on path at the table points, which only move with MoDuas in mass-invariant mode
+        self.bessels = None
+        if self.face_on and not kb.mass_invariant:
+            rho = kb.face_on_rho*eh.RADPERUAS
+            q = np.sqrt(self.table.uv[:,0]**2 + self.table.uv[:,1]**2)
+            self.bessels = FrozenCache([((order, self.table.uv.tobytes()), bessel_matrix(order, q, rho)) for order in set([abs(m) for m in kb.face_on_window])])
+
+        self.freeze()
+
+    def freeze(self):
+        for value in self.__dict__.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        object.__setattr__(self, '_frozen', True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Likelihood objects cannot be modified once built; build a new one instead.")
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        #thread-local caches stay behind; a copy starts with empty ones
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__['local'] = threading.local()
+        self.freeze()
+
+    def visibility_cache(self):
+        """
+        The visibility cache of the calling thread.
+        """
+        if not hasattr(self.local, 'visibility_cache'):
+            self.local.visibility_cache = LRUCache(self.cache_size)
+        return self.local.visibility_cache
+
+    def cache_info(self):
+        """
+        Return hit and miss counts for the geometry, emissivity and visibility caches of the calling thread.
+        """
+        info = self.model.cache_info()
+        info['visibility'] = self.visibility_cache().info()
+        return info
+
+    def build_eval(self, params):
+        """
+        KerrBam.build_eval for the modeled parameters of this likelihood.
+        """
+        to_eval = dict()
+        for name in self.all_names:
+            if not(name in self.modeled_names):
+                to_eval[name] = self.all_param_dict[name]
+            else:
+                to_eval[name] = params[self.modeled_names.index(name)]
+        to_eval['jargs'] = [to_eval.pop(jn) for jn in self.jarg_names]
+        return to_eval
+
+    def prepare(self, params):
+        to_eval = self.build_eval(params)
+        if self.marginalize_zbl:
+            to_eval['zbl'] = 1.
+        return to_eval
+
+    def model_images(self, to_eval, imparams, normalize=True):
+        """
+        Stokes vectors [i, q, u, v] of the image of imparams on each template grid, or its face-on
+        Stokes I profile.
+        """
+        if self.face_on:
+            return self.model.face_on_profile(imparams)
+        if self.native_vis:
+            ivecs, qvecs, uvecs, vvecs = self.model.image(imparams, intensity_only=self.intensity_only, native=True, normalize=normalize)
+            return [[ivecs[n], qvecs[n], uvecs[n], vvecs[n]] for n in range(len(ivecs))]
+        ivecs, qvecs, uvecs, vvecs = self.model.image(imparams, intensity_only=self.intensity_only, normalize=normalize)
+        return [[np.sum(ivecs,axis=0), np.sum(qvecs,axis=0), np.sum(uvecs,axis=0), np.sum(vvecs,axis=0)]]
+
+    def transform(self, to_eval, imparams, normalize=True):
+        """
+        Visibilities of the image of imparams at the uv points of this likelihood,
+        and without normalize also its total flux.
+        """
+        images = self.model_images(to_eval, imparams, normalize=normalize)
+        #in mass-invariant mode the model image is in units of M, so MoDuas rescales the uv plane
+        if self.model.mass_invariant:
+            uvscale = to_eval['MoDuas']
+        else:
+            uvscale = 1.
+        unitvis = {}
+        if self.face_on:
+            harmonics = dict([(m, window*images) for m, window in self.model.face_on_window.items()])
+            unitvis['table'] = hankel_vis(self.model.face_on_rho*eh.RADPERUAS, self.model.face_on_drho*eh.RADPERUAS, harmonics, self.table.uv*uvscale, rotation=to_eval['PA'], cache=self.bessels)
+            return unitvis
+        if self.table is not None:
+            unitvis['table'] = np.sum([sample_grid(im, [vecs[0]], to_eval['PA'], self.table.uv*uvscale, ttype=self.ttype, engines=self.engines)[0] for im, vecs in zip(self.templates, images)], axis=0)
+        if self.polvis:
+            unitvis['allvis'] = np.sum([np.array(sample_grid(im, vecs, to_eval['PA'], self.visuv*uvscale, ttype=self.ttype, engines=self.engines)) for im, vecs in zip(self.templates, images)], axis=0)
+        if not normalize:
+            unitvis['flux'] = np.sum([np.sum(vecs[0]) for vecs in images])
+        return unitvis
+
+    def transform_batch(self, jobs):
+        """
+        transform for each (to_eval, imparams, normalize) in jobs. With Fourier engines planned,
+        the images of all jobs are stacked and transformed in one matrix product per engine.
+        """
+        if self.engines is None or len(jobs) == 0:
+            return [self.transform(*job) for job in jobs]
+        vecsets = [self.model_images(*job) for job in jobs]
+        out = [{} for job in jobs]
+        if self.table is not None:
+            vis = np.sum([self.engines[engine_key(im, self.table.uv)].vis([vecs[g][0] for vecs in vecsets]) for g, im in enumerate(self.templates)], axis=0)
+            for j in range(len(jobs)):
+                out[j]['table'] = vis[j]
+        if self.polvis:
+            vis = np.sum([self.engines[engine_key(im, self.visuv)].vis([vec for vecs in vecsets for vec in vecs[g]]) for g, im in enumerate(self.templates)], axis=0)
+            for j in range(len(jobs)):
+                out[j]['allvis'] = vis[4*j:4*j+4]
+        for j in range(len(jobs)):
+            if not jobs[j][2]:
+                out[j]['flux'] = np.sum([np.sum(vecs[0]) for vecs in vecsets[j]])
+        return out
+
+    #zbl, polfrac, dEVPA and the translation act linearly on the visibilities, so the model is
+    #transformed at unit flux and polarization fraction, and only again when its shape or PA changes;
+    #the image is also affine in the linear jargs, so they are left out of the key and combined later
+    def vis_key(self, to_eval):
+        jargs = to_eval['jargs']
+        return tuple([tuple([jargs[i] for i in range(len(jargs)) if not i in self.linear_jargs]) if ipn == 'jargs' else to_eval[ipn] for ipn in self.imparam_names if not ipn in LINEAR_NAMES])
+
+    def unit_jobs(self, to_eval):
+        """
+        The transform jobs behind the unit visibilities of to_eval: one at unit flux, or with linear
+        jargs, one unnormalized image with every linear jarg at zero, then one per linear jarg set to one.
+        """
+        imparams = [1. if ipn in ['zbl','polfrac'] else 0. if ipn == 'dEVPA' else to_eval[ipn] for ipn in self.imparam_names]
+        if len(self.linear_jargs) == 0:
+            return [(to_eval, imparams, True)]
+        jobs = []
+        for k in range(len(self.linear_jargs)+1):
+            basis_jargs = list(to_eval['jargs'])
+            for j, i in enumerate(self.linear_jargs):
+                basis_jargs[i] = 1. if j == k-1 else 0.
+            jobs.append((to_eval, imparams[:-1]+[basis_jargs], False))
+        return jobs
+
+    def collect(self, parts):
+        if len(self.linear_jargs) == 0:
+            return parts[0]
+        unitvis = {}
+        for name in parts[0].keys():
+            stacked = np.array([part[name] for part in parts])
+            stacked[1:] -= stacked[0]
+            unitvis[name] = stacked
+        return unitvis
+
+    def combine(self, to_eval, unitvis):
+        """
+        The unit visibilities of to_eval from those of its linear jarg basis, or None if its
+        image has no positive total flux to normalize by.
+        """
+        if len(self.linear_jargs) == 0:
+            return unitvis
+        jargs = to_eval['jargs']
+        weights = np.concatenate([[1.], [jargs[i] for i in self.linear_jargs]])
+        flux = weights.dot(unitvis['flux'])
+        if not flux > 0:
+            return None
+        return dict([(name, np.tensordot(weights, unitvis[name], axes=1)/flux) for name in unitvis.keys() if name != 'flux'])
+
+    def evaluate(self, to_eval, unitvis, zbl_conditional=False):
+        """
+        The log likelihood of to_eval, given the unit visibilities of its image. With zbl marginalized
+        and zbl_conditional, the conditional posterior of zbl as from scale_posterior instead.
+        Without unit visibilities, the image could not be normalized and to_eval is ruled out.
+        """
+        if unitvis is None:
+            if self.marginalize_zbl and zbl_conditional:
+                #the data say nothing about zbl, so its conditional posterior is its prior
+                return scale_posterior(np.zeros(3), self.zbl_bounds, prior=self.zbl_prior)[:4]+(-np.inf,)
+            return -np.inf
+        data_types = self.data_types
+        table = self.table
+        u, v = self.u, self.v
+        out = 0.
+        quad = np.zeros(3) if self.marginalize_zbl else None
+        zbl = to_eval['zbl']
+        if self.error_modeling:
+            syserr = {'fractional':to_eval['f'], 'additive':to_eval['e'], 'var_a':to_eval['var_a'], 'var_b':to_eval['var_b'], 'var_c':to_eval['var_c'], 'var_u0':to_eval['var_u0']}
+        if table is not None:
+            table_ivis = zbl*unitvis['table']
+        if self.shared_vis:
+            translation_phasor = np.exp(-1j*2*np.pi*(u*to_eval['xuas']+v*to_eval['yuas'])*eh.RADPERUAS)
+            model_ivis = table.lookup(table_ivis, 'vis') * translation_phasor
+        elif self.polvis:
+            model_ivis, model_qvis, model_uvis, model_vvis = unitvis['allvis']
+            #dEVPA rotates Q+iU in the image plane, which mixes the Q and U visibilities
+            pfac = zbl*to_eval['polfrac']
+            cos2 = np.cos(2*to_eval['dEVPA'])
+            sin2 = np.sin(2*to_eval['dEVPA'])
+            model_ivis, model_qvis, model_uvis, model_vvis = zbl*model_ivis, pfac*(cos2*model_qvis-sin2*model_uvis), pfac*(sin2*model_qvis+cos2*model_uvis), pfac*model_vvis
+            if 'mvis' in data_types:
+                model_mvis = (model_qvis+1j*model_uvis)/model_ivis
+            translation_phasor = np.exp(-1j*2*np.pi*(u*to_eval['xuas']+v*to_eval['yuas'])*eh.RADPERUAS)
+            model_ivis = model_ivis * translation_phasor
+            model_qvis = model_qvis * translation_phasor
+            model_uvis = model_uvis * translation_phasor
+            model_vvis = model_vvis * translation_phasor
+
+        if 'vis' in data_types:
+            if self.error_modeling:
+                _, sd = amp_add_syserr(self.amp, self.sigma, u = self.uvdists, **syserr)
+            else:
+                sd = self.sigma
+            vislike = -0.5 * chisq(model_ivis, self.vis, sd, quad)
+            ln_norm = vislike-2*np.sum(np.log((2.0*np.pi)**0.5 * sd))
+            out+=ln_norm
+        if 'qvis' in data_types:
+            if self.error_modeling:
+                _, sd = amp_add_syserr(self.qamp, self.qsigma, u = self.uvdists, **syserr)
+            else:
+                sd = self.qsigma
+            qvislike = -0.5 * chisq(model_qvis, self.qvis, sd, quad)
+            ln_norm = qvislike-2*np.sum(np.log((2.0*np.pi)**0.5*sd))
+            out += ln_norm
+        if 'uvis' in data_types:
+            if self.error_modeling:
+                _, sd = amp_add_syserr(self.uamp, self.usigma, u = self.uvdists, **syserr)
+            else:
+                sd = self.usigma
+            uvislike = -0.5 * chisq(model_uvis, self.uvis, sd, quad)
+            ln_norm = uvislike-2*np.sum(np.log((2.0*np.pi)**0.5*sd))
+            out += ln_norm
+        if 'vvis' in data_types:
+            if self.error_modeling:
+                _, sd = amp_add_syserr(self.vamp, self.vsigma, u = self.uvdists, **syserr)
+            else:
+                sd = self.vsigma
+            vvislike = -0.5 * chisq(model_vvis, self.vvis, sd, quad)
+            ln_norm = vvislike-2*np.sum(np.log((2.0*np.pi)**0.5*sd))
+            out += ln_norm
+        if 'mvis' in data_types:
+            if self.error_modeling:
+                _, sd = amp_add_syserr(self.amp, self.msigma, u = self.uvdists, **syserr)
+                msd = sd * np.sqrt(2/np.abs(self.vis)**2 + np.abs(self.pvis)**2 / np.abs(self.vis)**4)
+                mln = -2*np.sum(np.log((2.0*np.pi)**0.5*msd))
+            else:
+                msd = self.msigma
+                mln = self.mvis_ln_norm
+            mvislike = -0.5 * np.sum(np.abs(model_mvis-self.mvis)**2.0/msd**2)
+            ln_norm = mvislike + mln
+            out+=ln_norm
+        if 'amp' in data_types:
+            if self.error_modeling:
+                _, sd = amp_add_syserr(self.amp, self.sigma, u = self.uvdists, **syserr)
+            else:
+                sd = self.sigma
+            model_amp = np.abs(table.lookup(table_ivis, 'amp'))
+            if self.rice_amps:
+                ricelike = np.sum(np.log(rice(model_amp,sd,self.amp)))
+                out += ricelike
+            else:
+                amplike = -0.5*chisq(model_amp, self.amp, sd, quad)
+                ln_norm = amplike-np.sum(np.log((2.0*np.pi)**0.5 * sd))
+                out+=ln_norm
+        if 'logcamp' in data_types:
+            if self.compute_minimal:
+                model_logcamp = self.logcamp_design_mat.dot(np.log(np.abs(table.lookup(table_ivis, 'logcamp'))))
+            else:
+                camps = [np.log(np.abs(table.lookup(table_ivis, name))) for name in ['campuv1','campuv2','campuv3','campuv4']]
+                model_logcamp = camps[0]+camps[1]-camps[2]-camps[3]
+            if self.error_modeling:
+                _, new_logcamp_err = logcamp_add_syserr(*self.camp_amps, *self.camp_uvdists, debias=self.debias, **syserr)
+                logcamplike = -0.5*np.sum((self.logcamp-model_logcamp)**2/new_logcamp_err**2)
+                ln_norm = logcamplike-np.sum(np.log((2.0*np.pi)**0.5 * new_logcamp_err))
+            else:
+                logcamplike = -0.5*np.sum((self.logcamp-model_logcamp)**2 / self.logcamp_sigma**2)
+                ln_norm = logcamplike + self.logcamp_ln_norm
+            out += ln_norm
+        if 'cphase' in data_types:
+            if self.compute_minimal:
+                model_cphase = self.cphase_design_mat.dot(np.angle(table.lookup(table_ivis, 'cphase')))
+            else:
+                model_cphase = np.sum([np.angle(table.lookup(table_ivis, name)) for name in ['cphaseuv1','cphaseuv2','cphaseuv3']], axis=0)
+            if self.error_modeling:
+                _, new_cphase_err = cphase_add_syserr(*self.cphase_amps, *self.cphase_uvdists, **syserr)
+                cphaselike = -np.sum((1-np.cos(self.cphase-model_cphase))/new_cphase_err**2)
+                ln_norm = cphaselike-np.sum(np.log(2.0*np.pi*ive(0, 1.0/(new_cphase_err)**2)))
+            else:
+                cphaselike = -np.sum((1-np.cos(self.cphase-model_cphase))/self.cphase_sigma**2)
+                ln_norm = cphaselike + self.cphase_ln_norm
+            out += ln_norm
+        if self.marginalize_zbl:
+            mean, std, lo, hi, logz = scale_posterior(quad, self.zbl_bounds, prior=self.zbl_prior)
+            if zbl_conditional:
+                return mean, std, lo, hi, logz
+            out += logz
+        return out
+
+    def __call__(self, params, zbl_conditional=False):
+        to_eval = self.prepare(params)
+        key = self.vis_key(to_eval)
+        cache = self.visibility_cache()
+        unitvis = cache.get(key)
+        if unitvis is None:
+            unitvis = self.collect([self.transform(*job) for job in self.unit_jobs(to_eval)])
+            cache.put(key, unitvis)
+        return self.evaluate(to_eval, self.combine(to_eval, unitvis), zbl_conditional=zbl_conditional)
+
+    def batch(self, params_matrix, zbl_conditional=False):
+        """
+        The log likelihood of each row of params_matrix. The images missing from the visibility
+        cache are computed together and transformed in stacked products.
+        """
+        evals = [self.prepare(params) for params in np.atleast_2d(params_matrix)]
+        keys = [self.vis_key(to_eval) for to_eval in evals]
+        cache = self.visibility_cache()
+        unitvis = {}
+        pending = {}
+        for key, to_eval in zip(keys, evals):
+            if key in unitvis or key in pending:
+                continue
+            cached = cache.get(key)
+            if cached is None:
+                pending[key] = self.unit_jobs(to_eval)
+            else:
+                unitvis[key] = cached
+        parts = self.transform_batch([job for key in pending for job in pending[key]])
+        start = 0
+        for key in pending:
+            unitvis[key] = self.collect(parts[start:start+len(pending[key])])
+            start += len(pending[key])
+            cache.put(key, unitvis[key])
+        out = [self.evaluate(to_eval, self.combine(to_eval, unitvis[key]), zbl_conditional=zbl_conditional) for key, to_eval in zip(keys, evals)]
+        if zbl_conditional:
+            return out
+        return np.array(out)
+
+
+def chisq(model, data, sd, quad):
+    """
+    Chi squared of model against data, or, with zbl marginalized, zero after adding the
+    coefficients of the chi squared as a quadratic in zbl to quad, for a model at unit flux.
+    """
+    if quad is None:
+        return np.sum(np.abs(model-data)**2/sd**2)
+    quad[0] += np.sum(np.abs(model)**2/sd**2)
+    quad[1] += np.sum(np.real(np.conj(model)*data)/sd**2)
+    quad[2] += np.sum(np.abs(data)**2/sd**2)
+    return 0.
+
+
+def test_linear_jarg_flux(npix=16, tol=1e-6):
+    """
+    Check that a likelihood with linear jargs matches one that evaluates them directly where the
+    image has positive flux, and rules out draws whose combined image has none, from a
+    synthetic five-station observation of a ring.
+    """
+    from bam.inference.kerrbam import KerrBam
+    from bam.inference.jfuncs import make_radial_basis_jfunc
+    from ehtim.const_def import DTARR
+    #geocentric positions in m and SEFDs in Jy of ALMA, LMT, SMT, SMA and PV
+    stations = [('AA', 2225061.164, -5440057.370, -2481681.150, 90.), ('LM', -768715.632, -5988507.072, 2063354.852, 5000.),
+                ('AZ', -1828796.200, -5054406.800, 3427865.200, 11000.), ('SM', -5464555.493, -2492927.989, 2150797.176, 4500.),
+                ('PV', 5088967.748, -301681.186, 3825012.206, 1400.)]
+    tarr = np.array([(site, x, y, z, sefd, sefd, 0j, 0j, 0., 0., 0.) for site, x, y, z, sefd in stations], dtype=DTARR)
+    ra, dec = 12.513728717168174, 12.39112323919932
+    empty = eh.array.Array(tarr).obsdata(ra, dec, 230e9, 2e9, 60., 3600., 0., 24., mjd=57854)
+    fov = 60*eh.RADPERUAS
+    jfunc = make_radial_basis_jfunc([3., 5., 7., 9.])
+    names = ['j0','j1','j2','j3']
+    truth = KerrBam(fov, npix, jfunc, names, [0., 1., 0.5, 0.], 3.8, 0.5, 0.3, 0.6)
+    obs = truth.make_image(ra=ra, dec=dec, rf=230e9, mjd=57854).observe_same(empty, ttype='direct', ampcal=True, phasecal=True, seed=4)
+    likes = []
+    for linear_jarg_names in [names, None]:
+        kb = KerrBam(fov, npix, jfunc, names, [[-1., 1.]]*4, 3.8, [-0.9, 0.9], 0.3, 0.6, linear_jarg_names=linear_jarg_names)
+        kb.modelim = kb.make_modelim(ra=obs.ra, dec=obs.dec, rf=obs.rf, mjd=obs.mjd)
+        likes.append(Likelihood(kb, obs, data_types=['vis'], ttype='direct'))
+    draws = np.array([[0.5, 0., 1., 0.5, 0.], [0.5, 0., -1., -0.5, 0.], [0.5, 0., 0., 0., 0.], [0.5, 0.2, 0.5, -0.2, 0.1]])
+    linear = likes[0].batch(draws)
+    direct = np.array([likes[1](draw) for draw in draws[[0, 3]]])
+    print("Log likelihoods with linear jargs: "+str(linear)+", evaluated directly: "+str(direct))
+    if not (np.all(np.isneginf(linear[1:3])) and np.isneginf(likes[0](draws[1])) and np.allclose(linear[[0, 3]], direct, rtol=tol)):
+        raise Exception("Linear jargs do not match direct evaluation, or do not rule out images without positive flux!")
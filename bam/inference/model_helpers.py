@@ -1,10 +1,12 @@
 import numpy as np
 try:
     from collections.abc import Iterable
-except ImportError: 
+except ImportError:
     from collections import Iterable
+from collections import OrderedDict
 
 from scipy.stats import rice as scipy_rice
+from scipy.special import log_ndtr
 
 Gpercsq = 6.67e-11 / (3e8)**2
 M87_ra = 12.513728717168174
@@ -23,6 +25,7 @@ SgrA_MoD = Gpercsq*SgrA_mass / SgrA_dist
 SgrA_MoDuas = SgrA_MoD/RADPERUAS
 
 from skimage.transform import rescale, resize
+from scipy.sparse import csr_matrix, kron as sparse_kron
 
 def rice(nu, sigma, x):
 
@@ -37,12 +40,53 @@ def rice(nu, sigma, x):
     return val
 
 
-def rescale_veclist(veclist,mode='edge',order=1,anti_aliasing=True):
+def resize_operator(subxdim, xdim, order=1, mode='edge'):
+    """
+    Sparse CSR matrix that maps a flattened (subxdim, subxdim) image to its skimage resize to
+    (xdim, xdim) without anti-aliasing. Nearest and bilinear interpolation are separable, so
+    the operator is the Kronecker product of the 1D resize along each axis.
+    """
+    if order > 1:
+        raise Exception("Only interp_order 0 and 1 resizes are linear; higher orders are clipped by skimage.")
+    resize1d = np.array([resize(np.eye(subxdim)[j].reshape((1,subxdim)), (1,xdim), mode=mode, order=order, anti_aliasing=False)[0] for j in range(subxdim)]).T
+    resize1d[np.abs(resize1d) < 1e-15] = 0.
+    resize1d = csr_matrix(resize1d)
+    return sparse_kron(resize1d, resize1d, format='csr')
+
+def rescale_veclists(veclists, mode='edge', order=1, operators=None):
+    """
+    rescale_veclist without anti-aliasing, applied to several lists of subimages that share sizes.
+    With order 0 or 1 and a cache of operators (an LRUCache keyed on source size, target size,
+    order and mode), the subimages of one size from every list are stacked and resampled
+    in a single sparse product. Otherwise each subimage is resized with skimage.
+    """
+    if operators is None or order > 1:
+        return [rescale_veclist(veclist, mode=mode, order=order, anti_aliasing=False) for veclist in veclists]
+    xdim = int(np.sqrt(len(veclists[0][-1])))
+    outlists = [[] for veclist in veclists]
+    for i in range(len(veclists[0])-1):
+        subxdim = int(np.sqrt(len(veclists[0][i])))
+        key = (subxdim, xdim, order, mode)
+        operator = operators.get(key)
+        if operator is None:
+            operator = resize_operator(subxdim, xdim, order=order, mode=mode)
+            operators.put(key, operator)
+        stacked = operator.dot(np.column_stack([veclist[i] for veclist in veclists]))
+        for j in range(len(veclists)):
+            outlists[j].append(stacked[:,j])
+    for j in range(len(veclists)):
+        outlists[j].append(veclists[j][-1])
+    return outlists
+
+def rescale_veclist(veclist,mode='edge',order=1,anti_aliasing=True,operators=None):
     """
     Given a list of flattened arrays which are
     ordered by size, use the last array to rescale all
-    the others.
+    the others. Without anti-aliasing, cached sparse operators can
+    be used instead of skimage; see rescale_veclists.
     """
+    if operators is not None and not anti_aliasing and order <= 1:
+        return rescale_veclists([veclist], mode=mode, order=order, operators=operators)[0]
     ref = veclist[-1]
     xdim = int(np.sqrt(len(ref)))
     outlist = []
@@ -52,6 +96,68 @@ def rescale_veclist(veclist,mode='edge',order=1,anti_aliasing=True):
     outlist.append(ref)
     return outlist
 
+def log_ndtr_diff(a, b):
+    """
+    log(Phi(b) - Phi(a)) for a < b, where Phi is the standard normal CDF, without cancellation in either tail.
+    """
+    if a > 0:
+        a, b = -b, -a
+    return log_ndtr(b) + np.log1p(-np.exp(log_ndtr(a) - log_ndtr(b)))
+
+def scale_posterior(quad, bounds, prior=None):
+    """
+    Given quad = [A, B, C], the coefficients of a chi squared s**2*A - 2*s*B + C in an overall
+    scale s, and a prior on s that is uniform within bounds or, if prior is (mean, std), Gaussian
+    and truncated to s > 0, return the mean, standard deviation, lower and upper bounds of the
+    conditional posterior of s and the log of the integral of exp(-chisq/2) times the prior over s.
+    The truncation matters for amplitudes, which see only |s|, so that s and -s fit them equally well.
+    """
+    A, B, C = quad
+    if prior is not None:
+        A = A + 1/prior[1]**2
+        B = B + prior[0]/prior[1]**2
+        C = C + prior[0]**2/prior[1]**2
+        lo, hi = 0., np.inf
+        lognorm = -0.5*np.log(2*np.pi*prior[1]**2) - log_ndtr(prior[0]/prior[1])
+    else:
+        lo, hi = bounds
+        lognorm = -np.log(hi-lo)
+    if A <= 0:
+        #the model has no flux at the data points, so the likelihood does not depend on s
+        return 0., np.inf, lo, hi, -0.5*C
+    mean = B/A
+    std = 1/np.sqrt(A)
+    logz = -0.5*(C - B*mean) + 0.5*np.log(2*np.pi/A) + lognorm + log_ndtr_diff((lo-mean)/std, (hi-mean)/std)
+    return mean, std, lo, hi, logz
+
+def compact_support(*vecs):
+    """
+    Indices of the pixels where any of the given flattened images is nonzero.
+    """
+    return np.flatnonzero(np.any([np.asarray(vec) != 0 for vec in vecs], axis=0))
+
+def compact_dft(vecs, psize, xdim, ydim, uv, pulse):
+    """
+    Direct Fourier transform of each flattened image in vecs, equal to ehtim's ftmatrix
+    applied to it, but restricted to the pixel rows and columns that hold flux in one of them.
+    The phase separates in x and y, so the transform is a matrix product over those rows
+    and columns. uv should already be rotated by the image pa.
+    """
+    uv = np.atleast_2d(uv)
+    support = compact_support(*vecs)
+    rows = np.unique(support // xdim)
+    cols = np.unique(support % xdim)
+    xlist = np.arange(0, -xdim, -1)*psize + (psize*xdim)/2.0 - psize/2.0
+    ylist = np.arange(0, -ydim, -1)*psize + (psize*ydim)/2.0 - psize/2.0
+    pulsefac = np.fromiter((pulse(2*np.pi*uvpt[0], 2*np.pi*uvpt[1], psize, dom="F") for uvpt in uv), 'c16')
+    xphase = np.exp(2j*np.pi*np.outer(uv[:,0], xlist[cols]))*pulsefac[:,None]
+    yphase = np.exp(2j*np.pi*np.outer(uv[:,1], ylist[rows]))
+    out = []
+    for vec in vecs:
+        sub = np.reshape(vec, (ydim, xdim))[np.ix_(rows, cols)]
+        out.append(np.sum(yphase*xphase.dot(sub.T), axis=1))
+    return out
+
 
 def get_rho_varphi_from_FOV_npix(fov_uas, npix, adap_fac=1, nmax=0):
     """
@@ -132,6 +238,75 @@ def isiterable(object):
     '''
     return isinstance(object, Iterable)
 
+def array_module(x):
+    '''
+    Returns jax.numpy for jax arrays and tracers and numpy otherwise, so that a jfunc written
+    against the returned module also runs inside the differentiable likelihood.
+    '''
+    if type(x).__module__.split('.')[0] in ['jax', 'jaxlib']:
+        import jax.numpy as jnp
+        return jnp
+    return np
+
+
+class LRUCache:
+    """
+    A bounded least-recently-used cache with hit and miss counters.
+    A maxsize of 0 disables storage entirely.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.store = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the value stored under key, or None on a miss.
+        """
+        if key in self.store:
+            self.store.move_to_end(key)
+            self.hits += 1
+            return self.store[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.store[key] = value
+        self.store.move_to_end(key)
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+    def clear(self):
+        self.store.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits':self.hits, 'misses':self.misses, 'size':len(self.store), 'maxsize':self.maxsize}
+
+    def __getstate__(self):
+        #don't ship cached arrays to pool workers or pickles
+        state = self.__dict__.copy()
+        state['store'] = OrderedDict()
+        return state
+
+class FrozenCache:
+    """
+    A read-only stand-in for LRUCache, holding values computed beforehand. get has no side effects
+    and put does nothing, so one instance can be shared between threads; a miss is computed by the caller.
+    """
+    def __init__(self, store):
+        self.store = dict(store)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def put(self, key, value):
+        pass
+
 def quadsum(u, v):
     """ Returns the quadrature sum of arrays u and v.
     """
@@ -0,0 +1,560 @@
+"""
+Compiled per-pixel ray tracing for the Kerr toy model.
+
+This mirrors kerrexact.ray_trace_by_case, but evaluates cases 1-3 and every subimage n
+for a pixel in a single fused loop, parallelized over pixels with numba's prange.
+The elliptic integrals are computed with scalar Carlson symmetric forms (RF, RD, RJ, RC)
+and the Jacobi elliptic functions with the descending Landen (AGM) scheme used by Cephes,
+so no full-size temporaries are created per subimage.
+
+numba is an optional dependency, only imported when this backend is requested
+(use_numba=True in ray_trace_all or KerrBam).
+"""
+
+import math
+import numpy as np
+from numba import njit, prange
+
+phi_o = 3*np.pi/2
+halfpi = 0.5*np.pi
+MACHEP = 1.11022302462515654042e-16
+ERRTOL = 1.e-3
+MAXITER = 100
+
+
+@njit(cache=True, error_model='numpy')
+def carlson_rf(x, y, z):
+    """
+    Carlson's RF(x,y,z) by duplication.
+    """
+    xt = x
+    yt = y
+    zt = z
+    for i in range(MAXITER):
+        sqrtx = math.sqrt(xt)
+        sqrty = math.sqrt(yt)
+        sqrtz = math.sqrt(zt)
+        alamb = sqrtx*(sqrty+sqrtz)+sqrty*sqrtz
+        xt = 0.25*(xt+alamb)
+        yt = 0.25*(yt+alamb)
+        zt = 0.25*(zt+alamb)
+        ave = (xt+yt+zt)/3.
+        delx = (ave-xt)/ave
+        dely = (ave-yt)/ave
+        delz = (ave-zt)/ave
+        if max(abs(delx), abs(dely), abs(delz)) < ERRTOL:
+            break
+    e2 = delx*dely-delz*delz
+    e3 = delx*dely*delz
+    return (1.+(e2/24.-0.1-3.*e3/44.)*e2+e3/14.)/math.sqrt(ave)
+
+
+@njit(cache=True, error_model='numpy')
+def carlson_rc(x, y):
+    """
+    Carlson's RC(x,y), taking the Cauchy principal value for y<0.
+    """
+    if y > 0:
+        xt = x
+        yt = y
+        w = 1.
+    else:
+        xt = x-y
+        yt = -y
+        w = math.sqrt(x)/math.sqrt(xt)
+    for i in range(MAXITER):
+        alamb = 2.*math.sqrt(xt)*math.sqrt(yt)+yt
+        xt = 0.25*(xt+alamb)
+        yt = 0.25*(yt+alamb)
+        ave = (xt+yt+yt)/3.
+        s = (yt-ave)/ave
+        if abs(s) < ERRTOL:
+            break
+    return w*(1.+s*s*(0.3+s*(1./7.+s*(0.375+s*9./22.))))/math.sqrt(ave)
+
+
+@njit(cache=True, error_model='numpy')
+def carlson_rd(x, y, z):
+    """
+    Carlson's RD(x,y,z) = RJ(x,y,z,z) by duplication.
+    """
+    xt = x
+    yt = y
+    zt = z
+    total = 0.
+    fac = 1.
+    for i in range(MAXITER):
+        sqrtx = math.sqrt(xt)
+        sqrty = math.sqrt(yt)
+        sqrtz = math.sqrt(zt)
+        alamb = sqrtx*(sqrty+sqrtz)+sqrty*sqrtz
+        total += fac/(sqrtz*(zt+alamb))
+        fac = 0.25*fac
+        xt = 0.25*(xt+alamb)
+        yt = 0.25*(yt+alamb)
+        zt = 0.25*(zt+alamb)
+        ave = 0.2*(xt+yt+3.*zt)
+        delx = (ave-xt)/ave
+        dely = (ave-yt)/ave
+        delz = (ave-zt)/ave
+        if max(abs(delx), abs(dely), abs(delz)) < ERRTOL:
+            break
+    ea = delx*dely
+    eb = delz*delz
+    ec = ea-eb
+    ed = ea-6.*eb
+    ee = ed+ec+ec
+    c3 = 9./22.
+    c4 = 3./26.
+    return 3.*total+fac*(1.+ed*(-3./14.+0.25*c3*ed-1.5*c4*delz*ee)+delz*(ee/6.+delz*(-c3*ec+delz*c4*ea)))/(ave*math.sqrt(ave))
+
+
+@njit(cache=True, error_model='numpy')
+def carlson_rj(x, y, z, p):
+    """
+    Carlson's RJ(x,y,z,p) by duplication, for p>0.
+    """
+    xt = x
+    yt = y
+    zt = z
+    pt = p
+    total = 0.
+    fac = 1.
+    for i in range(MAXITER):
+        sqrtx = math.sqrt(xt)
+        sqrty = math.sqrt(yt)
+        sqrtz = math.sqrt(zt)
+        alamb = sqrtx*(sqrty+sqrtz)+sqrty*sqrtz
+        alpha = (pt*(sqrtx+sqrty+sqrtz)+sqrtx*sqrty*sqrtz)**2
+        beta = pt*(pt+alamb)**2
+        total += fac*carlson_rc(alpha, beta)
+        fac = 0.25*fac
+        xt = 0.25*(xt+alamb)
+        yt = 0.25*(yt+alamb)
+        zt = 0.25*(zt+alamb)
+        pt = 0.25*(pt+alamb)
+        ave = 0.2*(xt+yt+zt+pt+pt)
+        delx = (ave-xt)/ave
+        dely = (ave-yt)/ave
+        delz = (ave-zt)/ave
+        delp = (ave-pt)/ave
+        if max(abs(delx), abs(dely), abs(delz), abs(delp)) < ERRTOL:
+            break
+    ea = delx*(dely+delz)+dely*delz
+    eb = delx*dely*delz
+    ec = delp*delp
+    ed = ea-3.*ec
+    ee = eb+2.*delp*(ea-ec)
+    c1 = 3./14.
+    c2 = 1./3.
+    c3 = 3./22.
+    c4 = 3./26.
+    return 3.*total+fac*(1.+ed*(-c1+0.75*c3*ed-1.5*c4*ee)+eb*(0.5*c2+delp*(-2.*c3+delp*c4))+delp*ea*(c2-delp*c3)-c2*delp*ec)/(ave*math.sqrt(ave))
+
+
+@njit(cache=True, error_model='numpy')
+def ellipk(m):
+    return carlson_rf(0., 1.-m, 1.)
+
+
+@njit(cache=True, error_model='numpy')
+def ellipe(m):
+    return carlson_rf(0., 1.-m, 1.) - m/3.*carlson_rd(0., 1.-m, 1.)
+
+
+@njit(cache=True, error_model='numpy')
+def ellipkinc(phi, m):
+    """
+    F(phi|m), using F(k*pi + phi2|m) = 2k*K(m) + F(phi2|m) outside [-pi/2, pi/2].
+    """
+    if math.isnan(phi) or math.isnan(m) or math.isinf(phi):
+        return np.nan
+    k = math.floor(phi/np.pi+0.5)
+    phi2 = phi - k*np.pi
+    s = math.sin(phi2)
+    c = math.cos(phi2)
+    F = s*carlson_rf(c*c, 1.-m*s*s, 1.)
+    if k != 0:
+        F += 2.*k*ellipk(m)
+    return F
+
+
+@njit(cache=True, error_model='numpy')
+def ellipeinc(phi, m):
+    """
+    E(phi|m), using E(k*pi + phi2|m) = 2k*E(m) + E(phi2|m) outside [-pi/2, pi/2].
+    """
+    if math.isnan(phi) or math.isnan(m) or math.isinf(phi):
+        return np.nan
+    k = math.floor(phi/np.pi+0.5)
+    phi2 = phi - k*np.pi
+    s = math.sin(phi2)
+    c = math.cos(phi2)
+    y = 1.-m*s*s
+    E = s*carlson_rf(c*c, y, 1.) - m/3.*s*s*s*carlson_rd(c*c, y, 1.)
+    if k != 0:
+        E += 2.*k*ellipe(m)
+    return E
+
+
+@njit(cache=True, error_model='numpy')
+def _carlson_pi(n, phi, m):
+    """
+    Pi(n;phi|m) for -pi/2 <= phi <= pi/2, with the DLMF 19.20.14 transform for rho<0.
+    """
+    s = math.sin(phi)
+    x = math.cos(phi)**2
+    y = 1.-m*s*s
+    rho = 1.-n*s*s
+    CRF = carlson_rf(x, y, 1.)
+    if rho > 0:
+        CRJ = carlson_rj(x, y, 1., rho)
+    else: # transform for rho<0, https://dlmf.nist.gov/19.20#E14 19.20.14
+        q = -rho
+        p = (x+y+q - x*y) / (1. + q)
+        CRJ0 = carlson_rj(x, y, 1., p)
+        CRC = carlson_rc(x*y + p*q, p*q)
+        CRJ = ((p-1.)*CRJ0 - 3*CRF + 3*math.sqrt((x*y)/(x*y+p*q))*CRC)/(q+1.)
+    return s*CRF + (n/3.)*(s**3)*CRJ
+
+
+@njit(cache=True, error_model='numpy')
+def ellip_pi(n, phi, m):
+    """
+    Scalar Pi(n;phi|m) with the same conventions and special cases as scipy_ellip_binding.ellip_pi_arr.
+    """
+    if abs(phi) <= 1.e-10:
+        return phi
+    if m < -1.e14:
+        return 0.
+    sphi2 = math.sin(phi)**2
+    if 1.-m*sphi2 < 0:
+        return np.nan
+    if abs(phi) > halfpi and m >= 1:
+        return np.nan
+    if abs(phi) > halfpi and n == 1:
+        return np.inf
+    if math.isnan(phi) or math.isinf(phi):
+        return np.nan
+    k = math.floor(phi/np.pi+0.5)
+    phi2 = phi - k*np.pi
+    if 1.-n*sphi2 == 0 or 1.-n*math.sin(phi2)**2 == 0:
+        return np.inf
+    if math.isinf(n):
+        return 0.
+    Pi = _carlson_pi(n, phi2, m)
+    if k != 0:
+        Pi += 2.*k*_carlson_pi(n, halfpi, m)
+    return Pi
+
+
+@njit(cache=True, error_model='numpy')
+def ellipj(u, m):
+    """
+    Jacobi elliptic functions sn, cn, dn and the amplitude am of u for 0 <= m <= 1,
+    following the Cephes routine wrapped by scipy.special.ellipj.
+    """
+    if not (m >= 0 and m <= 1) or math.isnan(u):
+        return np.nan, np.nan, np.nan, np.nan
+    if m < 1.e-9:
+        t = math.sin(u)
+        b = math.cos(u)
+        ai = 0.25*m*(u-t*b)
+        return t-ai*b, b+ai*t, 1.-0.5*m*t*t, u-ai
+    if m >= 0.9999999999:
+        ai = 0.25*(1.-m)
+        b = math.cosh(u)
+        t = math.tanh(u)
+        phi = 1./b
+        twon = b*math.sinh(u)
+        sn = t+ai*(twon-u)/(b*b)
+        ph = 2.*math.atan(math.exp(u))-halfpi+ai*(twon-u)/b
+        ai = ai*t*phi
+        return sn, phi-ai*(twon-u), phi+ai*(twon+u), ph
+    a = np.empty(9)
+    c = np.empty(9)
+    a[0] = 1.
+    b = math.sqrt(1.-m)
+    c[0] = math.sqrt(m)
+    twon = 1.
+    i = 0
+    while abs(c[i]/a[i]) > MACHEP:
+        if i > 7:
+            break
+        ai = a[i]
+        i += 1
+        c[i] = 0.5*(ai-b)
+        t = math.sqrt(ai*b)
+        a[i] = 0.5*(ai+b)
+        b = t
+        twon *= 2.
+    phi = twon*a[i]*u
+    while i > 0:
+        t = c[i]*math.sin(phi)/a[i]
+        b = phi
+        phi = 0.5*(math.asin(t)+phi)
+        i -= 1
+    t = math.cos(phi)
+    return math.sin(phi), t, t/math.cos(phi-b), phi
+
+
+@njit(cache=True, error_model='numpy')
+def R1_R2(al, phi, j, ret_r2):
+    """
+    Scalar version of kerrexact.R1_R2.
+    """
+    al2 = al**2
+    sphi = math.sin(phi)
+    s2phi = math.sqrt(1-j*sphi**2)
+    p1 = math.sqrt((al2 -1)/(j+(1-j)*al2))
+    f1 = 0.5*p1*math.log(abs((p1*s2phi+sphi)/(p1*s2phi-sphi)))
+    nn = al2/(al2-1)
+    R1 = (ellip_pi(nn,phi,j) - al*f1)/(1-al2)
+    R2 = np.nan
+    if ret_r2:
+        F = ellipkinc(phi,j)
+        E = ellipeinc(phi,j)
+        R2 = (F - (al2/(j+(1-j)*al2))*(E - al*sphi*s2phi/(1+al*math.cos(phi)))) / (al2-1)
+        R2 = R2 + (2*j - nn)*R1 / (j + (1-j)*al2)
+    return R1, R2
+
+
+@njit(cache=True, error_model='numpy')
+def nan_to_num(x):
+    if math.isnan(x):
+        return 0.
+    if math.isinf(x):
+        return 1.7976931348623157e308 if x > 0 else -1.7976931348623157e308
+    return x
+
+
+@njit(cache=True, error_model='numpy')
+def sign(x):
+    if x > 0:
+        return 1.
+    if x < 0:
+        return -1.
+    if x == 0:
+        return 0.
+    return np.nan
+
+
+@njit(cache=True, error_model='numpy')
+def _trace_pixel(i, case, sb, lam, eta, r1, r2, rr3, ir3, rr4, ir4, up, um, a, rm, rp, inc, nmin, nmax, axisymmetric, stationary, r_o, r_out, phi_out, t_out, Irmask_out, signpr_out):
+    """
+    Ray trace one pixel for all subimages nmin..nmax, writing into column i of the outputs.
+    Follows kerrexact.ray_trace_by_case line by line.
+    """
+    urat = up/um
+    Kurat = ellipk(urat)
+    m = min(sb, 0.) + nmin
+    Fobs_arg = math.asin(min(max(math.cos(inc)/math.sqrt(up), -1.), 1.))
+    Fobs = ellipkinc(Fobs_arg, urat)
+    rtnega2um = math.sqrt(-um*a**2)
+    a2um = a**2*um
+    Gph_o = 0.
+    Gth_o = 0.
+    Gt_o = 0.
+    if not axisymmetric:
+        Gph_o = -1/math.sqrt(-a2um) * ellip_pi(up, Fobs_arg, urat)
+        Gth_o = -1/math.sqrt(-a2um) * Fobs
+    if not stationary:
+        Eobs = ellipeinc(Fobs_arg, urat)
+        Gt_o = 2*up/rtnega2um* (Eobs - Fobs)/(2*urat) # GL 19a, 31
+
+    if case == 1 or case == 2:
+        r3 = rr3
+        r4 = rr4
+        r31 = r3-r1
+        r32 = r3-r2
+        r42 = r4-r2
+        r41 = r4-r1
+        r43 = r4-r3
+        k = (r32*r41 / (r31*r42))
+        r3142sqrt = np.sqrt(r31*r42)
+        if r_o == np.inf:
+            x2ro = np.sqrt(r31/r41)
+        else:
+            x2ro = np.sqrt(r31*(r_o-r4)/(r41*(r_o-r3)))
+        auxarg = np.arcsin(x2ro)
+        I2ro = 2/r3142sqrt * ellipkinc(auxarg,k)
+        Ir_turn = I2ro
+        if case == 1:
+            Ir_total = 2*Ir_turn
+        else:
+            x2rp = np.sqrt((r31*(rp-r4))/(r41*(rp-r3)))
+            I2rp = 2/r3142sqrt*ellipkinc(np.arcsin(x2rp),k)
+            Ir_total = I2ro-I2rp
+        if not axisymmetric or not stationary:
+            rp3 = rp - r3
+            rm3 = rm - r3
+            rp4 = rp - r4
+            rm4 = rm - r4
+            Rpot_o = (r_o-r1)*(r_o-r2)*(r_o-r3)*(r_o-r4)
+            np1 = r41/r31
+            npp = (rp3*r41)/(rp4*r31)
+            npm = (rm3*r41)/(rm4*r31)
+            Eaux = ellipeinc(auxarg, k)
+            Pi1aux = ellip_pi(np1,auxarg,k)
+            Ppaux = ellip_pi(npp,auxarg,k)
+            Pmaux = ellip_pi(npm,auxarg,k)
+
+        for ni in range(nmax+1-nmin):
+            m += 1
+            Ir = 1/rtnega2um*(2*m*Kurat - sb*Fobs)
+            if case == 1:
+                signpr = sign(Ir_turn-Ir)
+            else:
+                signpr = 1.
+            Irmask = Ir<Ir_total
+            X2 = 1/2*r3142sqrt *(-Ir + I2ro)
+            snnum, cnnum, dnnum, amnum = ellipj(X2,k)
+            snsqr = snnum**2
+            r = (r4*r31 - r3*r41*snsqr)/(r31-r41*snsqr)
+            if not Irmask:
+                r = np.nan
+            r_out[ni,i] = nan_to_num(r)
+            signpr_out[ni,i] = signpr
+            Irmask_out[ni,i] = Irmask
+            if not axisymmetric or not stationary:
+                tau = Ir
+                dX2dtau = -0.5*r3142sqrt
+                dsn2dtau = 2*snnum*cnnum*dnnum*dX2dtau
+                drsdtau = -r31*r43*r41*dsn2dtau / ((r31-r41*snsqr)**2)
+                drsdtau_o = signpr*math.sqrt(Rpot_o)
+                H = drsdtau / (r - r3) - drsdtau_o/(r_o-r3)
+                E = r3142sqrt*(ellipkinc(amnum,k) - signpr*Eaux)
+                Pi_1 = (2./r3142sqrt)*(ellip_pi(np1,amnum,k)-signpr*Pi1aux)
+                Pi_p = (2./r3142sqrt)*(r43/(rp3*rp4))*(ellip_pi(npp,amnum,k)-signpr*Ppaux)
+                Pi_m = (2./r3142sqrt)*(r43/(rm3*rm4))*(ellip_pi(npm,amnum,k)-signpr*Pmaux)
+                I1 = r3*(-tau) + r43*Pi_1 # B48
+                I2 = H - 0.5*(r1*r4 + r2*r3)*(-tau) - E # B49
+                Ip = Ir/rp3 - Pi_p # B50
+                Im = Ir/rm3 - Pi_m # B50
+                _finish_phi_t(i, ni, Irmask, tau, I1, I2, Ip, Im, sb, lam, up, um, urat, a, rm, rp, Gth_o, Gph_o, Gt_o, axisymmetric, stationary, r_o, phi_out, t_out)
+
+    elif case == 3:
+        #r3 and r4 are complex conjugates here
+        z3 = rr3 + 1j*ir3
+        z4 = rr4 + 1j*ir4
+        r21 = r2-r1
+        Agl = np.sqrt((z3-r2)*(z4-r2)).real
+        Bgl = np.sqrt((z3-r1)*(z4-r1)).real
+        k3 = ((Agl+Bgl)**2 - (r2-r1)**2)/(4*Agl*Bgl)
+        rp1 = rp-r1
+        rp2 = rp-r2
+        x3rp = (Agl*rp1 - Bgl*rp2)/(Agl*rp1 + Bgl*rp2) # GL19a, B55
+        if r_o == np.inf:
+            x3ro = (Agl-Bgl)/(Agl+Bgl)
+        else:
+            ro1 = r_o - r1
+            ro2 = r_o - r2
+            Aro1 = Agl*ro1
+            Bro2 = Bgl*ro2
+            x3ro = (Aro1-Bro2)/(Aro1+Bro2)
+        rtAB = np.sqrt(Agl*Bgl)
+        pref = 1/rtAB
+        auxarg = np.arccos(x3ro)
+        Ir_o = pref*ellipkinc(auxarg, k3)
+        Ir_p = pref*ellipkinc(np.arccos(x3rp),k3)
+        Ir_total = Ir_o - Ir_p
+        signpr = 1.
+        if not axisymmetric or not stationary:
+            alp = -1/x3rp
+            rm1 = rm - r1
+            rm2 = rm - r2
+            x3rm = (Agl*rm1 - Bgl*rm2)/(Agl*rm1 + Bgl*rm2) # GL19a, B55
+            alm = -1/x3rm
+            al0 = (Agl+Bgl)/(Bgl-Agl)
+            R1_b_0, R2_b_0 = R1_R2(al0,auxarg,k3,True)
+            R1_b_p, _ = R1_R2(alp,auxarg,k3,False)
+            R1_b_m, _ = R1_R2(alm,auxarg,k3,False)
+            pref2 = ((Bgl*r2 + Agl*r1)/(Bgl+Agl))
+
+        for ni in range(nmax+1-nmin):
+            m += 1
+            Ir = 1/rtnega2um*(2*m*Kurat - sb*Fobs)
+            Irmask = Ir<Ir_total
+            X3 = rtAB*(-Ir +signpr*Ir_o)
+            snnum, cnnum, dnnum, amnum = ellipj(X3, k3)
+            r = ((Bgl*r2 - Agl*r1) + (Bgl*r2+Agl*r1)*cnnum) / ((Bgl-Agl)+(Bgl+Agl)*cnnum)
+            if not Irmask:
+                r = np.nan
+            r_out[ni,i] = nan_to_num(r)
+            signpr_out[ni,i] = signpr
+            Irmask_out[ni,i] = Irmask
+            if not axisymmetric or not stationary:
+                tau = Ir
+                R1_a_0, R2_a_0 = R1_R2(al0,amnum,k3,True)
+                R1_a_p, _ = R1_R2(alp,amnum,k3,False)
+                R1_a_m, _ = R1_R2(alm,amnum,k3,False)
+                Pi_1 = ((2*r21*rtAB)/(Bgl**2-Agl**2)) * (R1_a_0 - signpr *R1_b_0) # B81
+                Pi_2 = ((2*r21*rtAB)/(Bgl**2-Agl**2))**2 * (R2_a_0 - signpr*R2_b_0) # B81
+                Pi_p = ((2*r21*rtAB)/(Bgl*rp2 - Agl*rp1))*(R1_a_p - signpr* R1_b_p) # B82
+                Pi_m = ((2*r21*rtAB)/(Bgl*rm2 - Agl*rm1))*(R1_a_m - signpr*R1_b_m) # B82
+                I1 = pref2*(-tau) + Pi_1 # B78
+                I2 = pref2**2*(-tau) + 2*pref2*Pi_1 + rtAB*Pi_2 # B79
+                Ip = -((Bgl+Agl)*(-tau) + Pi_p) / (Bgl*rp2 + Agl*rp1) # B80
+                Im = -((Bgl+Agl)*(-tau) + Pi_m) / (Bgl*rm2 + Agl*rm1) # B80
+                _finish_phi_t(i, ni, Irmask, tau, I1, I2, Ip, Im, sb, lam, up, um, urat, a, rm, rp, Gth_o, Gph_o, Gt_o, axisymmetric, stationary, r_o, phi_out, t_out)
+
+
+@njit(cache=True, error_model='numpy')
+def _finish_phi_t(i, ni, Irmask, tau, I1, I2, Ip, Im, sb, lam, up, um, urat, a, rm, rp, Gth_o, Gph_o, Gt_o, axisymmetric, stationary, r_o, phi_out, t_out):
+    """
+    Shared angular (G) integrals and the final phi and t of a geodesic.
+    """
+    snarg = math.sqrt(-a**2 * um)*(-tau+sb*Gth_o)
+    if abs(snarg)<1e-12:
+        Phi_tau = snarg
+    else:
+        mk = urat/(urat-1) # real, in (0,1) since k<0
+        #am(sqrt(1-m)x | k) = pi/2 - am(K(m) - x | m for m <=1
+        Phi_tau = 0.5*np.pi-ellipj(ellipk(mk) - snarg/math.sqrt(1-mk), mk)[3]
+    if not axisymmetric:
+        I_phi = (2*a/(rp-rm))*((rp - 0.5*a*lam)*Ip - (rm - 0.5*a*lam)*Im) # B1
+        Gph = (1/math.sqrt(-a**2*um)*ellip_pi(up, Phi_tau, urat)-sb*Gph_o)
+        phi = phi_o + I_phi + lam * Gph
+        if not Irmask:
+            phi = np.nan
+        phi_out[ni,i] = nan_to_num(phi)
+    if not stationary:
+        I0 = -tau
+        I_tA = (4/(rp-rm))*((rp**2 - 0.5*a*lam*rp)*Ip - (rm**2 - 0.5*a*lam*rm)*Im) # B2
+        It = I_tA + 4*I0 + 2*I1 + I2
+        Gt = -(2*up/math.sqrt(-um*a**2)* (ellipeinc(Phi_tau,urat) - ellipkinc(Phi_tau,urat))/(2*urat)) - sb * Gt_o
+        t = It+a**2*Gt
+        t = t+(r_o + 2*np.log(r_o))
+        if not Irmask:
+            t = np.nan
+        t_out[ni,i] = nan_to_num(t)
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _trace_kernel(cases, sb, lam, eta, r1, r2, rr3, ir3, rr4, ir4, up, um, a, rm, rp, inc, nmin, nmax, axisymmetric, stationary, r_o, r_out, phi_out, t_out, Irmask_out, signpr_out):
+    for i in prange(len(cases)):
+        if cases[i] > 0:
+            _trace_pixel(i, cases[i], sb[i], lam[i], eta[i], r1[i], r2[i], rr3[i], ir3[i], rr4[i], ir4[i], up[i], um[i], a, rm, rp, inc, nmin, nmax, axisymmetric, stationary, r_o, r_out, phi_out, t_out, Irmask_out, signpr_out)
+
+
+def trace_pixels(a, rm, rp, sb, lam, eta, r1, r2, r3, r4, up, um, inc, nmin, nmax, case1, case2, case3, axisymmetric=True, stationary=True, r_o=np.inf):
+    """
+    Drop-in replacement for the case-by-case ray tracing and stitching in kerrexact.ray_trace_all.
+    Returns per-subimage lists of r, phi, t, Irmask and sign(p_r) on the full pixel grid.
+    """
+    cases = np.zeros(len(sb), dtype=np.int8)
+    cases[case1] = 1
+    cases[case2] = 2
+    cases[case3] = 3
+    nn = nmax+1-nmin
+    npix = len(sb)
+    r_out = np.zeros((nn, npix))
+    phi_out = np.zeros((nn, npix))
+    t_out = np.zeros((nn, npix))
+    Irmask_out = np.ones((nn, npix))
+    signpr_out = np.ones((nn, npix))
+    _trace_kernel(cases, np.asarray(sb, dtype=float), np.asarray(lam, dtype=float), np.asarray(eta, dtype=float),
+                  np.real(r1).astype(float), np.real(r2).astype(float), np.real(r3).astype(float), np.imag(r3).astype(float), np.real(r4).astype(float), np.imag(r4).astype(float),
+                  np.asarray(up, dtype=float), np.asarray(um, dtype=float), float(a), float(rm), float(rp), float(inc), nmin, nmax,
+                  axisymmetric, stationary, float(r_o), r_out, phi_out, t_out, Irmask_out, signpr_out)
+    return list(r_out), list(phi_out), list(t_out), list(Irmask_out), list(signpr_out)
@@ -96,172 +96,125 @@ def ellip_pi(n,phi,m,precision=1.e-3):
 
     return Pi
 
+def _carlson_pi(n,phi,m):
+    """Pi(n;phi|m) from CarlsonRF and CarlsonRJ for flat arrays with -pi/2 <= phi <= pi/2.
+       Uses the DLMF 19.20.14 transform where rho = 1-n*sin^2(phi) < 0.
+    """
+    sphi = np.sin(phi)
+    x = np.cos(phi)**2
+    y = 1. - m*sphi**2
+    z = np.ones(phi.shape)
+    rho = 1. - n*sphi**2
+
+    CRF = sp.elliprf(x,y,z)
+    CRJ = np.empty(phi.shape)
+
+    rhomask = rho > 0
+    if np.any(rhomask):
+        CRJ[rhomask] = sp.elliprj(x[rhomask],y[rhomask],z[rhomask],rho[rhomask])
+
+    rhomask = ~rhomask
+    if np.any(rhomask): # transform for rho<0, https://dlmf.nist.gov/19.20#E14 19.20.14
+        x_m = x[rhomask]
+        y_m = y[rhomask]
+        z_m = z[rhomask]
+        q_m = -rho[rhomask]
+        p_m = (z_m*(x_m+y_m+q_m) - x_m*y_m) / (z_m + q_m)
+        CRJ0 = sp.elliprj(x_m,y_m,z_m,p_m)
+        CRC = sp.elliprc(x_m*y_m + p_m*q_m,p_m*q_m)
+        CRJ[rhomask] = ((p_m-z_m)*CRJ0 - 3*CRF[rhomask] + 3*np.sqrt((x_m*y_m*z_m)/(x_m*y_m+p_m*q_m))*CRC)/(q_m+z_m)
+
+    return sphi*CRF + (n/3.)*(sphi**3)*CRJ
+
 def ellip_pi_arr(n,phi,m):
     """Incomplete Elliptic Integral of the Third Kind Pi(n;phi|m)
        Convention following Abramowitz & Stegun & Mathematica
        DIFFERENT from gsl convention.
-       Implemented using CarlsonRJ and CarlsonRF and periodicities to account for full range
+       Implemented using CarlsonRJ and CarlsonRF and periodicities to account for full range.
+       n and m may be scalars or any arrays that broadcast against phi.
        """
 
-    if not isinstance(n, np.ndarray): n  = np.array([n]).flatten()
-    if not isinstance(phi, np.ndarray): phi = np.array([phi]).flatten()
-    if not isinstance(m, np.ndarray): m = np.array([m]).flatten()
-    
-    #print(n.shape[-1],phi.shape[-1],m.shape[-1])
-    if not(n.shape[-1]==phi.shape[-1]==m.shape[-1]):
-        raise Exception("inputs to ellip_pi_arr do not have same last dimension!")
-        
-    # if dimensions aren't equal, expand parameter arrays # TODO?? 
-    if (len(n.shape)!=len(phi.shape)):
-        n = np.outer(np.ones(phi.shape[0]),n)
-    if (len(m.shape)!=len(phi.shape)):
-        m = np.outer(np.ones(phi.shape[0]),m)
-                        
+    n = np.atleast_1d(np.asarray(n, dtype=float))
+    phi = np.atleast_1d(np.asarray(phi, dtype=float))
+    m = np.atleast_1d(np.asarray(m, dtype=float))
+    try:
+        n, phi, m = np.broadcast_arrays(n, phi, m)
+    except ValueError:
+        raise Exception("inputs to ellip_pi_arr cannot be broadcast together!")
+
     # real range is m sin^2(phi) < 1, n sin^2 phi < 1
     # relation to Carlson symmetric form only works for -pi/2 < phi < pi/2,
-    # need to use periodicity outside this range
-
-    # derived quantities
-    cphi = np.cos(phi)
-    sphi = np.sin(phi)
-
-    x = cphi**2
-    y = 1. - m*sphi**2
-    z = np.ones(x.shape)
-    rho = 1. - n*sphi**2
-
+    # so write phi = k*pi + phi2 with |phi2| <= pi/2 and use
+    # Pi(n;phi|m) = 2k*Pi(n;pi/2|m) + Pi(n;phi2|m)
+    absphi = np.abs(phi)
+    sphi2 = np.sin(phi)**2
+    k = np.round(phi/np.pi)
+    phi2 = phi - k*np.pi
+    rho2 = 1. - n*np.sin(phi2)**2
+
+    # special cases, in order of precedence
+    conditions = [absphi<=1.e-10,                   # limit as phi->0
+                  m<-1.e14,                         # limit as m->-infinity
+                  1. - m*sphi2 < 0,                 # outside the allowed region
+                  (absphi>halfpi) & (m>=1),
+                  (absphi>halfpi) & (n==1),
+                  (1. - n*sphi2 == 0) | (rho2 == 0),
+                  np.isinf(n)]
+    values = [phi, 0., np.nan, np.nan, np.inf, np.inf, 0.]
+
+    outarr = np.empty(phi.shape)
+    donemask = np.zeros(phi.shape, dtype=bool)
+    for condition, value in zip(conditions, values):
+        newmask = condition & ~donemask
+        if np.any(newmask):
+            outarr[newmask] = value[newmask] if isinstance(value, np.ndarray) else value
+            donemask |= newmask
+
+    # evaluate the reduced incomplete part and, where k != 0, the complete part in one call
+    livemask = ~donemask
+    if np.any(livemask):
+        n_m = n[livemask]
+        m_m = m[livemask]
+        k_m = k[livemask]
+        compmask = k_m != 0
+        ncomp = np.count_nonzero(compmask)
+        Pi = _carlson_pi(np.concatenate([n_m, n_m[compmask]]),
+                         np.concatenate([phi2[livemask], np.full(ncomp, halfpi)]),
+                         np.concatenate([m_m, m_m[compmask]]))
+        outarr[livemask] = Pi[:len(n_m)]
+        if ncomp:
+            outarr.reshape(-1)[np.flatnonzero(livemask)[compmask]] += 2*k_m[compmask]*Pi[len(n_m):]
 
-    outarr = np.zeros(phi.shape)
-    donemask = np.zeros(phi.shape).astype(bool)
-    
-    # limit as phi->0
-    mask1 = np.abs(phi)<=1.e-10
-    if np.any(mask1):
-        outarr[mask1] = phi[mask1]
-    donemask += mask1
-    
-    # limit as m->-infinity
-    mask2 = (m<-1.e14) * ~donemask
-    if np.any(mask2):
-        outarr[mask2] = 0.
-    donemask += mask2
-        
-    # check the allowed region
-    mask3 = (y<0) * ~donemask
-    if np.any(mask3):
-        outarr[mask3] = np.nan
-    donemask += mask3
-            
-    mask4 = (np.abs(phi)>halfpi) * (m>=1) * ~donemask
-    if np.any(mask4):
-        outarr[mask4] = np.nan        
-    donemask += mask4
-    
-    mask5 = (np.abs(phi)>halfpi) * (n==1) * ~donemask
-    if np.any(mask5):
-        outarr[mask5] = np.inf        
-    donemask += mask5
-    
-    mask6 = (rho==0) * ~donemask
-    if np.any(mask6):
-        outarr[mask6] = np.inf        
-    donemask += mask6
-    
-    mask7 = np.isinf(n) * ~donemask
-    if np.any(mask7):
-        outarr[mask7] = 0        
-    donemask += mask7
-
-    # account for periodicity
-    mask8 = (np.abs(phi)>np.pi) * ~donemask
-    if np.any(mask8):
-        m_m = m[mask8]
-        n_m = n[mask8]
-        phi_m = phi[mask8] 
-        
-        s = np.sign(phi_m)
-        k = s*np.floor(np.abs(phi_m)/np.pi)
-        phi2 = phi_m - k*np.pi
-        comp_part = 2*k*ellip_pi_arr(n_m,halfpi*np.ones(phi2.shape),m_m)
-        incomp_part = ellip_pi_arr(n_m,phi2,m_m)
-        Pi = comp_part + incomp_part
-        outarr[mask8] = Pi
-    donemask += mask8
-        
-    mask9 = (np.abs(phi)>halfpi) * (np.abs(phi)<=np.pi) * ~donemask
-    if np.any(mask9):
-        m_m = m[mask9]
-        n_m = n[mask9]
-        phi_m = phi[mask9] 
-            
-        s = np.sign(phi_m)
-        phi2 = -phi_m + s*np.pi
-        comp_part = s*2*ellip_pi_arr(n_m,halfpi*np.ones(phi2.shape),m_m)
-        incomp_part = -ellip_pi_arr(n_m,phi2,m_m)
-        Pi = comp_part + incomp_part
-        outarr[mask9] = Pi
-    donemask += mask9
-    
-    # all others
-    nmask = ~donemask
-    if np.any(nmask):
-        m_m = m[nmask]
-        n_m = n[nmask]
-        phi_m = phi[nmask] 
-            
-        sphi_m = sphi[nmask]
-        x_m = x[nmask]
-        y_m = y[nmask]
-        z_m = z[nmask]
-        rho_m = rho[nmask]
-        
-        q_m = -rho_m           
-        p_m = (z_m*(x_m+y_m+q_m) - x_m*y_m) / (z_m + q_m) 
-        aa = (x_m*y_m + p_m*q_m)
-        bb = p_m*q_m
-        fac1 = p_m - z_m
-        fac2_num = (x_m*y_m*z_m)
-        fac2_denom = (x_m*y_m+p_m*q_m)
-        fac3 = q_m + z_m
-                                       
-        rhomask = rho_m > 0
-
-        CRF = sp.elliprf(x_m,y_m,z_m)
-        CRJ = np.zeros(phi_m.shape)
-        if np.any(rhomask):
-            CRJ[rhomask] = sp.elliprj(x_m[rhomask],y_m[rhomask],z_m[rhomask],rho_m[rhomask])
-        
-        rhomask = ~rhomask  
-        if np.any(rhomask): # transform for rho<0, https://dlmf.nist.gov/19.20#E14 19.20.14
-            CRJ0 = sp.elliprj(x_m[rhomask],y_m[rhomask],z_m[rhomask],p_m[rhomask])
-            CRC = sp.elliprc(aa[rhomask],bb[rhomask])
-            
-            fac2 = 3*np.sqrt(fac2_num[rhomask]/fac2_denom[rhomask])
-            CRJ[rhomask] = (fac1[rhomask]*CRJ0 - 3*CRF[rhomask] + fac2*CRC)
-            CRJ[rhomask] = CRJ[rhomask] / fac3[rhomask]
-
-
-        F = sphi_m * CRF
-        Pi = F + (n_m/3.)*(sphi_m**3)*CRJ
-        outarr[nmask] = Pi
-        
     return outarr
 
 
 
-def test_ellip_pi(n = .8, m=-.33):
+def test_ellip_pi(n = .8, m=-.33, tol=1.e-10):
 
     args = [[n,.026,m],[n,.1,m],[n,np.pi/2.,m],[n,2.37,m],[n,4.1,m],
             [n,6.,m],[n,7.7,m],[n,14.3,m],[n,215.,m],
             [n,-.026,m],[n,-.1,m],[n,-np.pi/2.,m],[n,-2.37,m],[n,-4.1,m],
             [n,-6.,m],[n,-7.7,m],[n,-14.3,m],[n,-215.,m]]
 
+    mp_pis = np.zeros(len(args))
     for k,arg in enumerate(args):
         mp_pi = mp.ellippi(arg[0],arg[1],arg[2])
         if np.imag(mp_pi)!=0.:
             print(k," complex result")
+            mp_pis[k] = np.nan
         else:
             mp_pi = np.real(mp_pi)
-            gsl_pi = ellip_pi_arr(arg[0],arg[1],arg[2])
+            mp_pis[k] = mp_pi
+            gsl_pi = ellip_pi_arr(arg[0],arg[1],arg[2])[0]
             print("%d | %.6e %.6e %.6e"%(k,mp_pi,gsl_pi,1.-gsl_pi/mp_pi))
-    return
+
+    # all angles in one call, with n and m broadcast as scalars and as rows of a 2d phi array
+    phis = np.array([arg[1] for arg in args])
+    vec_pis = ellip_pi_arr(n,phis,m)
+    bcast_pis = ellip_pi_arr(np.array([n,n]),np.array([phis,phis]).T,np.array([m,m]))
+    ok = ~np.isnan(mp_pis)
+    maxerr = np.max(np.abs(1.-vec_pis[ok]/mp_pis[ok]))
+    print("max relative error of vectorized call: %.3e"%maxerr)
+    if maxerr > tol or not np.allclose(bcast_pis, vec_pis[:,None], rtol=tol, atol=0):
+        raise Exception("ellip_pi_arr disagrees with mpmath reference!")
+    return maxerr
@@ -0,0 +1,35 @@
+import numpy as np
+from bam.inference.kerrbam import KerrBam
+from bam.inference.geodesic_tables import build_geodesic_table
+import ehtim as eh
+
+
+#geodesic tables supply phi and t, so they only help non-axisymmetric or non-stationary models
+def example_phi_jfunc(r, phi, jargs):
+    peak_r = jargs[0]
+    thickness = jargs[1]
+    peak_phi = jargs[2]
+    return np.exp(-4.*np.log(2)*((r-peak_r)/thickness)**2)*(1+np.sin(phi-peak_phi))
+
+obs = eh.obsdata.load_uvfits('SR1_M87_2017_101_lo_hops_netcal_StokesI.uvfits')
+obs.add_scans()
+obs_sa = obs.avg_coherent(0., scan_avg=True)
+
+fov = 60*eh.RADPERUAS
+npix = 30
+nmax = 1
+adap_fac = 2
+MoDuas_to_fit = [2,5]
+a_to_fit = [-0.99, -0.01]
+inc_to_fit = [1*np.pi/180, 30*np.pi/180]
+
+#tabulate the ray tracing once over the prior box; the table is in units of M,
+#so it is reusable for every fit of this source with the same grid and nmax
+fov_M = fov/eh.RADPERUAS/np.min(MoDuas_to_fit)
+build_geodesic_table('./geodesic_table', fov_M, npix, np.linspace(-0.99,-0.01,50), np.linspace(1,30,30)*np.pi/180, nmax, adap_fac=adap_fac, axisymmetric=False)
+
+modelb = KerrBam(fov, npix, example_phi_jfunc, ['peak_r','thickness','peak_phi'], [4.5, 2., np.pi/2], MoDuas_to_fit, a_to_fit, inc_to_fit, 0.6, PA=288/180*np.pi, chi=-135/180*np.pi, nmax=nmax, beta=0.5, adap_fac=adap_fac, axisymmetric=False, geodesic_table='./geodesic_table')
+
+modelb.setup(obs_sa, data_types=['logcamp','cphase'])
+modelb.run_nested_default()
+modelb.cornerplot(save='geodesic_table_corner.png', show=False)